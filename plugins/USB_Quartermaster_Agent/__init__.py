@@ -0,0 +1 @@
+from .communicator import Agent
@@ -0,0 +1,59 @@
+import logging
+from typing import Any, Optional
+
+from django.conf import settings
+
+from USB_Quartermaster_common import AbstractCommunicator, CommunicatorError, CommandResponse
+from quartermaster_agent import protocol
+
+logger = logging.getLogger(__name__)
+
+
+class AgentError(CommunicatorError):
+    pass
+
+
+class Agent(AbstractCommunicator):
+    """
+    Talks to the agent daemon running on the remote host. Requests go through the agent hub, started with the
+    `run_agent_hub` management command, which holds the agents' connections and the inventory they last reported.
+    """
+    CONFIGURATION_KEYS = ("token",)
+    SUPPORTED_HOST_TYPES = ("Darwin", "Linux_AMD64", "Windows")
+    SUPPORTED_REQUESTS = ('bind', 'unbind', 'stop_using')
+    IDENTIFIER = "Agent"
+
+    def hub_call(self, method: str, params: dict) -> Any:
+        params = dict(params, host_id=self.host.pk, control_token=settings.AGENT_HUB_CONTROL_TOKEN)
+        try:
+            return protocol.call(settings.AGENT_HUB_CONTROL_ADDRESS, method, params,
+                                 timeout=settings.AGENT_REQUEST_TIMEOUT)
+        except protocol.RPCError as e:
+            if e.code == protocol.AGENT_NOT_CONNECTED:
+                self.forget_contact()
+            raise AgentError(f"Agent request {method} to {self.host} failed: {e.message}")
+        except OSError as e:
+            raise AgentError(f"Could not reach the agent hub at {settings.AGENT_HUB_CONTROL_ADDRESS}: {e}")
+
+    def request(self, method: str, **params) -> Any:
+        result = self.hub_call('call', {'method': method, 'params': params})
+        self.record_contact()
+        return result
+
+    def get_inventory(self) -> Optional[dict]:
+        inventory = self.hub_call('inventory', {'max_age': settings.AGENT_INVENTORY_MAX_AGE.total_seconds()})
+        self.record_contact()
+        return inventory
+
+    def execute_command(self, command: str) -> CommandResponse:
+        response = CommandResponse(**self.request('execute', command=command))
+        if response.return_code != 0:
+            logger.warning(f"Command on {self.host} returned rc={response.return_code}, command={command}")
+        return response
+
+    def is_host_reachable(self) -> bool:
+        try:
+            return bool(self.hub_call('connected', {}))
+        except AgentError as e:
+            logger.warning(str(e))
+            return False
@@ -0,0 +1,126 @@
+import asyncio
+import logging
+import secrets
+import ssl
+import time
+from typing import Dict, Tuple, Callable, Optional, Any
+
+from quartermaster_agent.protocol import Connection, RPCError, AGENT_NOT_CONNECTED, UNAUTHORIZED, METHOD_NOT_FOUND, \
+    STREAM_LIMIT
+
+logger = logging.getLogger(__name__)
+
+
+class AgentHub(object):
+    """
+    Holds the connections agents make in and relays requests from the rest of the server to them over a local
+    control socket. Inventory the agents push is cached here so polling a host doesn't need a round trip to it.
+
+    authenticate(host_id, token) is blocking, it is run in the executor so it may use the database.
+
+    Every control request has to carry `control_token` and only RELAYED_METHODS are passed on to agents, agents run
+    as a privileged user so the control socket mustn't be a way to have them do anything else.
+    """
+    RELAYED_METHODS = ('inventory', 'bind', 'unbind', 'stop_using', 'execute')
+
+    def __init__(self, authenticate: Callable[[int, str], bool], control_token: str, request_timeout: float = 10.0):
+        if not control_token:
+            raise ValueError("A control token is required")
+        self.authenticate = authenticate
+        self.control_token = control_token
+        self.request_timeout = request_timeout
+        self.agents: Dict[int, Connection] = {}
+        self.inventories: Dict[int, Tuple[float, dict]] = {}
+
+    async def serve(self, agent_address: Tuple[str, int], control_address: Tuple[str, int],
+                    ssl_context: Optional[ssl.SSLContext] = None) -> None:
+        """Agents connect over TLS when `ssl_context` is given, their tokens are sent in the clear otherwise"""
+        agent_server = await asyncio.start_server(self.handle_agent, *agent_address, limit=STREAM_LIMIT,
+                                                  ssl=ssl_context)
+        control_server = await asyncio.start_server(self.handle_control, *control_address, limit=STREAM_LIMIT)
+        logger.info(f"Agent hub listening for agents on {agent_address[0]}:{agent_address[1]} "
+                    f"and for control requests on {control_address[0]}:{control_address[1]}")
+        async with agent_server, control_server:
+            await asyncio.gather(agent_server.serve_forever(), control_server.serve_forever())
+
+    async def handle_agent(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        host_id: Optional[int] = None
+        connection: Connection
+
+        async def handler(method: str, params: dict) -> Any:
+            nonlocal host_id
+            if method == 'register':
+                host_id = await self.register(connection, **params)
+                return 'ok'
+            if host_id is None:
+                raise RPCError(UNAUTHORIZED, "register first")
+            if method == 'report':
+                self.inventories[host_id] = (time.monotonic(), params)
+                return None
+            raise RPCError(METHOD_NOT_FOUND, f"Unknown method {method}")
+
+        connection = Connection(reader, writer, handler)
+        try:
+            await connection.serve()
+        finally:
+            if host_id is not None and self.agents.get(host_id) is connection:
+                logger.info(f"Agent for host {host_id} disconnected")
+                del self.agents[host_id]
+                self.inventories.pop(host_id, None)
+
+    async def register(self, connection: Connection, host_id: int, token: str) -> int:
+        loop = asyncio.get_running_loop()
+        if not await loop.run_in_executor(None, self.authenticate, host_id, token):
+            logger.warning(f"Rejected agent for host {host_id} from {connection.peer}")
+            raise RPCError(UNAUTHORIZED, "Unknown host or bad token")
+
+        previous = self.agents.get(host_id)
+        if previous is not None and previous is not connection:
+            logger.info(f"Agent for host {host_id} reconnected from {connection.peer}, dropping old connection")
+            previous.close()
+        self.agents[host_id] = connection
+        logger.info(f"Agent for host {host_id} registered from {connection.peer}")
+        return host_id
+
+    def agent(self, host_id: int) -> Connection:
+        connection = self.agents.get(host_id)
+        if connection is None or connection.closed:
+            raise RPCError(AGENT_NOT_CONNECTED, f"No agent connected for host {host_id}")
+        return connection
+
+    async def handle_control(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        await Connection(reader, writer, self.control_request).serve()
+
+    async def control_request(self, method: str, params: dict) -> Any:
+        token = params.pop('control_token', None)
+        if not isinstance(token, str) or not secrets.compare_digest(token, self.control_token):
+            raise RPCError(UNAUTHORIZED, "Missing or bad control token")
+        if method == 'call':
+            return await self.call(**params)
+        elif method == 'inventory':
+            return await self.inventory(**params)
+        elif method == 'connected':
+            connection = self.agents.get(params['host_id'])
+            return connection is not None and not connection.closed
+        elif method == 'status':
+            now = time.monotonic()
+            return {host_id: {'peer': connection.peer,
+                              'inventory_age': now - self.inventories[host_id][0]
+                              if host_id in self.inventories else None}
+                    for host_id, connection in self.agents.items()}
+        raise RPCError(METHOD_NOT_FOUND, f"Unknown method {method}")
+
+    async def call(self, host_id: int, method: str, params: Optional[dict] = None) -> Any:
+        if method not in self.RELAYED_METHODS:
+            raise RPCError(METHOD_NOT_FOUND, f"{method} is not relayed to agents")
+        return await self.agent(host_id).call(method, params, timeout=self.request_timeout)
+
+    async def inventory(self, host_id: int, max_age: float) -> dict:
+        """The last inventory the agent reported, or a fresh one if that is older than max_age seconds"""
+        connection = self.agent(host_id)
+        cached = self.inventories.get(host_id)
+        if cached is not None and time.monotonic() - cached[0] <= max_age:
+            return cached[1]
+        inventory = await connection.call('inventory', timeout=self.request_timeout)
+        self.inventories[host_id] = (time.monotonic(), inventory)
+        return inventory
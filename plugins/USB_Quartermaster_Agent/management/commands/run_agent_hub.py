@@ -0,0 +1,46 @@
+import asyncio
+import secrets
+import ssl
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections
+
+from data.models import RemoteHost
+from USB_Quartermaster_Agent.hub import AgentHub
+
+
+def authenticate_agent(host_id: int, token: str) -> bool:
+    # The hub runs for as long as the process and looks hosts up from executor threads, drop connections the database
+    # closed or that are past CONN_MAX_AGE the way a request would
+    close_old_connections()
+    try:
+        host = RemoteHost.objects.get(pk=host_id, communicator='Agent')
+    except RemoteHost.DoesNotExist:
+        return False
+    finally:
+        close_old_connections()
+    expected = host.config.get('token')
+    return bool(expected) and secrets.compare_digest(str(expected), str(token))
+
+
+class Command(BaseCommand):
+    help = "Accept connections from remote host agents and relay requests to them"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--insecure', action='store_true',
+                            help="Accept agent connections without TLS, agent tokens are sent in the clear")
+
+    def handle(self, *args, **options):
+        if not settings.AGENT_HUB_CONTROL_TOKEN:
+            raise CommandError("AGENT_HUB_CONTROL_TOKEN must be set")
+        ssl_context = None
+        if not options['insecure']:
+            if not (settings.AGENT_HUB_TLS_CERTFILE and settings.AGENT_HUB_TLS_KEYFILE):
+                raise CommandError("AGENT_HUB_TLS_CERTFILE and AGENT_HUB_TLS_KEYFILE must be set, or use --insecure")
+            ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+            ssl_context.load_cert_chain(settings.AGENT_HUB_TLS_CERTFILE, settings.AGENT_HUB_TLS_KEYFILE)
+        hub = AgentHub(authenticate=authenticate_agent, control_token=settings.AGENT_HUB_CONTROL_TOKEN,
+                       request_timeout=settings.AGENT_REQUEST_TIMEOUT)
+        asyncio.run(hub.serve(settings.AGENT_HUB_LISTEN_ADDRESS, settings.AGENT_HUB_CONTROL_LISTEN_ADDRESS,
+                              ssl_context=ssl_context))
@@ -0,0 +1,291 @@
+import asyncio
+import os
+import sys
+from unittest.mock import MagicMock
+
+import pytest
+
+import quartermaster_agent
+from quartermaster_agent import protocol
+from quartermaster_agent.daemon import AgentDaemon, usbip_inventory, parse_virtualhere_state
+from USB_Quartermaster_Agent.hub import AgentHub
+from USB_Quartermaster_Agent.management.commands import run_agent_hub
+from data.models import RemoteHost
+
+VH_STATE = """<?xml version="1.0" encoding="utf-8"?>
+<state>
+  <server>
+    <connection id="1" ip="127.0.0.1" hostname="remotehost" port="7575" />
+    <device address="1101" nickname="Phone" state="1" />
+    <device address="1102" nickname="Tablet" state="3" />
+  </server>
+</state>
+"""
+
+
+def make_sysfs_device(root, name, **attributes):
+    path = root / name
+    path.mkdir()
+    for attribute, value in attributes.items():
+        (path / attribute).write_text(value + '\n')
+
+
+def test_usbip_inventory(tmp_path):
+    devices = tmp_path / 'devices'
+    devices.mkdir()
+    make_sysfs_device(devices, '1-1', bDeviceClass='00', idVendor='0403', idProduct='6015',
+                      manufacturer='FTDI', product='Bridge')
+    make_sysfs_device(devices, '1-2', bDeviceClass='00', idVendor='05c6', idProduct='901d')
+    make_sysfs_device(devices, '1-1:1.0', bInterfaceNumber='00')
+    make_sysfs_device(devices, 'usb1', bDeviceClass='09')
+    make_sysfs_device(devices, '2-1', bDeviceClass='09')
+    driver = tmp_path / 'usbip-host'
+    driver.mkdir()
+    (driver / '1-2').mkdir()
+    (driver / 'bind').write_text('')
+
+    inventory = usbip_inventory(str(devices), str(driver))
+
+    assert inventory['shared'] == ['1-2']
+    assert inventory['devices'] == [
+        {'bus_id': '1-1', 'id_vendor': '0403', 'id_product': '6015', 'vendor': 'FTDI', 'product': 'Bridge'},
+        {'bus_id': '1-2', 'id_vendor': '05c6', 'id_product': '901d', 'vendor': 'unknown vendor',
+         'product': 'unknown product'},
+    ]
+
+
+def test_usbip_inventory_without_driver(tmp_path):
+    assert usbip_inventory(str(tmp_path), str(tmp_path / 'missing')) == {'devices': [], 'shared': []}
+
+
+def test_parse_virtualhere_state():
+    assert parse_virtualhere_state(VH_STATE) == [
+        {'address': 'remotehost.1101', 'nickname': 'Phone', 'shared': False},
+        {'address': 'remotehost.1102', 'nickname': 'Tablet', 'shared': True},
+    ]
+
+
+def test_decode_rejects_bad_json():
+    with pytest.raises(protocol.RPCError) as e:
+        protocol.decode(b'{not json\n')
+    assert e.value.code == protocol.PARSE_ERROR
+
+
+def test_unwrap_error():
+    with pytest.raises(protocol.RPCError) as e:
+        protocol.unwrap(protocol.make_error(1, protocol.UNAUTHORIZED, 'nope'))
+    assert e.value.code == protocol.UNAUTHORIZED
+    assert protocol.unwrap(protocol.make_result(1, {'a': 1})) == {'a': 1}
+
+
+class FakeDaemon(AgentDaemon):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.shared = set()
+
+    async def inventory(self) -> dict:
+        return {'usbip': {'devices': [{'bus_id': '1-1', 'id_vendor': '0403', 'id_product': '6015',
+                                       'vendor': 'FTDI', 'product': 'Bridge'}],
+                          'shared': sorted(self.shared)}}
+
+    async def bind(self, bus_id: str) -> dict:
+        self.shared.add(bus_id)
+        await self.report()
+        return {'return_code': 0, 'stdout': '', 'stderr': ''}
+
+
+async def start_hub(hub: AgentHub):
+    agent_server = await asyncio.start_server(hub.handle_agent, '127.0.0.1', 0)
+    control_server = await asyncio.start_server(hub.handle_control, '127.0.0.1', 0)
+    return agent_server, control_server
+
+
+CONTROL_TOKEN = 'control-secret'
+
+
+async def control_call(address, method, params, control_token=CONTROL_TOKEN):
+    # The blocking client is what the server uses, run it off the loop so the hub can answer
+    loop = asyncio.get_running_loop()
+    params = dict(params, control_token=control_token)
+    return await loop.run_in_executor(None, protocol.call, address, method, params, 5.0)
+
+
+def make_hub():
+    return AgentHub(authenticate=lambda host_id, token: token == 'secret', control_token=CONTROL_TOKEN)
+
+
+async def wait_for_inventory(hub: AgentHub, host_id: int):
+    for _ in range(100):
+        if host_id in hub.inventories:
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError("Agent never reported")
+
+
+def test_hub_relays_requests():
+    async def scenario():
+        hub = make_hub()
+        agent_server, control_server = await start_hub(hub)
+        agent_port = agent_server.sockets[0].getsockname()[1]
+        control_address = control_server.sockets[0].getsockname()[:2]
+
+        daemon = FakeDaemon(f"127.0.0.1:{agent_port}", host_id=7, token='secret', report_interval=60)
+        session = asyncio.ensure_future(daemon.session())
+        try:
+            await wait_for_inventory(hub, 7)
+            assert await control_call(control_address, 'connected', {'host_id': 7})
+            assert not await control_call(control_address, 'connected', {'host_id': 8})
+
+            inventory = await control_call(control_address, 'inventory', {'host_id': 7, 'max_age': 60})
+            assert inventory['usbip']['shared'] == []
+
+            await control_call(control_address, 'call', {'host_id': 7, 'method': 'bind', 'params': {'bus_id': '1-1'}})
+            # The agent reports again after changing the binding so the cached copy is already current
+            inventory = await control_call(control_address, 'inventory', {'host_id': 7, 'max_age': 60})
+            assert inventory['usbip']['shared'] == ['1-1']
+
+            with pytest.raises(protocol.RPCError) as e:
+                await control_call(control_address, 'call', {'host_id': 8, 'method': 'bind', 'params': {}})
+            assert e.value.code == protocol.AGENT_NOT_CONNECTED
+        finally:
+            session.cancel()
+            agent_server.close()
+            control_server.close()
+
+    asyncio.run(scenario())
+
+
+def test_hub_rejects_bad_token():
+    async def scenario():
+        hub = make_hub()
+        agent_server, control_server = await start_hub(hub)
+        agent_port = agent_server.sockets[0].getsockname()[1]
+        daemon = FakeDaemon(f"127.0.0.1:{agent_port}", host_id=7, token='wrong')
+        try:
+            with pytest.raises(protocol.RPCError) as e:
+                await daemon.session()
+            assert e.value.code == protocol.UNAUTHORIZED
+            assert 7 not in hub.agents
+        finally:
+            agent_server.close()
+            control_server.close()
+
+    asyncio.run(scenario())
+
+
+def test_hub_control_requires_token():
+    async def scenario():
+        hub = make_hub()
+        agent_server, control_server = await start_hub(hub)
+        agent_port = agent_server.sockets[0].getsockname()[1]
+        control_address = control_server.sockets[0].getsockname()[:2]
+        daemon = FakeDaemon(f"127.0.0.1:{agent_port}", host_id=7, token='secret', report_interval=60)
+        session = asyncio.ensure_future(daemon.session())
+        try:
+            await wait_for_inventory(hub, 7)
+            for control_token in ('wrong', None):
+                with pytest.raises(protocol.RPCError) as e:
+                    await control_call(control_address, 'call',
+                                       {'host_id': 7, 'method': 'bind', 'params': {'bus_id': '1-1'}},
+                                       control_token=control_token)
+                assert e.value.code == protocol.UNAUTHORIZED
+            assert daemon.shared == set()
+        finally:
+            session.cancel()
+            agent_server.close()
+            control_server.close()
+
+    asyncio.run(scenario())
+
+
+def test_hub_only_relays_allowed_methods():
+    async def scenario():
+        hub = make_hub()
+        agent_server, control_server = await start_hub(hub)
+        agent_port = agent_server.sockets[0].getsockname()[1]
+        control_address = control_server.sockets[0].getsockname()[:2]
+        daemon = FakeDaemon(f"127.0.0.1:{agent_port}", host_id=7, token='secret', report_interval=60)
+        session = asyncio.ensure_future(daemon.session())
+        try:
+            await wait_for_inventory(hub, 7)
+            with pytest.raises(protocol.RPCError) as e:
+                await control_call(control_address, 'call', {'host_id': 7, 'method': 'run_process', 'params': {}})
+            assert e.value.code == protocol.METHOD_NOT_FOUND
+        finally:
+            session.cancel()
+            agent_server.close()
+            control_server.close()
+
+    asyncio.run(scenario())
+
+
+# Remote hosts don't have the server's dependencies, the daemon has to start without them
+WITHOUT_SERVER = """
+import runpy, sys
+for name in ('django', 'USB_Quartermaster_common', 'USB_Quartermaster_Agent'):
+    sys.modules[name] = None
+runpy.run_module('quartermaster_agent.daemon', run_name='__main__')
+"""
+
+
+def test_daemon_runs_without_server_dependencies():
+    async def scenario():
+        hub = make_hub()
+        agent_server, control_server = await start_hub(hub)
+        agent_port = agent_server.sockets[0].getsockname()[1]
+        plugins_path = os.path.dirname(os.path.dirname(os.path.abspath(quartermaster_agent.__file__)))
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, '-c', WITHOUT_SERVER, '--hub', f"127.0.0.1:{agent_port}", '--host-id', '7',
+            '--token', 'secret', '--insecure', cwd=plugins_path, env=dict(os.environ, PYTHONPATH=plugins_path),
+            stderr=asyncio.subprocess.PIPE)
+        try:
+            for _ in range(500):
+                if 7 in hub.inventories or process.returncode is not None:
+                    break
+                await asyncio.sleep(0.01)
+            assert 7 in hub.inventories, (await process.stderr.read()).decode() if process.returncode else ''
+        finally:
+            if process.returncode is None:
+                process.kill()
+            await process.wait()
+            agent_server.close()
+            control_server.close()
+
+    asyncio.run(scenario())
+
+
+@pytest.mark.parametrize('command', [
+    'rm -rf /',
+    'sudo rm -rf /',
+    'sudo ls /root',
+    'ls /root',
+    'ls /sys/bus/usb/../../../root',
+    'ls /sys/bus/usb/ /root',
+    'echo "unterminated',
+])
+def test_execute_rejects_commands(command):
+    daemon = AgentDaemon("127.0.0.1:1", host_id=7, token='secret', virtualhere_command='/opt/vhclient')
+    with pytest.raises(protocol.RPCError):
+        asyncio.run(daemon.execute(command))
+
+
+def test_execute_allows_driver_commands():
+    daemon = AgentDaemon("127.0.0.1:1", host_id=7, token='secret', virtualhere_command='/opt/vhclient')
+    assert daemon.command_allowed(['sudo', 'usbip', 'list', '-l'])
+    assert daemon.command_allowed(['ls', '-1', '/sys/bus/usb/drivers/usbip-host/'])
+    assert daemon.command_allowed(['/opt/vhclient', '-t', 'LIST'])
+    assert not daemon.command_allowed(['sudo', '/opt/vhclient', '-t', 'LIST'])
+
+
+@pytest.mark.django_db
+def test_authenticate_agent_closes_old_connections(monkeypatch):
+    close_old_connections = MagicMock()
+    monkeypatch.setattr(run_agent_hub, 'close_old_connections', close_old_connections)
+    host = RemoteHost.objects.create(address='agent.example.com', communicator='Agent', type='Linux_AMD64',
+                                     config_json='{"token": "secret"}')
+
+    assert run_agent_hub.authenticate_agent(host.pk, 'secret')
+    assert not run_agent_hub.authenticate_agent(host.pk, 'wrong')
+    assert not run_agent_hub.authenticate_agent(host.pk + 1, 'secret')
+    # Before and after every lookup, the hub's executor threads keep their connections between agents
+    assert close_old_connections.call_count == 6
@@ -1,27 +1,69 @@
 import binascii
+import codecs
 import logging
+import secrets
+import select
+import time
 from base64 import decodebytes
 from io import StringIO
+from typing import List, Tuple, Callable, Optional
 
 import paramiko
 from django.conf import settings
 from paramiko import HostKeys, ECDSAKey, PKey
 from paramiko.hostkeys import InvalidHostKey
 
-from USB_Quartermaster_common import CommunicatorError, AbstractCommunicator, CommandResponse
+from USB_Quartermaster_common import CommunicatorError, AbstractCommunicator, CommandResponse, CircuitBreaker
+from USB_Quartermaster_common.util import RevisionCache
+from .pool import connection_pool, PooledConnection
 
 logger = logging.getLogger(__name__)
 
+# Parsing key material is slow enough to show up when polling, keep the parsed keys until the host is edited
+key_cache = RevisionCache()
+
 
 class SSHError(CommunicatorError):
     pass
 
 
+class OutputBuffer(object):
+    """
+    Collects command output up to a limit, anything past it is counted and dropped so a runaway command can't
+    use up the server's memory.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.chunks = []
+        self.size = 0
+        self.dropped = 0
+
+    def append(self, data: bytes) -> None:
+        space = self.limit - self.size
+        if space < len(data):
+            self.dropped += len(data) - max(space, 0)
+            data = data[:max(space, 0)]
+        if data:
+            self.chunks.append(data)
+            self.size += len(data)
+
+    @property
+    def truncated(self) -> bool:
+        return self.dropped > 0
+
+    def text(self) -> str:
+        return b''.join(self.chunks).decode('UTF-8', errors='replace')
+
+
 class SSH(AbstractCommunicator):
     CONFIGURATION_KEYS = ("host_key", "host_key_type", "username", "private_key", "private_key_type")
     SUPPORTED_HOST_TYPES = ("Darwin", "Linux_AMD64", "Windows")
     IDENTIFIER = "SSH"
-    
+
+    # What a pooled connection dying under a command looks like, the connection is dropped and SSHError raised
+    CONNECTION_ERRORS = (paramiko.SSHException, EOFError, OSError)
+
     PRIVATE_KEY_FORMAT_MAPPINGS = {'DSS': paramiko.DSSKey.from_private_key,
                                    'RSA': paramiko.RSAKey.from_private_key,
                                    'ECDSA': paramiko.ECDSAKey.from_private_key,
@@ -38,22 +80,35 @@ class SSH(AbstractCommunicator):
     def __init__(self, host):
         super().__init__(host)
         self.username = self.config["username"]
+        self.breaker = CircuitBreaker(host,
+                                      failure_threshold=settings.HOST_FAILURE_THRESHOLD,
+                                      base_backoff=settings.HOST_RETRY_BACKOFF,
+                                      max_backoff=settings.HOST_RETRY_BACKOFF_MAX)
+        self.contact_freshness = settings.HOST_REACHABLE_FRESHNESS.total_seconds()
+        self.max_concurrent_commands = settings.HOST_MAX_CONCURRENT_COMMANDS
+        self.queue_timeout = settings.HOST_QUEUE_TIMEOUT.total_seconds()
 
     def get_host_key(self) -> PKey:
+        return key_cache.get(('host_key', self.host.pk), self.config_revision, self.load_host_key)
+
+    def load_host_key(self) -> PKey:
         # Decide what kind of key we're looking at and create an object
         # to hold it accordingly.
-        key_type = self.host.config['host_key_type']
+        key_type = self.config['host_key_type']
         if key_type not in self.HOST_KEY_FORMAT_MAPPINGS:
             raise SSHError(f"Unable to handle key of type {key_type}")
 
         try:
-            key = self.host.config['host_key'].encode('utf-8')
+            key = self.config['host_key'].encode('utf-8')
             host_key = self.HOST_KEY_FORMAT_MAPPINGS[key_type](data=decodebytes(key))
         except binascii.Error as e:
             raise InvalidHostKey(repr(self.host), e)
         return host_key
 
-    def get_private_key(self):
+    def get_private_key(self) -> PKey:
+        return key_cache.get(('private_key', self.host.pk), self.config_revision, self.load_private_key)
+
+    def load_private_key(self) -> PKey:
         # Decide what kind of key we're looking at and create an object
         # to hold it accordingly.
         key_type = self.config['private_key_type']
@@ -76,35 +131,214 @@ class SSH(AbstractCommunicator):
         client._host_keys = host_keys  # If you not a better way than accessing a private member I am all ears
         return client
 
-    def execute_command(self, command: str) -> CommandResponse:
+    def connect(self) -> paramiko.SSHClient:
+        # Fail fast rather than waiting out the connect timeout on a host known to be down
+        self.breaker.before_call()
         client = self.get_client()
         try:
             client.connect(self.host.address,
                            username=self.config["username"],
                            pkey=self.get_private_key(),
                            timeout=settings.SSH_CONNECT_TIMEOUT)
-            stdin, stdout, stderr = client.exec_command(command=command, timeout=settings.SSH_EXEC_TIMEOUT)
-            return_code = stdout.channel.recv_exit_status()
-            stdout_str = stdout.read().decode('UTF-8')
-            stderr_str = stderr.read().decode('UTF-8')
+        except Exception:
+            client.close()
+            self.forget_contact()
+            self.breaker.record_failure()
+            raise
+        self.breaker.record_success()
+        client.get_transport().set_keepalive(settings.SSH_KEEPALIVE_INTERVAL)
+        return client
+
+    @property
+    def pool_key(self):
+        # Including the revision means an edited host gets a new connection using its new keys
+        return self.host.pk, self.host.address, self.username, self.config_revision
+
+    def get_connection(self) -> PooledConnection:
+        return connection_pool.get(self.pool_key, self.connect, settings.SSH_POOL_IDLE_TIMEOUT)
+
+    def open_command(self, command: str) -> Tuple[PooledConnection, tuple]:
+        """Start command on a pooled connection, returns the connection used along with stdin, stdout and stderr"""
+        connection = self.get_connection()
+        try:
+            return connection, connection.client.exec_command(command=command, timeout=settings.SSH_EXEC_TIMEOUT)
+        except self.CONNECTION_ERRORS:
+            # The pooled transport died while idle. The command never started so it is safe to try once more
+            # on a fresh connection.
+            logger.info(f"Reconnecting to {self.username}@{self.host.address}, pooled connection was lost")
+            connection_pool.evict(self.pool_key, connection)
+        connection = self.get_connection()
+        try:
+            return connection, connection.client.exec_command(command=command, timeout=settings.SSH_EXEC_TIMEOUT)
+        except self.CONNECTION_ERRORS:
+            connection_pool.evict(self.pool_key, connection)
+            raise
+
+    def execute_command(self, command: str) -> CommandResponse:
+        return self.run_command(command)
+
+    def execute_command_streaming(self, command: str, on_stdout: Callable[[str], None]) -> CommandResponse:
+        return self.run_command(command, on_stdout=on_stdout)
+
+    def run_command(self, command: str, on_stdout: Optional[Callable[[str], None]] = None) -> CommandResponse:
+        connection = None
+        try:
+            # The slot is held from connecting until the output is read so bursts can't swamp the host's sshd
+            with self.gate.slot(self.queue_timeout):
+                connection, (stdin, stdout, stderr) = self.open_command(command)
+                return_code, stdout_str, stderr_str = self.read_channel(stdout.channel, command, on_stdout)
+            self.record_contact()
             if return_code != 0:
                 logger.info(
                     f"host={self.username}@{self.host.address} rc={return_code} command={command} stdout={stdout_str} stderr={stderr_str}")
-        except paramiko.SSHException as e:
+        except self.CONNECTION_ERRORS as e:
+            if connection is not None:
+                connection_pool.evict(self.pool_key, connection)
             logger.exception(f"Error: host={self.username}@{self.host.address}, command={command}")
             raise SSHError(
                 f"Ran into problems connecting to {self.username}@{self.host.address}: {e}")
-        finally:
-            client.close()
 
         return CommandResponse(return_code, stdout_str, stderr_str)
 
+    def make_output_sinks(self, on_stdout: Optional[Callable[[str], None]]) \
+            -> Tuple[OutputBuffer, OutputBuffer, Callable[[bytes], None], Callable[[], None]]:
+        """
+        Returns the stdout and stderr buffers, the function stdout data should be given to and one to call once
+        all output has been read. When streaming, stdout is decoded and handed on as it arrives and only the
+        start of it is kept for error messages.
+        """
+        stderr_buffer = OutputBuffer(settings.SSH_MAX_OUTPUT_BYTES)
+        if on_stdout is None:
+            stdout_buffer = OutputBuffer(settings.SSH_MAX_OUTPUT_BYTES)
+            return stdout_buffer, stderr_buffer, stdout_buffer.append, lambda: None
+
+        stdout_buffer = OutputBuffer(settings.SSH_STREAM_PREVIEW_BYTES)
+        decoder = codecs.getincrementaldecoder('UTF-8')(errors='replace')
+
+        def stdout_sink(data: bytes) -> None:
+            stdout_buffer.append(data)
+            on_stdout(decoder.decode(data))
+
+        def finish() -> None:
+            on_stdout(decoder.decode(b'', final=True))
+
+        return stdout_buffer, stderr_buffer, stdout_sink, finish
+
+    @staticmethod
+    def drain_channel(channel: paramiko.Channel,
+                      stdout_sink: Callable[[bytes], None],
+                      stderr_sink: Callable[[bytes], None],
+                      deadline: float) -> None:
+        # Both streams are emptied every pass so a command blocked writing to one can't stall the other. A command
+        # that never stops writing would keep us here, stop at the deadline (time.monotonic()) so the caller can
+        # time it out.
+        while (channel.recv_ready() or channel.recv_stderr_ready()) and time.monotonic() < deadline:
+            if channel.recv_ready():
+                stdout_sink(channel.recv(32768))
+            if channel.recv_stderr_ready():
+                stderr_sink(channel.recv_stderr(32768))
+
+    @staticmethod
+    def channel_finished(channel: paramiko.Channel) -> bool:
+        return channel.exit_status_ready() and (channel.eof_received or channel.closed) \
+               and not channel.recv_ready() and not channel.recv_stderr_ready()
+
+    def output_text(self, command: str, stdout_buffer: OutputBuffer, stderr_buffer: OutputBuffer,
+                    streaming: bool) -> Tuple[str, str]:
+        if (stdout_buffer.truncated and not streaming) or stderr_buffer.truncated:
+            logger.warning(f"Output truncated host={self.username}@{self.host.address} command={command} "
+                           f"stdout_dropped={stdout_buffer.dropped} stderr_dropped={stderr_buffer.dropped}")
+        return stdout_buffer.text(), stderr_buffer.text()
+
+    def read_channel(self, channel: paramiko.Channel, command: str,
+                     on_stdout: Optional[Callable[[str], None]] = None) -> Tuple[int, str, str]:
+        """
+        Read stdout and stderr as they arrive into bounded buffers, or hand stdout to on_stdout, until the command
+        exits. SSH_EXEC_TIMEOUT applies to the whole command rather than each read.
+        """
+        stdout_buffer, stderr_buffer, stdout_sink, finish = self.make_output_sinks(on_stdout)
+        deadline = time.monotonic() + settings.SSH_EXEC_TIMEOUT
+        try:
+            while True:
+                self.drain_channel(channel, stdout_sink, stderr_buffer.append, deadline)
+                if self.channel_finished(channel):
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise SSHError(f"Timed out waiting for command on {self.username}@{self.host.address}")
+                # The exit status isn't signalled through the channel's file descriptor so check back periodically
+                select.select([channel], [], [], min(remaining, 0.5))
+            finish()
+        finally:
+            channel.close()
+
+        stdout_str, stderr_str = self.output_text(command, stdout_buffer, stderr_buffer,
+                                                  streaming=on_stdout is not None)
+        return channel.recv_exit_status(), stdout_str, stderr_str
+
+    def execute_commands(self, commands: List[str]) -> List[CommandResponse]:
+        # Windows hosts don't have a POSIX shell to run the batch script in
+        if len(commands) < 2 or self.host.type == "Windows":
+            return super().execute_commands(commands)
+
+        boundary = f"QUARTERMASTER-{secrets.token_hex(8)}"
+        response = self.execute_command(self.batch_script(commands, boundary))
+        try:
+            stdouts = self.split_batch_output(response.stdout, boundary, len(commands))
+            stderrs = self.split_batch_output(response.stderr, boundary, len(commands))
+        except ValueError as e:
+            raise SSHError(f"Could not parse batch output from {self.username}@{self.host.address}, "
+                           f"rc={response.return_code} stdout={response.stdout} stderr={response.stderr}: {e}")
+
+        responses = []
+        for command, (stdout_str, return_code), (stderr_str, _) in zip(commands, stdouts, stderrs):
+            return_code = int(return_code)
+            if return_code != 0:
+                logger.info(
+                    f"host={self.username}@{self.host.address} rc={return_code} command={command} stdout={stdout_str} stderr={stderr_str}")
+            responses.append(CommandResponse(return_code, stdout_str, stderr_str))
+        return responses
+
+    @staticmethod
+    def batch_script(commands: List[str], boundary: str) -> str:
+        """
+        Build a shell script running each command in its own subshell. After each command a marker line holding the
+        boundary, the command index and, on stdout, the return code is written to stdout and stderr so the output
+        can be split up again.
+        """
+        script = []
+        for index, command in enumerate(commands):
+            script.append(f"(\n{command}\n)\n"
+                          f"printf '\\n%s %d %d\\n' '{boundary}' {index} $?\n"
+                          f"printf '\\n%s %d \\n' '{boundary}' {index} >&2\n")
+        return "".join(script)
+
+    @staticmethod
+    def split_batch_output(output: str, boundary: str, count: int) -> List[Tuple[str, str]]:
+        """Returns the output and marker value, the return code on stdout, of each command in a batch"""
+        results = []
+        position = 0
+        for index in range(count):
+            marker = f"\n{boundary} {index} "
+            marker_start = output.find(marker, position)
+            if marker_start == -1:
+                raise ValueError(f"Missing output marker for command {index}")
+            marker_end = output.find("\n", marker_start + len(marker))
+            if marker_end == -1:
+                raise ValueError(f"Truncated output marker for command {index}")
+            results.append((output[position:marker_start], output[marker_start + len(marker):marker_end]))
+            position = marker_end + 1
+        return results
+
+    @property
+    def reachability_command(self) -> str:
+        if self.host.type == "Windows":
+            return 'date /t'
+        return 'true'
+
     def is_host_reachable(self) -> bool:
         try:
-            if self.host.type == "Windows":
-                response = self.execute_command('date /t')
-            else:
-                response = self.execute_command('true')
+            response = self.execute_command(self.reachability_command)
         except Exception:
             return False
         return True
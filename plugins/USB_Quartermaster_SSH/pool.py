@@ -0,0 +1,115 @@
+import logging
+import threading
+import time
+from typing import Dict, Hashable, Callable, Optional
+
+import paramiko
+
+logger = logging.getLogger(__name__)
+
+
+class PooledConnection(object):
+    def __init__(self, client: paramiko.SSHClient):
+        self.client = client
+        self.last_used = time.monotonic()
+
+    @property
+    def transport(self) -> Optional[paramiko.Transport]:
+        return self.client.get_transport()
+
+    def is_usable(self, idle_timeout: float) -> bool:
+        transport = self.transport
+        if transport is None or not transport.is_active():
+            return False
+        return time.monotonic() - self.last_used < idle_timeout
+
+    def close(self) -> None:
+        try:
+            self.client.close()
+        except Exception:
+            logger.exception("Error closing pooled SSH connection")
+
+
+class SSHConnectionPool(object):
+    """
+    Keeps an authenticated transport per remote host open so running a command only costs opening a new channel
+    rather than a full TCP, key exchange and authentication handshake.
+
+    paramiko transports multiplex channels and are thread safe so huey's thread workers share the same connection.
+    Connections that are idle too long or whose transport has died are closed and replaced on the next request.
+    """
+
+    # How often, at most, we look through the whole pool for idle connections to close
+    SWEEP_INTERVAL = 30.0
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._connections: Dict[Hashable, PooledConnection] = {}
+        # Only kept while some thread is getting a connection for the key, keys change with every host edit
+        self._connect_locks: Dict[Hashable, threading.Lock] = {}
+        self._connect_waiters: Dict[Hashable, int] = {}
+        self._last_sweep = time.monotonic()
+
+    def get(self, key: Hashable, connect: Callable[[], paramiko.SSHClient], idle_timeout: float) -> PooledConnection:
+        self.evict_idle(idle_timeout)
+        with self._lock:
+            connect_lock = self._connect_locks.setdefault(key, threading.Lock())
+            self._connect_waiters[key] = self._connect_waiters.get(key, 0) + 1
+
+        try:
+            # Only one thread per host does the handshake, any others waiting reuse the result
+            with connect_lock:
+                with self._lock:
+                    connection = self._connections.get(key)
+                if connection is not None and not connection.is_usable(idle_timeout):
+                    logger.debug(f"Replacing stale SSH connection key={key}")
+                    self.evict(key, connection)
+                    connection = None
+                if connection is None:
+                    connection = PooledConnection(connect())
+                    with self._lock:
+                        self._connections[key] = connection
+        finally:
+            with self._lock:
+                self._connect_waiters[key] -= 1
+                if not self._connect_waiters[key]:
+                    del self._connect_waiters[key]
+                    del self._connect_locks[key]
+
+        connection.last_used = time.monotonic()
+        return connection
+
+    def evict(self, key: Hashable, connection: PooledConnection) -> None:
+        """Close a connection that failed, it is only removed from the pool if it is still the pooled one for key.
+        This keeps a thread holding an old connection from closing the replacement another thread already made."""
+        with self._lock:
+            if self._connections.get(key) is connection:
+                del self._connections[key]
+        connection.close()
+
+    def evict_idle(self, idle_timeout: float, force: bool = False) -> None:
+        now = time.monotonic()
+        with self._lock:
+            if not force and now - self._last_sweep < self.SWEEP_INTERVAL:
+                return
+            self._last_sweep = now
+            stale = [(key, connection) for key, connection in self._connections.items()
+                     if not connection.is_usable(idle_timeout)]
+            for key, _ in stale:
+                del self._connections[key]
+        for key, connection in stale:
+            logger.debug(f"Closing idle SSH connection key={key}")
+            connection.close()
+
+    def close_all(self) -> None:
+        with self._lock:
+            connections = list(self._connections.values())
+            self._connections.clear()
+        for connection in connections:
+            connection.close()
+
+    def __len__(self):
+        return len(self._connections)
+
+
+connection_pool = SSHConnectionPool()
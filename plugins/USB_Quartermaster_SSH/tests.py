@@ -1,3 +1,379 @@
 from django.test import TestCase
 
 # Create your tests here.
+import threading
+import time
+from datetime import timedelta
+from unittest.mock import MagicMock
+
+import paramiko
+import pytest
+
+from USB_Quartermaster_SSH import communicator
+from USB_Quartermaster_SSH.communicator import SSH, SSHError, OutputBuffer
+from USB_Quartermaster_SSH.pool import SSHConnectionPool
+from USB_Quartermaster_common import CircuitBreaker, HostHealth, HostUnavailable, HostBusy
+from USB_Quartermaster_common.gate import HostGate
+from USB_Quartermaster_common.util import RevisionCache, config_revision, ContactTracker
+from data.models import RemoteHost
+
+
+def make_client(active: bool = True) -> MagicMock:
+    client = MagicMock()
+    client.get_transport.return_value.is_active.return_value = active
+    client.exec_command.return_value = (MagicMock(), MagicMock(), MagicMock())
+    return client
+
+
+@pytest.fixture()
+def pool() -> SSHConnectionPool:
+    return SSHConnectionPool()
+
+
+def test_pool_reuses_connection(pool):
+    connect = MagicMock(side_effect=lambda: make_client())
+    first = pool.get('host', connect, idle_timeout=60)
+    second = pool.get('host', connect, idle_timeout=60)
+    assert first is second
+    assert 1 == connect.call_count
+
+
+def test_pool_separates_hosts(pool):
+    connect = MagicMock(side_effect=lambda: make_client())
+    pool.get('host1', connect, idle_timeout=60)
+    pool.get('host2', connect, idle_timeout=60)
+    assert 2 == connect.call_count
+    assert 2 == len(pool)
+
+
+def test_pool_replaces_dead_transport(pool):
+    dead_client = make_client(active=False)
+    connect = MagicMock(side_effect=[dead_client, make_client()])
+    first = pool.get('host', connect, idle_timeout=60)
+    second = pool.get('host', connect, idle_timeout=60)
+    assert first is not second
+    assert 1 == dead_client.close.call_count
+
+
+def test_pool_replaces_idle_connection(pool):
+    connect = MagicMock(side_effect=lambda: make_client())
+    first = pool.get('host', connect, idle_timeout=60)
+    first.last_used -= 120
+    second = pool.get('host', connect, idle_timeout=60)
+    assert first is not second
+    assert 1 == first.client.close.call_count
+
+
+def test_pool_evict_only_current(pool):
+    connect = MagicMock(side_effect=lambda: make_client())
+    first = pool.get('host', connect, idle_timeout=60)
+    pool.evict('host', first)
+    second = pool.get('host', connect, idle_timeout=60)
+    # Evicting an already replaced connection must not close its replacement
+    pool.evict('host', first)
+    assert 0 == second.client.close.call_count
+    assert 1 == len(pool)
+
+
+@pytest.fixture()
+def ssh(sample_remote_host, pool, monkeypatch) -> SSH:
+    """An SSH communicator with its own connection pool, connecting hands back a mock client"""
+    monkeypatch.setattr(communicator, 'connection_pool', pool)
+    ssh = SSH(sample_remote_host)
+    monkeypatch.setattr(ssh, 'connect', lambda: make_client())
+    return ssh
+
+
+@pytest.mark.django_db
+def test_failed_command_keeps_replacement_connection(ssh, pool, monkeypatch):
+    first = ssh.get_connection()
+    replacements = []
+
+    def read_channel(channel, command, on_stdout):
+        # Another thread found the connection broken and replaced it while this command was still reading
+        pool.evict(ssh.pool_key, first)
+        replacements.append(ssh.get_connection())
+        raise paramiko.SSHException("Connection lost")
+
+    monkeypatch.setattr(ssh, 'read_channel', read_channel)
+    with pytest.raises(SSHError):
+        ssh.execute_command('true')
+    assert replacements[0] is ssh.get_connection()
+    assert 0 == replacements[0].client.close.call_count
+    assert 1 <= first.client.close.call_count
+
+
+@pytest.mark.django_db
+def test_reconnect_failure_raises_ssh_error(ssh, pool, monkeypatch):
+    first = ssh.get_connection()
+    first.client.exec_command.side_effect = EOFError()
+    fresh = make_client()
+    fresh.exec_command.side_effect = OSError("Connection reset by peer")
+    monkeypatch.setattr(ssh, 'connect', lambda: fresh)
+
+    with pytest.raises(SSHError):
+        ssh.execute_command('true')
+    # Neither broken connection is left for the next command
+    assert 0 == len(pool)
+    assert 1 <= first.client.close.call_count
+    assert 1 <= fresh.close.call_count
+
+
+def test_pool_forgets_connect_locks(pool):
+    connect = MagicMock(side_effect=lambda: make_client())
+    # Keys include the config revision, every edit of a host makes a new one
+    for revision in range(5):
+        connection = pool.get(('host', revision), connect, idle_timeout=60)
+        pool.evict(('host', revision), connection)
+    failing = MagicMock(side_effect=OSError("Connection refused"))
+    with pytest.raises(OSError):
+        pool.get('down', failing, idle_timeout=60)
+    assert {} == pool._connect_locks
+
+
+def test_pool_connects_once_for_waiting_threads(pool):
+    connecting = threading.Event()
+    release = threading.Event()
+
+    def connect():
+        connecting.set()
+        release.wait(5)
+        return make_client()
+
+    connect = MagicMock(side_effect=connect)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(pool.get('host', connect, idle_timeout=60)))
+               for _ in range(4)]
+    threads[0].start()
+    connecting.wait(5)
+    for thread in threads[1:]:
+        thread.start()
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert 1 == connect.call_count
+    assert all(result is results[0] for result in results)
+    assert {} == pool._connect_locks
+
+
+def test_pool_evict_idle(pool):
+    connect = MagicMock(side_effect=lambda: make_client())
+    connection = pool.get('host', connect, idle_timeout=60)
+    connection.last_used -= 120
+    pool.evict_idle(idle_timeout=60, force=True)
+    assert 0 == len(pool)
+    assert 1 == connection.client.close.call_count
+
+
+def test_revision_cache_reuses_value():
+    cache = RevisionCache()
+    factory = MagicMock(side_effect=lambda: object())
+    revision = config_revision('{"username": "test_user"}')
+    assert cache.get(1, revision, factory) is cache.get(1, revision, factory)
+    assert 1 == factory.call_count
+
+
+def test_revision_cache_rebuilds_on_edit():
+    cache = RevisionCache()
+    factory = MagicMock(side_effect=lambda: object())
+    first = cache.get(1, config_revision('{"username": "test_user"}'), factory)
+    second = cache.get(1, config_revision('{"username": "other_user"}'), factory)
+    assert first is not second
+    assert 2 == factory.call_count
+
+
+def test_split_batch_output():
+    boundary = 'QUARTERMASTER-test'
+    stdout = f"hello\n\n{boundary} 0 0\nno newline\n{boundary} 1 3\n\n{boundary} 2 0\n"
+    assert [('hello\n', '0'), ('no newline', '3'), ('', '0')] == SSH.split_batch_output(stdout, boundary, 3)
+
+
+def test_split_batch_output_missing_marker():
+    boundary = 'QUARTERMASTER-test'
+    with pytest.raises(ValueError):
+        SSH.split_batch_output(f"hello\n\n{boundary} 0 0\n", boundary, 2)
+
+
+def test_batch_script_marks_every_command():
+    script = SSH.batch_script(['usbip list -l', 'ls -1 /tmp'], 'QUARTERMASTER-test')
+    assert 'usbip list -l' in script
+    assert 2 == script.count("'QUARTERMASTER-test' 1")
+
+
+@pytest.mark.django_db
+def test_breaker_opens_after_threshold(sample_remote_host):
+    breaker = CircuitBreaker(sample_remote_host, failure_threshold=2)
+    breaker.record_failure()
+    assert HostHealth.CLOSED == sample_remote_host.health_state
+    breaker.record_failure()
+    sample_remote_host.refresh_from_db()
+    assert HostHealth.OPEN == sample_remote_host.health_state
+    assert not sample_remote_host.is_available
+    with pytest.raises(HostUnavailable):
+        CircuitBreaker(sample_remote_host, failure_threshold=2).before_call()
+
+
+@pytest.mark.django_db
+def test_breaker_probes_after_backoff(sample_remote_host):
+    breaker = CircuitBreaker(sample_remote_host, failure_threshold=1)
+    breaker.record_failure()
+    breaker.update(health_retry_at=sample_remote_host.health_retry_at - timedelta(hours=1))
+    breaker.before_call()
+    assert HostHealth.HALF_OPEN == sample_remote_host.health_state
+    breaker.record_success()
+    sample_remote_host.refresh_from_db()
+    assert HostHealth.CLOSED == sample_remote_host.health_state
+    assert 0 == sample_remote_host.health_failures
+
+
+@pytest.mark.django_db
+def test_breaker_failed_probe_backs_off_further(sample_remote_host):
+    breaker = CircuitBreaker(sample_remote_host, failure_threshold=1, base_backoff=timedelta(seconds=30))
+    breaker.record_failure()
+    first_backoff = sample_remote_host.health_retry_at - breaker.now()
+    breaker.update(health_retry_at=sample_remote_host.health_retry_at - timedelta(hours=1))
+    breaker.before_call()
+    breaker.record_failure()
+    assert HostHealth.OPEN == sample_remote_host.health_state
+    assert sample_remote_host.health_retry_at - breaker.now() > first_backoff
+
+
+@pytest.mark.django_db
+def test_breaker_single_probe(sample_remote_host):
+    breaker = CircuitBreaker(sample_remote_host, failure_threshold=1)
+    breaker.record_failure()
+    breaker.update(health_retry_at=sample_remote_host.health_retry_at - timedelta(hours=1))
+    # Every caller saw the retry time pass, only the first gets to probe
+    breakers = [CircuitBreaker(RemoteHost.objects.get(pk=sample_remote_host.pk)) for _ in range(3)]
+    breakers[0].before_call()
+    for breaker in breakers[1:]:
+        with pytest.raises(HostUnavailable):
+            breaker.before_call()
+    # The winner carries on with its probe
+    breakers[0].before_call()
+    breakers[0].record_success()
+    breakers[1].host.refresh_from_db()
+    breakers[1].before_call()
+
+
+def test_contact_tracker_freshness():
+    tracker = ContactTracker()
+    assert not tracker.is_fresh('host', window=60)
+    tracker.record('host')
+    assert tracker.is_fresh('host', window=60)
+    assert not tracker.is_fresh('host', window=0)
+    tracker.forget('host')
+    assert not tracker.is_fresh('host', window=60)
+
+
+def test_output_buffer_is_bounded():
+    buffer = OutputBuffer(limit=8)
+    buffer.append(b'12345')
+    buffer.append(b'67890')
+    buffer.append(b'abc')
+    assert '12345678' == buffer.text()
+    assert buffer.truncated
+    assert 5 == buffer.dropped
+
+
+def test_drain_channel_reads_both_streams():
+    stdout_chunks = [b'out1', b'out2']
+    stderr_chunks = [b'err1']
+    channel = MagicMock()
+    channel.recv_ready.side_effect = lambda: bool(stdout_chunks)
+    channel.recv_stderr_ready.side_effect = lambda: bool(stderr_chunks)
+    channel.recv.side_effect = lambda _: stdout_chunks.pop(0)
+    channel.recv_stderr.side_effect = lambda _: stderr_chunks.pop(0)
+    stdout, stderr = OutputBuffer(limit=100), OutputBuffer(limit=100)
+    SSH.drain_channel(channel, stdout.append, stderr.append, deadline=time.monotonic() + 60)
+    assert 'out1out2' == stdout.text()
+    assert 'err1' == stderr.text()
+
+
+def endless_channel() -> MagicMock:
+    channel = MagicMock()
+    channel.recv_ready.return_value = True
+    channel.recv_stderr_ready.return_value = False
+    channel.recv.return_value = b'y\n'
+    return channel
+
+
+def test_drain_channel_stops_at_deadline():
+    channel = endless_channel()
+    stdout = OutputBuffer(limit=100)
+    SSH.drain_channel(channel, stdout.append, MagicMock(), deadline=time.monotonic() - 1)
+    assert 0 == channel.recv.call_count
+
+
+@pytest.mark.django_db
+def test_read_channel_times_out_on_endless_output(ssh, settings):
+    settings.SSH_EXEC_TIMEOUT = 0.05
+    channel = endless_channel()
+    with pytest.raises(SSHError):
+        ssh.read_channel(channel, 'yes')
+    assert 1 == channel.close.call_count
+
+
+def test_gate_limits_concurrency():
+    gate = HostGate('host', limit=2)
+    running = []
+    peak = []
+    lock = threading.Lock()
+
+    def work():
+        with gate.slot(timeout=5):
+            with lock:
+                running.append(1)
+                peak.append(len(running))
+            time.sleep(0.02)
+            with lock:
+                running.pop()
+
+    threads = [threading.Thread(target=work) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert max(peak) == 2
+    stats = gate.stats()
+    assert stats['acquired'] == 8
+    assert stats['active'] == 0
+    assert stats['waiting'] == 0
+    assert stats['max_wait'] > 0
+
+
+def test_gate_is_first_in_first_out():
+    gate = HostGate('host', limit=1)
+    gate.acquire()
+    order = []
+
+    def work(name):
+        with gate.slot(timeout=5):
+            order.append(name)
+
+    threads = []
+    for name in range(5):
+        thread = threading.Thread(target=work, args=(name,))
+        thread.start()
+        threads.append(thread)
+        # Make sure each thread is queued before the next one arrives
+        while gate.waiting < name + 1:
+            time.sleep(0.001)
+    gate.release()
+    for thread in threads:
+        thread.join()
+
+    assert order == [0, 1, 2, 3, 4]
+
+
+def test_gate_times_out():
+    gate = HostGate('host', limit=1)
+    gate.acquire()
+    with pytest.raises(HostBusy):
+        gate.acquire(timeout=0.01)
+    assert gate.stats()['timeouts'] == 1
+    assert gate.waiting == 0
+    gate.release()
+    assert gate.acquire(timeout=0.01) >= 0
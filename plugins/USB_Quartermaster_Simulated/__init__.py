@@ -0,0 +1,3 @@
+# The communicator is deliberately not exported here so plugin discovery doesn't offer it for real hosts.
+# Use SimulatedFleet.communicator() to get one.
+from .fleet import SimulatedFleet, SimulatedHost, SimulatedDevice
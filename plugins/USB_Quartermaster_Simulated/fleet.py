@@ -0,0 +1,188 @@
+import random
+import re
+import threading
+import time
+from typing import Dict, List, Optional
+from xml.etree import ElementTree
+
+from USB_Quartermaster_common import AbstractCommunicator, CommunicatorError, CommandResponse
+
+
+class SimulatedConnectionError(CommunicatorError):
+    pass
+
+
+class SimulatedDevice(object):
+    def __init__(self, bus_id: str, vh_address: str, id_vendor: str, id_product: str, vendor: str, product: str):
+        self.bus_id = bus_id
+        self.vh_address = vh_address
+        self.id_vendor = id_vendor
+        self.id_product = id_product
+        self.vendor = vendor
+        self.product = product
+        self.nickname = product
+        self.shared = False  # usbip bound to usbip-host, or VirtualHere device in use by a client
+
+
+class SimulatedHost(object):
+    VH_HUB_NAME = 'localhub'
+
+    def __init__(self, address: str, devices: List[SimulatedDevice]):
+        self.address = address
+        self.devices: Dict[str, SimulatedDevice] = {device.bus_id: device for device in devices}
+        self.reachable = True
+        self.lock = threading.Lock()
+
+    def device_by_vh_address(self, address: str) -> Optional[SimulatedDevice]:
+        for device in self.devices.values():
+            if f"{self.VH_HUB_NAME}.{device.vh_address}" == address:
+                return device
+        return None
+
+    def usbip_list(self) -> str:
+        lines = []
+        for device in self.devices.values():
+            ids = f"({device.id_vendor}:{device.id_product})"
+            lines.append(f" - busid {device.bus_id} {ids}\n"
+                         f"   {device.vendor} : {device.product} {ids}\n"
+                         f"\n")
+        return "".join(lines)
+
+    def usbip_host_listing(self) -> str:
+        shared = [device.bus_id for device in self.devices.values() if device.shared]
+        return "\n".join(sorted(shared) + ['bind', 'match_busid', 'module', 'new_id', 'rebind', 'remove_id',
+                                           'uevent', 'unbind']) + "\n"
+
+    def vh_client_state(self) -> str:
+        state = ElementTree.Element('state')
+        server = ElementTree.SubElement(state, 'server', name=self.VH_HUB_NAME)
+        ElementTree.SubElement(server, 'connection', id='1', ip='127.0.0.1', hostname=self.VH_HUB_NAME, port='7575',
+                               connectionId='1', state='3', serverSerial='00000000', license_max_devices='0')
+        for device in self.devices.values():
+            ElementTree.SubElement(server, 'device', address=device.vh_address, idVendor=device.id_vendor,
+                                   idProduct=device.id_product, vendor=device.vendor, product=device.product,
+                                   nickname=device.nickname, state='3' if device.shared else '1',
+                                   connectionId='1', boundConnectionId='0', boundClientHostname='')
+        return '<?xml version="1.0" encoding="utf-8"?>\n' + ElementTree.tostring(state, encoding='unicode')
+
+
+class SimulatedFleet(object):
+    """
+    Pretends to be N remote hosts with M USB devices each so the server's polling and reservation code can be
+    measured without real hardware. Commands get the same output usbip and the VirtualHere client would give,
+    after a configurable latency and jitter, and fail at a configurable rate.
+
+    Every call to the communicator counts as one round trip, a batch of commands included.
+    """
+
+    VH_COMMAND_MATCHER = re.compile(r'-t "(?P<command>[^"]*)"')
+    VENDORS = (('0403', '6015', 'Future Technology Devices International, Ltd', 'Bridge(I2C/SPI/UART/FIFO)'),
+               ('05c6', '901d', 'Qualcomm, Inc.', 'unknown product'),
+               ('1c4f', '0002', 'SiGma Micro', 'Keyboard TRACER Gamma Ivory'))
+
+    def __init__(self, hosts: int = 10, devices_per_host: int = 8, latency: float = 0.0, jitter: float = 0.0,
+                 failure_rate: float = 0.0, seed: int = 0):
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.round_trips = 0
+        self.commands = 0
+        self.hosts: Dict[str, SimulatedHost] = {}
+        for host_index in range(hosts):
+            devices = []
+            for device_index in range(devices_per_host):
+                id_vendor, id_product, vendor, product = self.VENDORS[device_index % len(self.VENDORS)]
+                devices.append(SimulatedDevice(bus_id=f"1-{device_index + 1}",
+                                               vh_address=str(1100 + device_index + 1),
+                                               id_vendor=id_vendor, id_product=id_product,
+                                               vendor=vendor, product=product))
+            address = f"host{host_index}.simulated.example.com"
+            self.hosts[address] = SimulatedHost(address, devices)
+
+    def communicator(self, host: 'RemoteHost') -> 'SimulatedCommunicator':
+        return SimulatedCommunicator(host, fleet=self)
+
+    def reset_counters(self) -> None:
+        with self.lock:
+            self.round_trips = 0
+            self.commands = 0
+
+    def exchange(self, address: str, commands: List[str]) -> List[CommandResponse]:
+        with self.lock:
+            self.round_trips += 1
+            self.commands += len(commands)
+            failed = self.random.random() < self.failure_rate
+            delay = self.latency + self.random.uniform(0, self.jitter)
+        if delay:
+            time.sleep(delay)
+
+        host = self.hosts.get(address)
+        if host is None or not host.reachable or failed:
+            raise SimulatedConnectionError(f"Could not connect to {address}")
+        with host.lock:
+            return [self.run(host, command) for command in commands]
+
+    def run(self, host: SimulatedHost, command: str) -> CommandResponse:
+        if command in ('true', 'date /t'):
+            return CommandResponse(0, '', '')
+        if command == 'usbip list -l':
+            return CommandResponse(0, host.usbip_list(), '')
+        if command.startswith('ls -1 ') and 'usbip-host' in command:
+            return CommandResponse(0, host.usbip_host_listing(), '')
+        if command.startswith('sudo usbip bind -b ') or command.startswith('sudo usbip unbind -b '):
+            bus_id = command.split(' ')[-1]
+            device = host.devices.get(bus_id)
+            if device is None:
+                return CommandResponse(1, '', "usbip: error: device with the specified bus ID does not exist\n")
+            device.shared = ' bind ' in command
+            action = 'bind' if device.shared else 'unbind'
+            return CommandResponse(0, f"usbip: info: {action} device on busid {bus_id}: complete\n", '')
+
+        match = self.VH_COMMAND_MATCHER.search(command)
+        if match:
+            return self.run_virtualhere(host, match['command'])
+        return CommandResponse(127, '', f"sh: 1: {command.split(' ')[0]}: not found\n")
+
+    def run_virtualhere(self, host: SimulatedHost, command: str) -> CommandResponse:
+        if command == 'GET CLIENT STATE':
+            return CommandResponse(0, host.vh_client_state(), '')
+        if command.startswith('MANUAL HUB ADD,'):
+            return CommandResponse(0, 'OK\n', '')
+        if command.startswith('STOP USING,') or command.startswith('DEVICE RENAME,'):
+            arguments = command.split(',')
+            device = host.device_by_vh_address(arguments[1])
+            if device is None:
+                return CommandResponse(0, 'FAILED\n', '')
+            if command.startswith('STOP USING,'):
+                device.shared = False
+            else:
+                device.nickname = arguments[2]
+            return CommandResponse(0, 'OK\n', '')
+        return CommandResponse(0, 'FAILED\n', '')
+
+
+class SimulatedCommunicator(AbstractCommunicator):
+    CONFIGURATION_KEYS = ()
+    SUPPORTED_HOST_TYPES = ("Darwin", "Linux_AMD64", "Windows")
+    IDENTIFIER = "Simulated"
+
+    def __init__(self, host: 'RemoteHost', fleet: SimulatedFleet):
+        super().__init__(host)
+        self.fleet = fleet
+
+    def execute_command(self, command: str) -> CommandResponse:
+        return self.execute_commands([command])[0]
+
+    def execute_commands(self, commands: List[str]) -> List[CommandResponse]:
+        responses = self.fleet.exchange(self.host.address, commands)
+        self.record_contact()
+        return responses
+
+    def is_host_reachable(self) -> bool:
+        try:
+            self.execute_command('true')
+        except CommunicatorError:
+            return False
+        return True
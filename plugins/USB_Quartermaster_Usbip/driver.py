@@ -2,13 +2,13 @@ import asyncio
 import logging
 import platform
 import shutil
-from typing import Dict, NamedTuple, Set, Optional, Iterable, List
+from typing import Dict, NamedTuple, Set, Optional, Iterable, List, Tuple
 
 import paramiko
 from django.conf import settings
 
 from USB_Quartermaster_common import AbstractRemoteHostDriver, AbstractShareableDeviceDriver, AbstractLocalDriver, \
-    CommandResponse
+    CommandResponse, DeviceTransition, HostSnapshot
 
 logger = logging.getLogger(__name__)
 
@@ -21,7 +21,7 @@ class DeviceDetails(NamedTuple):
     product: str
 
 class DriverMetaData(object):
-    SUPPORTED_COMMUNICATORS = ('SSH',)
+    SUPPORTED_COMMUNICATORS = ('SSH', 'Agent')
     SUPPORTED_HOST_TYPES = ('Linux_AMD64',)
     IDENTIFIER = "USBIP"
 
@@ -30,18 +30,29 @@ class UsbipOverSSHHost(AbstractRemoteHostDriver, DriverMetaData):
     USBIPD_NOT_RUNNING = 'error: could not connect to localhost:3240'
     MISSING_KERNEL_MODULE = 'error: unable to bind device on '
     USBIP_DRIVER_PATH = '/sys/bus/usb/plugins/usbip-host'
-
-
+    LIST_COMMAND = "usbip list -l"
+    SHARED_COMMAND = f"ls -1 {USBIP_DRIVER_PATH}/"
 
     def __init__(self, host: 'RemoteHost'):
         super().__init__(host=host)
 
-    def execute_command(self, command: str):
+    def execute_command(self, command: str) -> CommandResponse:
         try:
             response = self.communicator.execute_command(command=command)
         except paramiko.SSHException as e:
             raise self.HostConnectionError(
                 f"Ran into problems connecting to {settings.SSH_USERNAME}@{self.host.address}: {e}")
+        return self.check_response(command, response)
+
+    def execute_commands(self, commands: List[str]) -> List[CommandResponse]:
+        try:
+            responses = self.communicator.execute_commands(commands)
+        except paramiko.SSHException as e:
+            raise self.HostConnectionError(
+                f"Ran into problems connecting to {settings.SSH_USERNAME}@{self.host.address}: {e}")
+        return [self.check_response(command, response) for command, response in zip(commands, responses)]
+
+    def check_response(self, command: str, response: CommandResponse) -> CommandResponse:
         if response.return_code != 0:
             if self.USBIPD_NOT_RUNNING in response.stderr:
                 message = f"usbipd is not running on {self.host}"
@@ -58,7 +69,31 @@ class UsbipOverSSHHost(AbstractRemoteHostDriver, DriverMetaData):
             raise self.HostCommandError(message)
         return response
 
+    def get_inventory(self) -> Optional[dict]:
+        """usbip section of the communicator's structured inventory, if it has one"""
+        inventory = self.communicator.get_inventory()
+        if inventory is None:
+            return None
+        return inventory.get('usbip')
+
+    @staticmethod
+    def inventory_devices(inventory: dict) -> Dict[str, DeviceDetails]:
+        return {device['bus_id']: DeviceDetails(bus_id=device['bus_id'],
+                                                idVendor=device['id_vendor'],
+                                                idProduct=device['id_product'],
+                                                vendor=device['vendor'],
+                                                product=device['product'])
+                for device in inventory['devices']}
+
     def get_device_list(self) -> Dict[str, DeviceDetails]:
+        inventory = self.get_inventory()
+        if inventory is not None:
+            return self.inventory_devices(inventory)
+        response = self.execute_command(self.LIST_COMMAND)
+        return self.parse_device_list(response.stdout)
+
+    @staticmethod
+    def parse_device_list(output: str) -> Dict[str, DeviceDetails]:
         """
         This process output that look like this or else blank if there are no devices
 
@@ -70,10 +105,7 @@ class UsbipOverSSHHost(AbstractRemoteHostDriver, DriverMetaData):
 
         :return: Dict containing all the IDs and there string
         """
-
-        command = "usbip list -l"
-        response = self.execute_command(command)
-        device_lines = response.stdout.split(" - ")
+        device_lines = output.split(" - ")
         devices = {}
         for line in device_lines[1:]:  # We skip the first line since it is always empty due to the leading separator
             bus_id = line.split(' ')[1]
@@ -88,21 +120,42 @@ class UsbipOverSSHHost(AbstractRemoteHostDriver, DriverMetaData):
         return devices
 
     def get_shared_bus_ids(self) -> Set[str]:
-        command = "ls -1 /sys/bus/usb/plugins/usbip-host/"
-        response = self.execute_command(command)
+        inventory = self.get_inventory()
+        if inventory is not None:
+            return set(inventory['shared'])
+        response = self.execute_command(self.SHARED_COMMAND)
+        return self.parse_shared_bus_ids(response.stdout)
+
+    @staticmethod
+    def parse_shared_bus_ids(output: str) -> Set[str]:
         shared = set()
         # Look for bus_ids
-        for line in response.stdout.splitlines(keepends=False):
+        for line in output.splitlines(keepends=False):
             if line[0].isdigit():
                 shared.add(line)
         return shared
 
-    def update_device_states(self, devices: Iterable['Device']):
-        shared = self.get_shared_bus_ids()
-        remote_devices = self.get_device_list()
+    def get_host_state(self) -> Tuple[Set[str], Dict[str, DeviceDetails]]:
+        """Shared bus ids and the devices on the host"""
+        inventory = self.get_inventory()
+        if inventory is not None:
+            return set(inventory['shared']), self.inventory_devices(inventory)
+        # Both listings are fetched in a single exchange with the host
+        shared_response, list_response = self.execute_commands([self.SHARED_COMMAND, self.LIST_COMMAND])
+        return self.parse_shared_bus_ids(shared_response.stdout), self.parse_device_list(list_response.stdout)
+
+    def take_snapshot(self) -> HostSnapshot:
+        shared, remote_devices = self.get_host_state()
+        return HostSnapshot(online=remote_devices.keys(), shared=shared, details=remote_devices)
+
+    def update_device_states(self, devices: Iterable['Device']) -> List[DeviceTransition]:
+        # The snapshot the poll took, the share()/unshare() corrections below decide from it without asking the host
+        # again
+        snapshot = self.get_snapshot()
+        transitions = []
         for device in devices:
-            actual_shared = device.config['bus_id'] in shared
-            actual_online = device.config['bus_id'] in remote_devices
+            actual_shared = snapshot.is_shared(device.config['bus_id'])
+            actual_online = snapshot.is_online(device.config['bus_id'])
 
             if device.in_use and not actual_shared:
                 device_driver = self.get_device_driver(device)
@@ -112,8 +165,8 @@ class UsbipOverSSHHost(AbstractRemoteHostDriver, DriverMetaData):
                 device_driver.unshare()
 
             if device.online != actual_online:
-                device.online = actual_online
-                device.save()
+                transitions.append(DeviceTransition(device, 'online', device.online, actual_online))
+        return transitions
 
 
 class UsbipOverSSH(AbstractShareableDeviceDriver, DriverMetaData):
@@ -129,22 +182,26 @@ class UsbipOverSSH(AbstractShareableDeviceDriver, DriverMetaData):
     def execute_command(self, command: str):
         return self.host_driver.execute_command(command)
 
-    def get_share_state(self) -> bool:
-        return self.device.config['bus_id'] in self.host_driver.get_shared_bus_ids()
-
-    def get_online_state(self) -> bool:
-        devices = self.host_driver.get_device_list()
-        return self.device.config['bus_id'] in devices
+    @property
+    def snapshot_key(self) -> str:
+        return self.device.config['bus_id']
 
     def start_sharing(self) -> None:
         if not self.get_share_state():
-            command = f"sudo usbip bind -b {self.device.config['bus_id']}"
-            self.execute_command(command)
+            self.change_binding('bind')
 
     def stop_sharing(self) -> None:
         if self.get_share_state():
-            command = f"sudo usbip unbind -b {self.device.config['bus_id']}"
-            self.execute_command(command)
+            self.change_binding('unbind')
+
+    def change_binding(self, action: str) -> None:
+        bus_id = self.device.config['bus_id']
+        communicator = self.host_driver.communicator
+        if action in communicator.SUPPORTED_REQUESTS:
+            communicator.request(action, bus_id=bus_id)
+        else:
+            self.execute_command(f"sudo usbip {action} -b {bus_id}")
+        self.host_driver.record_share_state(bus_id, action == 'bind')
 
     # This Driver.py does not support authentication
     # def password_string(self):
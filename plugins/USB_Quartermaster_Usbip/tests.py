@@ -4,6 +4,7 @@ import pytest
 
 from UsbipOverSSH.driver import UsbipOverSSHHost
 from quartermaster.AbstractCommunicator import CommandResponse
+from USB_Quartermaster_common import HostSnapshot
 
 sample_bus_id = '1-11'
 sample_hostname = 'example.com'
@@ -93,7 +94,7 @@ def test_host_address(sample_shared_device):
 def test_get_online_state_online(sample_shared_device, sample_list_stdout):
     driver = sample_shared_device.get_driver()
     mock_host_driver = MagicMock()
-    mock_host_driver.get_device_list.return_value = {sample_bus_id: None}  # All we check for is the presence of the key
+    mock_host_driver.get_snapshot.return_value = HostSnapshot(online=[sample_bus_id], shared=[])
     driver.host_driver = mock_host_driver
     assert driver.get_online_state()
 
@@ -102,7 +103,7 @@ def test_get_online_state_online(sample_shared_device, sample_list_stdout):
 def test_get_online_state_offline(sample_unshared_device):
     driver = sample_unshared_device.get_driver()
     mock_host_driver = MagicMock()
-    mock_host_driver.get_device_list.return_value = {sample_bus_id: None}  # All we check for is the presence of the key
+    mock_host_driver.get_snapshot.return_value = HostSnapshot(online=[sample_bus_id], shared=[])
     driver.host_driver = mock_host_driver
     assert not driver.get_online_state()
 
@@ -111,6 +112,6 @@ def test_get_online_state_offline(sample_unshared_device):
 def test_get_online_state_none(sample_unshared_device):
     driver = sample_unshared_device.get_driver()
     mock_host_driver = MagicMock()
-    mock_host_driver.execute_command.return_value = CommandResponse(0, '', UsbipOverSSHHost.NO_REMOTE_DEVICES)
+    mock_host_driver.get_snapshot.return_value = HostSnapshot(online=[], shared=[])
     driver.host_driver = mock_host_driver
     assert False == driver.get_online_state()
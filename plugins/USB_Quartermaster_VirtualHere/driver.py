@@ -10,7 +10,7 @@ from xml.etree import ElementTree
 from xml.etree.ElementTree import Element
 
 from USB_Quartermaster_common import AbstractRemoteHostDriver, AbstractShareableDeviceDriver, CommandResponse, \
-    AbstractLocalDriver
+    AbstractLocalDriver, DeviceTransition, HostSnapshot
 
 logger = logging.getLogger(__name__)
 
@@ -23,7 +23,7 @@ class DeviceInfo(NamedTuple):
 
 
 class DriverMetaData(object):
-    SUPPORTED_COMMUNICATORS = {'SSH'}
+    SUPPORTED_COMMUNICATORS = {'SSH', 'Agent'}
     SUPPORTED_HOST_TYPES = {"Darwin", "Linux_AMD64", "Windows"}
     IDENTIFIER = "VirtualHere"
 
@@ -48,6 +48,13 @@ class VirtualHereOverSSHHost(AbstractRemoteHostDriver, DriverMetaData):
 
     def ssh(self, command: str) -> CommandResponse:
         response = self.communicator.execute_command(command=command)
+        return self.check_response(command, response)
+
+    def ssh_batch(self, commands: List[str]) -> List[CommandResponse]:
+        responses = self.communicator.execute_commands(commands)
+        return [self.check_response(command, response) for command, response in zip(commands, responses)]
+
+    def check_response(self, command: str, response: CommandResponse) -> CommandResponse:
         if response.return_code != 0:
             message = f'Error: host={self.host.address}, command={command}, rc={response.return_code}, ' \
                       f'stdout={response.stdout}, stderr={response.stderr}'
@@ -63,19 +70,24 @@ class VirtualHereOverSSHHost(AbstractRemoteHostDriver, DriverMetaData):
                 return True
         return False
 
-    def vh_command(self, command) -> CommandResponse:
+    def vh_full_command(self, command: str) -> str:
         if self.host.type == "Windows":
             # This forces the the command shell to wait for the executable to exit before exiting ensuring
             # we get the output from VirtualHere.
-            full_command = f'start "quartermaster" /W {self.vh_client_cmd} -t "{command}" -r "quartermaster.tmp" ' \
-                           f'& type quartermaster.tmp ' \
-                           f'& del quartermaster.tmp'
+            return f'start "quartermaster" /W {self.vh_client_cmd} -t "{command}" -r "quartermaster.tmp" ' \
+                   f'& type quartermaster.tmp ' \
+                   f'& del quartermaster.tmp'
         else:
-            full_command = f'{self.vh_client_cmd} -t "{command}"'
+            return f'{self.vh_client_cmd} -t "{command}"'
 
+    def vh_command(self, command) -> CommandResponse:
+        return self.vh_commands([command])[0]
+
+    def vh_commands(self, commands: List[str]) -> List[CommandResponse]:
+        """Run several VirtualHere client commands in a single exchange with the host"""
+        full_commands = [self.vh_full_command(command) for command in commands]
         try:
-            response = self.ssh(full_command)
-            return response
+            return self.ssh_batch(full_commands)
         except self.HostCommandError as e:
             if self.client_service_not_running(e.message):
                 raise self.VirtualHereExecutionError(
@@ -97,14 +109,46 @@ class VirtualHereOverSSHHost(AbstractRemoteHostDriver, DriverMetaData):
         return None
 
     def _get_state_data(self) -> Element:
-        response = self.vh_command('GET CLIENT STATE')
+        # The state XML can get large on busy hubs so it is parsed as it arrives rather than buffered
+        parser = ElementTree.XMLParser()
+        parse_errors = []
+
+        def feed(text: str) -> None:
+            if parse_errors:
+                return
+            try:
+                parser.feed(text)
+            except ElementTree.ParseError as e:
+                parse_errors.append(e)
+
+        command = 'GET CLIENT STATE'
         try:
-            return ElementTree.fromstring(response.stdout)
+            response = self.communicator.execute_command_streaming(self.vh_full_command(command), feed)
+            self.check_response(command, response)
+        except self.HostCommandError as e:
+            if self.client_service_not_running(e.message):
+                raise self.VirtualHereExecutionError(
+                    f"VirtualHere client service is needed but does not appear to be running on {self.host.address}")
+            raise e
+
+        try:
+            if parse_errors:
+                raise parse_errors[0]
+            return parser.close()
         except ElementTree.ParseError as e:
             raise self.VirtualHereExecutionError(f"Error parsing VirtualHere client status, "
-                                                 f"host={self.host.communicator}:{self.host.address} xml=>>{response.stdout}<< stderr=>>{response.stderr}<<")
+                                                 f"host={self.host.communicator}:{self.host.address} error={e} "
+                                                 f"xml=>>{response.stdout}<< stderr=>>{response.stderr}<<")
 
     def get_states(self) -> Dict[str, DeviceInfo]:
+        inventory = self.communicator.get_inventory()
+        if inventory is not None and 'virtualhere' in inventory:
+            return {device['address']: DeviceInfo(address=device['address'],
+                                                  nickname=device['nickname'],
+                                                  online=True,
+                                                  shared=device['shared'])
+                    for device in inventory['virtualhere']['devices']}
+
         state_data = self._get_state_data()
         hostname = self._find_localhost_hostname(state_data)
 
@@ -136,25 +180,51 @@ class VirtualHereOverSSHHost(AbstractRemoteHostDriver, DriverMetaData):
             )
         return devices
 
-    def update_device_states(self, devices: Iterable['Device']):
+    def take_snapshot(self) -> HostSnapshot:
         states = self.get_states()
+        return HostSnapshot(online=states.keys(),
+                            shared=(address for address, state in states.items() if state.shared),
+                            details=states)
+
+    def update_device_states(self, devices: Iterable['Device']) -> List[DeviceTransition]:
+        states: Dict[str, DeviceInfo] = self.get_snapshot().details
+        stop_addresses = []
+        transitions = []
         for device in devices:
             try:
                 state_info = states[device.config['device_address']]
             except KeyError:
                 # If we don't see the device in the state info then it is offline
-                device.online = False
-                device.save()
+                if device.online:
+                    transitions.append(DeviceTransition(device, 'online', True, False))
                 continue
             else:
                 if not device.online:
-                    device.online = True
-                    device.save()
+                    transitions.append(DeviceTransition(device, 'online', False, True))
 
             # Devices are always shared, just disconnect users who don't have them reserved.
             if not device.in_use and state_info.shared:
-                device_driver = self.get_device_driver(device)
-                device_driver.unshare()
+                logger.info(f"Un-sharing {device}")
+                stop_addresses.append(device.config['device_address'])
+
+        # We already know the share states so disconnect everyone in one go rather than asking again per device
+        if stop_addresses:
+            self.stop_using(stop_addresses)
+        return transitions
+
+    def stop_using(self, addresses: List[str]) -> None:
+        if 'stop_using' in self.communicator.SUPPORTED_REQUESTS:
+            for address in addresses:
+                self.communicator.request('stop_using', address=address)
+        else:
+            self.vh_commands([f"STOP USING,{address}" for address in addresses])
+        for address in addresses:
+            self.record_share_state(address, False)
+
+    def record_nickname(self, address: str, nickname: str) -> None:
+        """Keep the snapshot in line after renaming a device"""
+        if self.snapshot is not None and address in self.snapshot.details:
+            self.snapshot.details[address] = self.snapshot.details[address]._replace(nickname=nickname)
 
 
 class VirtualHereOverSSH(AbstractShareableDeviceDriver, DriverMetaData):
@@ -170,29 +240,26 @@ class VirtualHereOverSSH(AbstractShareableDeviceDriver, DriverMetaData):
     class VirtualHereExecutionError(VirtualHereDriverError):
         pass
 
-    def get_share_state(self) -> bool:
-        device_address = self.device.config['device_address']
-        states: List[DeviceInfo] = self.host_driver.get_states()
-        if device_address in states:
-            return states[device_address].shared
-        else:
-            raise self.DeviceNotFound(f"Did not find {device_address} on {self.device.host}")
+    @property
+    def snapshot_key(self) -> str:
+        return self.device.config['device_address']
 
-    def get_online_state(self) -> bool:
-        device_address = self.device.config['device_address']
-        states: List[DeviceInfo] = self.host_driver.get_states()
-        return device_address in states
+    def get_share_state(self) -> bool:
+        snapshot = self.host_driver.get_snapshot()
+        if not snapshot.is_online(self.snapshot_key):
+            raise self.DeviceNotFound(f"Did not find {self.snapshot_key} on {self.device.host}")
+        return snapshot.is_shared(self.snapshot_key)
 
     def get_nickname(self) -> Optional[str]:
-        device_address = self.device.config['device_address']
-        states: List[DeviceInfo] = self.host_driver.get_states()
-        if device_address in states:
-            return states[device_address].nickname
+        states: Dict[str, DeviceInfo] = self.host_driver.get_snapshot().details
+        if self.snapshot_key in states:
+            return states[self.snapshot_key].nickname
         else:
-            raise self.DeviceNotFound(f"Did not find {device_address} on {self.device.host}")
+            raise self.DeviceNotFound(f"Did not find {self.snapshot_key} on {self.device.host}")
 
     def set_nickname(self) -> None:
-        self.host_driver.vh_command(f"DEVICE RENAME,{self.device.config['device_address']},{self.device.name}")
+        self.host_driver.vh_command(f"DEVICE RENAME,{self.snapshot_key},{self.device.name}")
+        self.host_driver.record_nickname(self.snapshot_key, self.device.name)
 
     def start_sharing(self) -> None:
         # FIXME: Make this do something
@@ -200,9 +267,8 @@ class VirtualHereOverSSH(AbstractShareableDeviceDriver, DriverMetaData):
         pass
 
     def stop_sharing(self) -> None:
-        states: Dict[str, DeviceInfo] = self.host_driver.get_states()
-        if states[self.device.config['device_address']].shared:
-            self.host_driver.vh_command(f"STOP USING,{self.device.config['device_address']}")
+        if self.host_driver.get_snapshot().is_shared(self.snapshot_key):
+            self.host_driver.stop_using([self.snapshot_key])
 
 
 ################################################################################
@@ -1,3 +1,24 @@
-from django.test import TestCase
+from unittest.mock import MagicMock
 
-# Create your tests here.
+import pytest
+
+from USB_Quartermaster_VirtualHere.driver import VirtualHereOverSSH, VirtualHereOverSSHHost, DeviceInfo
+from USB_Quartermaster_common import HostSnapshot
+from data.models import Device
+
+
+@pytest.mark.django_db
+def test_set_nickname_updates_snapshot(sample_remote_host, sample_unshared_resource):
+    device = Device.objects.create(resource=sample_unshared_resource, driver=VirtualHereOverSSH.IDENTIFIER,
+                                   host=sample_remote_host, name='Phone', config_json='{"device_address": "1101"}')
+    host_driver = VirtualHereOverSSHHost(host=sample_remote_host)
+    host_driver.snapshot = HostSnapshot(online=['1101'], shared=[],
+                                        details={'1101': DeviceInfo('1101', 'Old name', True, False)})
+    host_driver.vh_command = MagicMock()
+    driver = VirtualHereOverSSH(device, host_driver)
+
+    assert 'Old name' == driver.get_nickname()
+    driver.set_nickname()
+    host_driver.vh_command.assert_called_once_with("DEVICE RENAME,1101,Phone")
+    # The rest of the poll sees the new name rather than renaming the device again
+    assert 'Phone' == driver.get_nickname()
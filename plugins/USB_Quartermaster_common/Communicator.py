@@ -1,12 +1,14 @@
-import json
-from typing import List
+from typing import List, Any, Callable, Optional, Tuple
 
-from .Exceptions import USB_Quartermaster_Exception
-from .util import CommandResponse
+from .Exceptions import CommunicatorError
+from .gate import HostGate, host_gates
+from .util import CommandResponse, RevisionCache, config_revision, ContactTracker
 
+# Parsed host configurations, keyed on host id and rebuilt when the host's config_json changes
+config_cache = RevisionCache()
 
-class CommunicatorError(USB_Quartermaster_Exception):
-    pass
+# When each host last completed an exchange with this process
+contact_tracker = ContactTracker()
 
 
 class AbstractCommunicator(object):
@@ -22,14 +24,74 @@ class AbstractCommunicator(object):
     CONFIGURATION_KEYS: List[str] = None
     SUPPORTED_HOST_TYPES: List[str] = None
     IDENTIFIER: str
-    
+
+    # Operations, such as 'bind', that request() can carry out on the remote host without drivers having to build
+    # and parse shell commands. Drivers fall back to commands for anything not listed.
+    SUPPORTED_REQUESTS: Tuple[str, ...] = ()
+
+    # A host that completed an exchange within this many seconds is treated as reachable without probing it
+    contact_freshness: float = 30.0
+
+    # At most this many commands run on one host at a time from this process, further callers queue in the order
+    # they arrived for up to queue_timeout seconds. A host's config can lower or raise the limit with a
+    # "max_concurrent_commands" entry.
+    max_concurrent_commands: int = 4
+    queue_timeout: float = 30.0
+
     def __init__(self, host: 'RemoteHost'):
         self.host = host
-        # strict=False is there to allow use of \n in json values
-        self.config = json.loads(host.config_json, strict=False)
+        self.config_revision = config_revision(host.config_json)
+        # Copied so changes made by one communicator don't leak in to the shared cache
+        self.config = dict(config_cache.get(host.pk, self.config_revision, self.parse_config))
+
+    def parse_config(self) -> dict:
+        # The model keeps its own parsed copy, reuse it so a row is only ever decoded once
+        return self.host.config
+
+    @property
+    def gate(self) -> HostGate:
+        limit = int(self.config.get('max_concurrent_commands', self.max_concurrent_commands))
+        return host_gates.get(self.host.pk, str(self.host), limit)
 
     def execute_command(self, command: str) -> CommandResponse:
         raise NotImplemented
 
+    def execute_command_streaming(self, command: str, on_stdout: Callable[[str], None]) -> CommandResponse:
+        """
+        Like execute_command but stdout is handed to on_stdout as it arrives, so large output can be parsed
+        incrementally. The stdout of the returned response may only hold the start of the output.
+        """
+        response = self.execute_command(command)
+        on_stdout(response.stdout)
+        return response
+
+    def record_contact(self) -> None:
+        """Call when an exchange with the host completes, whatever the command's return code"""
+        contact_tracker.record(self.host.pk)
+
+    def recently_reachable(self) -> bool:
+        return contact_tracker.is_fresh(self.host.pk, self.contact_freshness)
+
+    def forget_contact(self) -> None:
+        contact_tracker.forget(self.host.pk)
+
+    def execute_commands(self, commands: List[str]) -> List[CommandResponse]:
+        """
+        Run several commands returning a response, with its own return code, for each of them in order.
+        Override this when the protocol can run them all in one exchange with the remote host.
+        """
+        return [self.execute_command(command) for command in commands]
+
     def is_host_reachable(self) -> bool:
         raise NotImplemented
+
+    def request(self, method: str, **params) -> Any:
+        """Carry out one of SUPPORTED_REQUESTS on the remote host, raising CommunicatorError if it fails"""
+        raise NotImplementedError(f"{self.IDENTIFIER} does not support {method} requests")
+
+    def get_inventory(self) -> Optional[dict]:
+        """
+        Devices and share state of the remote host as structured data, keyed by driver, e.g. {'usbip': {...}}.
+        None, or a missing key, means the drivers have to find out for themselves with commands.
+        """
+        return None
@@ -1,5 +1,6 @@
+import hashlib
 import logging
-from typing import TYPE_CHECKING, List, Dict, Type, Iterable, Any, Tuple, NoReturn, Optional, Union
+from typing import TYPE_CHECKING, List, Dict, Type, Iterable, Any, Tuple, Optional, Union, NamedTuple, Hashable
 
 from .Communicator import AbstractCommunicator
 from .Exceptions import USB_Quartermaster_Exception
@@ -11,6 +12,49 @@ if TYPE_CHECKING:
 logger = logging.getLogger(__name__)
 
 
+class DeviceTransition(NamedTuple):
+    """A change to a device's state found while polling its host, the server saves these in bulk"""
+    device: 'Device'
+    field: str
+    old: Any
+    new: Any
+
+
+class HostSnapshot(object):
+    """
+    What is online and shared on a host, fetched in a single exchange with it. Device drivers decide what to do from
+    this rather than asking the host again and keep it current as they change what is shared.
+
+    Devices are identified by the key the driver finds them by on the host, like a bus id, and `details` holds
+    whatever else the driver learnt about them.
+    """
+
+    def __init__(self, online: Iterable[Hashable], shared: Iterable[Hashable],
+                 details: Optional[Dict[Hashable, Any]] = None):
+        self.online = set(online)
+        self.shared = set(shared)
+        self.details = details if details is not None else {}
+
+    def is_online(self, key: Hashable) -> bool:
+        return key in self.online
+
+    def is_shared(self, key: Hashable) -> bool:
+        return key in self.shared
+
+    def set_shared(self, key: Hashable, shared: bool) -> None:
+        if shared:
+            self.shared.add(key)
+        else:
+            self.shared.discard(key)
+
+    @property
+    def digest(self) -> str:
+        """Changes whenever anything in the snapshot does, two snapshots with the same digest are interchangeable"""
+        content = (sorted(map(repr, self.online)), sorted(map(repr, self.shared)),
+                   sorted((repr(key), repr(value)) for key, value in self.details.items()))
+        return hashlib.sha1(repr(content).encode()).hexdigest()
+
+
 class AbstractRemoteHostDriver(object):
     """
     This code runs on the quartermaster server
@@ -49,6 +93,7 @@ class AbstractRemoteHostDriver(object):
     def __init__(self, host: 'RemoteHost'):
         self.host = host
         self.communicator: AbstractCommunicator = host.get_communicator_obj()
+        self.snapshot: Optional[HostSnapshot] = None
 
     @property
     def address(self):
@@ -56,14 +101,32 @@ class AbstractRemoteHostDriver(object):
 
     @property
     def is_reachable(self) -> bool:
+        # A command that completed recently shows the host is up just as well as a dedicated probe would
+        if self.communicator.recently_reachable():
+            return True
         return self.communicator.is_host_reachable()
 
     def devices(self) -> Iterable['Device']:
-        return self.host.device_set.filter(driver=self.DEVICE_CLASS.__name__)
+        return self.host.device_set.filter(driver=self.IDENTIFIER)
 
     def get_device_driver(self, device: 'Device') -> 'AbstractShareableDeviceDriver':
         return self.DEVICE_CLASS(device=device, host=self)
 
+    def take_snapshot(self) -> HostSnapshot:
+        """Fetch the online and share state of all the host's devices in a single exchange"""
+        raise NotImplementedError
+
+    def get_snapshot(self) -> HostSnapshot:
+        """The snapshot this driver took last, one is only taken the first time it is needed"""
+        if self.snapshot is None:
+            self.snapshot = self.take_snapshot()
+        return self.snapshot
+
+    def record_share_state(self, key: Hashable, shared: bool) -> None:
+        """Keep the snapshot in line after changing whether a device is shared"""
+        if self.snapshot is not None:
+            self.snapshot.set_shared(key, shared)
+
     def online_statuses(self) -> List[Dict['Device', Any]]:
         raise NotImplemented
 
@@ -73,7 +136,11 @@ class AbstractRemoteHostDriver(object):
     def share_statuses(self) -> Dict[Any, Any]:
         raise NotImplemented
 
-    def update_device_states(self, devices: Iterable['Device']) -> NoReturn:
+    def update_device_states(self, devices: Iterable['Device']) -> List[DeviceTransition]:
+        """
+        Bring the host in line with the devices' reservations and return the device state changes found on the way.
+        The changes must not be saved here, the caller writes them all at once.
+        """
         raise NotImplemented
 
     def __str__(self):
@@ -157,11 +224,16 @@ class AbstractShareableDeviceDriver(object):
     def stop_sharing(self) -> None:
         raise NotImplemented
 
+    @property
+    def snapshot_key(self) -> Hashable:
+        """How the host's snapshot identifies this device"""
+        raise NotImplementedError
+
     def get_share_state(self) -> bool:
-        raise NotImplemented
+        return self.host_driver.get_snapshot().is_shared(self.snapshot_key)
 
     def get_online_state(self) -> bool:
-        raise NotImplementedError
+        return self.host_driver.get_snapshot().is_online(self.snapshot_key)
 
     def validate_configuration(self) -> List[str]:
         errors_found = []
@@ -1,2 +1,6 @@
 class USB_Quartermaster_Exception(Exception):
     pass
+
+
+class CommunicatorError(USB_Quartermaster_Exception):
+    pass
@@ -1,4 +1,7 @@
 from .Communicator import AbstractCommunicator, CommunicatorError
-from .Driver import AbstractRemoteHostDriver, AbstractShareableDeviceDriver, AbstractLocalDriver
+from .Driver import AbstractRemoteHostDriver, AbstractShareableDeviceDriver, AbstractLocalDriver, DeviceTransition, \
+    HostSnapshot
 from .Exceptions import USB_Quartermaster_Exception
+from .gate import HostBusy, host_gates
+from .health import CircuitBreaker, HostHealth, HostUnavailable
 from .util import CommandResponse
@@ -0,0 +1,128 @@
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Dict, Hashable, Optional
+
+from .Exceptions import CommunicatorError
+
+logger = logging.getLogger(__name__)
+
+
+class HostBusy(CommunicatorError):
+    """
+    Raised when a caller waited too long for its turn to run a command on a remote host. It is a communicator failure
+    like any other to callers that don't tell a busy host from one that can't be reached.
+    """
+    pass
+
+
+class HostGate(object):
+    """
+    Lets at most `limit` callers work with a host at once, the rest wait their turn in the order they arrived.
+    Bursts, like many reservations being made together, are spread out instead of opening a pile of simultaneous
+    sessions that the host's sshd refuses (MaxStartups).
+
+    Gates live in the memory of a process, each server process has its own and they don't coordinate with each other.
+    """
+
+    def __init__(self, name: str, limit: int):
+        self.name = name
+        self.limit = limit
+        self._condition = threading.Condition()
+        self._tickets = itertools.count()
+        self._queue = deque()
+        self.active = 0
+        # Metrics
+        self.acquired = 0
+        self.timeouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def _can_enter(self, ticket: int) -> bool:
+        return self.active < self.limit and self._queue[0] == ticket
+
+    def acquire(self, timeout: Optional[float] = None) -> float:
+        """Wait for a slot, returns how long that took"""
+        start = time.monotonic()
+        with self._condition:
+            ticket = next(self._tickets)
+            self._queue.append(ticket)
+            try:
+                if not self._condition.wait_for(lambda: self._can_enter(ticket), timeout=timeout):
+                    self.timeouts += 1
+                    raise HostBusy(f"Timed out after {timeout}s waiting behind {len(self._queue) - 1} "
+                                   f"others to run a command on {self.name}")
+            finally:
+                self._queue.remove(ticket)
+                # The head of the queue changed, whoever is next may be able to go now
+                self._condition.notify_all()
+            self.active += 1
+            waited = time.monotonic() - start
+            self.acquired += 1
+            self.total_wait += waited
+            self.max_wait = max(self.max_wait, waited)
+        if waited > 1.0:
+            logger.info(f"Waited {waited:.1f}s for a command slot on {self.name}")
+        return waited
+
+    def release(self) -> None:
+        with self._condition:
+            self.active -= 1
+            self._condition.notify_all()
+
+    @contextmanager
+    def slot(self, timeout: Optional[float] = None):
+        self.acquire(timeout)
+        try:
+            yield
+        finally:
+            self.release()
+
+    @property
+    def waiting(self) -> int:
+        return len(self._queue)
+
+    def stats(self) -> dict:
+        with self._condition:
+            return {'limit': self.limit,
+                    'active': self.active,
+                    'waiting': len(self._queue),
+                    'acquired': self.acquired,
+                    'timeouts': self.timeouts,
+                    'average_wait': self.total_wait / self.acquired if self.acquired else 0.0,
+                    'max_wait': self.max_wait}
+
+
+class HostGates(object):
+    """One gate per host, shared by every communicator in the process"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._gates: Dict[Hashable, HostGate] = {}
+
+    def get(self, key: Hashable, name: str, limit: int) -> HostGate:
+        with self._lock:
+            gate = self._gates.get(key)
+            if gate is None:
+                gate = self._gates[key] = HostGate(name, limit)
+            elif gate.limit != limit:
+                # The host's limit was edited, let more callers in straight away if it went up
+                with gate._condition:
+                    gate.limit = limit
+                    gate._condition.notify_all()
+        return gate
+
+    def stats(self) -> Dict[Hashable, dict]:
+        with self._lock:
+            gates = dict(self._gates)
+        return {key: gate.stats() for key, gate in gates.items()}
+
+    def clear(self) -> None:
+        with self._lock:
+            self._gates.clear()
+
+
+host_gates = HostGates()
@@ -0,0 +1,114 @@
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+from .Communicator import CommunicatorError
+from .util import on_calling_thread
+
+logger = logging.getLogger(__name__)
+
+
+class HostUnavailable(CommunicatorError):
+    """
+    Raised without contacting the remote host because recent attempts to reach it failed
+    """
+    pass
+
+
+class HostHealth(object):
+    CLOSED = 'closed'  # Host is healthy, calls go through
+    OPEN = 'open'  # Host is known to be bad, calls fail fast until the retry time
+    HALF_OPEN = 'half_open'  # Retry time has passed, one caller is probing the host
+
+    CHOICES = ((CLOSED, 'Reachable'), (OPEN, 'Unreachable'), (HALF_OPEN, 'Retrying'))
+
+
+class CircuitBreaker(object):
+    """
+    Tracks the health of a remote host so callers stop paying the full connection timeout while it is down.
+
+    After failure_threshold consecutive failed connections the circuit opens and calls fail immediately. Once the
+    retry time passes a single call is let through as a probe, if it fails the host is given a longer backoff,
+    doubling each time up to max_backoff.
+
+    The state is kept on the RemoteHost record so it is shared between server processes and visible to allocators.
+    """
+
+    FAILURE_THRESHOLD = 3
+    BASE_BACKOFF = timedelta(seconds=30)
+    MAX_BACKOFF = timedelta(minutes=15)
+
+    def __init__(self, host: 'RemoteHost',
+                 failure_threshold: Optional[int] = None,
+                 base_backoff: Optional[timedelta] = None,
+                 max_backoff: Optional[timedelta] = None):
+        self.host = host
+        self.failure_threshold = failure_threshold or self.FAILURE_THRESHOLD
+        self.base_backoff = base_backoff or self.BASE_BACKOFF
+        self.max_backoff = max_backoff or self.MAX_BACKOFF
+        # Whether this breaker's caller won the right to probe the host, see claim_probe()
+        self.probing = False
+
+    @staticmethod
+    def now() -> datetime:
+        return datetime.now(timezone.utc)
+
+    @property
+    def state(self) -> str:
+        return self.host.health_state
+
+    def backoff(self, failures: int) -> timedelta:
+        exponent = max(failures - self.failure_threshold, 0)
+        return min(self.base_backoff * (2 ** exponent), self.max_backoff)
+
+    def before_call(self) -> None:
+        if self.state == HostHealth.CLOSED or self.probing:
+            return
+        if self.host.health_retry_at is not None and self.now() < self.host.health_retry_at:
+            raise HostUnavailable(f"{self.host} is unreachable, not retrying until {self.host.health_retry_at}")
+        if not self.claim_probe():
+            raise HostUnavailable(f"{self.host} is unreachable, another caller is probing it")
+        logger.info(f"Probing {self.host} to see if it is reachable again")
+
+    def claim_probe(self) -> bool:
+        """
+        Of all the callers finding the retry time has passed only one gets to probe the host, the rest are refused
+        as they would be while it is open. A conditional UPDATE picks the winner. The probe holds the host for a
+        base backoff, if its caller never reports back another probe may be made after that.
+        """
+        current_time = self.now()
+        fields = {'health_state': HostHealth.HALF_OPEN, 'health_retry_at': current_time + self.base_backoff}
+        if self.host.pk is not None:
+            claimed = type(self.host)._default_manager \
+                .filter(pk=self.host.pk, health_state__in=(HostHealth.OPEN, HostHealth.HALF_OPEN),
+                        health_retry_at__lte=current_time)
+            if not on_calling_thread(claimed.update, **fields):
+                return False
+        for name, value in fields.items():
+            setattr(self.host, name, value)
+        self.probing = True
+        return True
+
+    def record_success(self) -> None:
+        if self.state != HostHealth.CLOSED or self.host.health_failures:
+            if self.state != HostHealth.CLOSED:
+                logger.info(f"{self.host} is reachable again")
+            self.update(health_state=HostHealth.CLOSED, health_failures=0, health_retry_at=None)
+        self.probing = False
+
+    def record_failure(self) -> None:
+        failures = self.host.health_failures + 1
+        if self.state == HostHealth.HALF_OPEN or failures >= self.failure_threshold:
+            retry_at = self.now() + self.backoff(failures)
+            logger.warning(f"{self.host} is unreachable after {failures} attempts, retrying after {retry_at}")
+            self.update(health_state=HostHealth.OPEN, health_failures=failures, health_retry_at=retry_at)
+        else:
+            self.update(health_failures=failures)
+        self.probing = False
+
+    def update(self, **fields) -> None:
+        for name, value in fields.items():
+            setattr(self.host, name, value)
+        if self.host.pk is not None:
+            # Breakers are used from the threads for_all_devices() fans out to, the write is made by its caller
+            on_calling_thread(type(self.host)._default_manager.filter(pk=self.host.pk).update, **fields)
@@ -1,7 +1,135 @@
-from typing import NamedTuple, Union
+import hashlib
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import NamedTuple, Union, Dict, Hashable, Tuple, Any, Callable, Optional, List
 
 
 class CommandResponse(NamedTuple):
     return_code: Union[int, str]
     stdout: str
     stderr: str
+
+
+def config_revision(config_json: str) -> str:
+    """Fingerprint of a config_json blob, it changes whenever the configuration is edited"""
+    return hashlib.sha1(config_json.encode('utf-8')).hexdigest()
+
+
+class RevisionCache(object):
+    """
+    Holds one value per key along with the revision of the data it was built from. When asked for a different
+    revision the value is rebuilt and replaces the old one, so edits invalidate entries without any extra bookkeeping
+    and the cache never holds more than one value per key.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries: Dict[Hashable, Tuple[str, Any]] = {}
+
+    def get(self, key: Hashable, revision: str, factory: Callable[[], Any]) -> Any:
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is not None and entry[0] == revision:
+            return entry[1]
+        value = factory()
+        with self._lock:
+            self._entries[key] = (revision, value)
+        return value
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+class ContactTracker(object):
+    """
+    Remembers when each host last completed an exchange with us. A host that answered a real command moments ago is
+    reachable, there is no need to spend a connection on a dedicated probe.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._last_contact: Dict[Hashable, float] = {}
+
+    def record(self, key: Hashable) -> None:
+        with self._lock:
+            self._last_contact[key] = time.monotonic()
+
+    def seconds_since(self, key: Hashable) -> Optional[float]:
+        with self._lock:
+            last_contact = self._last_contact.get(key)
+        if last_contact is None:
+            return None
+        return time.monotonic() - last_contact
+
+    def is_fresh(self, key: Hashable, window: float) -> bool:
+        age = self.seconds_since(key)
+        return age is not None and age < window
+
+    def forget(self, key: Hashable) -> None:
+        with self._lock:
+            self._last_contact.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._last_contact.clear()
+
+
+class CallingThread(object):
+    """
+    Lets the worker threads a caller fans out to hand work back to the caller's own thread. Database work is sent
+    through on_calling_thread() so workers never open connections of their own, those wouldn't see the caller's
+    uncommitted transaction and could wait forever on locks it holds.
+
+    Workers run their function with run(), the caller sits in serve() answering their requests until they finish.
+    """
+    _local = threading.local()
+
+    def __init__(self):
+        self._requests = queue.SimpleQueue()
+
+    def run(self, function: Callable, *args) -> Any:
+        """Run `function` on this worker thread with on_calling_thread() handing work back to the caller"""
+        self._local.current = self
+        try:
+            return function(*args)
+        finally:
+            del self._local.current
+
+    def serve(self, futures: List[Future]) -> None:
+        """Run the workers' requests until all of `futures` are done"""
+        for future in futures:
+            future.add_done_callback(lambda _: self._requests.put(None))
+        remaining = len(futures)
+        while remaining:
+            request = self._requests.get()
+            if request is None:
+                remaining -= 1
+                continue
+            result, function, args, kwargs = request
+            try:
+                result.set_result(function(*args, **kwargs))
+            except BaseException as e:
+                result.set_exception(e)
+
+    def request(self, function: Callable, *args, **kwargs) -> Any:
+        result = Future()
+        self._requests.put((result, function, args, kwargs))
+        return result.result()
+
+    @classmethod
+    def current(cls) -> Optional['CallingThread']:
+        return getattr(cls._local, 'current', None)
+
+
+def on_calling_thread(function: Callable, *args, **kwargs) -> Any:
+    """
+    Call `function` on the thread that fanned out to this one with a CallingThread, or right here on any other
+    thread. Returns its result or raises its exception either way.
+    """
+    calling_thread = CallingThread.current()
+    if calling_thread is None:
+        return function(*args, **kwargs)
+    return calling_thread.request(function, *args, **kwargs)
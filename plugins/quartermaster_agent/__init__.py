@@ -0,0 +1,4 @@
+"""
+Agent daemon for remote hosts and the protocol it speaks. This package only uses the standard library, copy it to a
+remote host and run `python -m quartermaster_agent.daemon`, the server side lives in USB_Quartermaster_Agent.
+"""
@@ -0,0 +1,264 @@
+"""
+Agent that runs on a remote host and keeps one connection open to the quartermaster agent hub. It reports the
+host's USB inventory and share state as JSON and carries out share changes when asked, so the server doesn't have to
+spawn and screen scrape shell commands for them.
+
+    python -m quartermaster_agent.daemon --hub quartermaster.example.com:7590 --host-id 12 --token ...
+
+The token has to match the "token" entry in the host's config on the server. The connection to the hub is made over
+TLS, checked against the system's certificate authorities or the one given with --ca-file.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import random
+import shlex
+import shutil
+import ssl
+from typing import Optional, List
+from xml.etree import ElementTree
+
+from .protocol import Connection, RPCError, METHOD_NOT_FOUND, COMMAND_FAILED, STREAM_LIMIT, parse_address, \
+    INVALID_PARAMS, UNAUTHORIZED
+
+logger = logging.getLogger(__name__)
+
+SYSFS_DEVICES_PATH = '/sys/bus/usb/devices'
+USBIP_HOST_DRIVER_PATH = '/sys/bus/usb/drivers/usbip-host'
+USB_HUB_CLASS = '09'
+# execute may list these, the usbip-host driver is found under the first
+SYSFS_USB_PATHS = ('/sys/bus/usb/',)
+
+
+def read_attribute(device_path: str, name: str) -> Optional[str]:
+    try:
+        with open(os.path.join(device_path, name)) as attribute:
+            return attribute.read().strip()
+    except OSError:
+        return None
+
+
+def usbip_inventory(devices_path: str = SYSFS_DEVICES_PATH, driver_path: str = USBIP_HOST_DRIVER_PATH) -> dict:
+    """The same information `usbip list -l` and a listing of the usbip-host driver give, read straight from sysfs"""
+    devices = []
+    for bus_id in sorted(os.listdir(devices_path)):
+        device_path = os.path.join(devices_path, bus_id)
+        # Interfaces and root hubs are not shareable, only real devices have a bus id like 1-2 or 1-2.3
+        if not bus_id[0].isdigit() or ':' in bus_id:
+            continue
+        if read_attribute(device_path, 'bDeviceClass') == USB_HUB_CLASS:
+            continue
+        devices.append({'bus_id': bus_id,
+                        'id_vendor': read_attribute(device_path, 'idVendor') or '',
+                        'id_product': read_attribute(device_path, 'idProduct') or '',
+                        'vendor': read_attribute(device_path, 'manufacturer') or 'unknown vendor',
+                        'product': read_attribute(device_path, 'product') or 'unknown product'})
+
+    try:
+        shared = sorted(entry for entry in os.listdir(driver_path) if entry[0].isdigit())
+    except FileNotFoundError:
+        # usbip-host module isn't loaded so nothing can be shared
+        shared = []
+    return {'devices': devices, 'shared': shared}
+
+
+def parse_virtualhere_state(xml: str) -> List[dict]:
+    """Devices on the local VirtualHere hub from `GET CLIENT STATE` output"""
+    state = ElementTree.fromstring(xml)
+    for connection in state.iter('connection'):
+        if connection.attrib['ip'] == '127.0.0.1':
+            hostname = connection.attrib['hostname']
+            break
+    else:
+        raise RPCError(COMMAND_FAILED, "The VirtualHere client is not connected to the local hub")
+
+    return [{'address': f"{hostname}.{device.attrib['address']}",
+             'nickname': device.attrib['nickname'],
+             'shared': device.attrib['state'] != "1"}  # 1=Unused, 3=Used
+            for device in state.iter('device')]
+
+
+class AgentDaemon(object):
+    # Reconnect delays when the hub can't be reached
+    MIN_RECONNECT_DELAY = 1.0
+    MAX_RECONNECT_DELAY = 60.0
+
+    def __init__(self, hub_address: str, host_id: int, token: str, report_interval: float = 30.0,
+                 virtualhere_command: Optional[str] = None, sudo: bool = True,
+                 ssl_context: Optional[ssl.SSLContext] = None):
+        self.hub_address = parse_address(hub_address)
+        self.ssl_context = ssl_context
+        self.host_id = host_id
+        self.token = token
+        self.report_interval = report_interval
+        self.virtualhere_command = virtualhere_command
+        self.sudo = ['sudo'] if sudo else []
+        self.connection: Optional[Connection] = None
+
+    async def run(self) -> None:
+        delay = self.MIN_RECONNECT_DELAY
+        while True:
+            try:
+                await self.session()
+                delay = self.MIN_RECONNECT_DELAY
+            except (OSError, RPCError) as e:
+                logger.warning(f"Lost connection to hub {self.hub_address[0]}:{self.hub_address[1]}: {e}")
+            # Jitter keeps a fleet of agents from reconnecting in lock step after the hub restarts
+            await asyncio.sleep(delay * random.uniform(0.5, 1.5))
+            delay = min(delay * 2, self.MAX_RECONNECT_DELAY)
+
+    async def session(self) -> None:
+        host, port = self.hub_address
+        reader, writer = await asyncio.open_connection(host, port, limit=STREAM_LIMIT, ssl=self.ssl_context)
+        connection = Connection(reader, writer, self.handle)
+        serving = asyncio.ensure_future(connection.serve())
+        try:
+            await connection.call('register', {'host_id': self.host_id, 'token': self.token}, timeout=10.0)
+            logger.info(f"Registered with hub {host}:{port} as host {self.host_id}")
+            self.connection = connection
+            while not serving.done():
+                await self.report()
+                await asyncio.wait([serving], timeout=self.report_interval)
+        finally:
+            self.connection = None
+            connection.close()
+            serving.cancel()
+
+    async def report(self) -> None:
+        """Push the current inventory so the hub can answer polls without asking us"""
+        if self.connection is not None:
+            await self.connection.notify('report', await self.inventory())
+
+    async def handle(self, method: str, params: dict):
+        handlers = {'inventory': self.inventory,
+                    'bind': self.bind,
+                    'unbind': self.unbind,
+                    'stop_using': self.stop_using,
+                    'execute': self.execute}
+        try:
+            handler = handlers[method]
+        except KeyError:
+            raise RPCError(METHOD_NOT_FOUND, f"Unknown method {method}")
+        return await handler(**params)
+
+    @staticmethod
+    async def collect(process: asyncio.subprocess.Process) -> dict:
+        stdout, stderr = await process.communicate()
+        return {'return_code': process.returncode,
+                'stdout': stdout.decode('UTF-8', errors='replace'),
+                'stderr': stderr.decode('UTF-8', errors='replace')}
+
+    async def run_process(self, *args: str) -> dict:
+        return await self.collect(await asyncio.create_subprocess_exec(
+            *args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE))
+
+    async def run_checked(self, *args: str) -> dict:
+        response = await self.run_process(*args)
+        if response['return_code'] != 0:
+            raise RPCError(COMMAND_FAILED, f"command={' '.join(args)}, rc={response['return_code']}, "
+                                           f"stdout={response['stdout']}, stderr={response['stderr']}")
+        return response
+
+    async def inventory(self) -> dict:
+        """Sections are left out when they can't be gathered, the server then falls back to running commands"""
+        inventory = {}
+        if os.path.isdir(SYSFS_DEVICES_PATH):
+            inventory['usbip'] = usbip_inventory()
+        vh = self.find_virtualhere()
+        if vh is not None:
+            try:
+                response = await self.run_checked(vh, '-t', 'GET CLIENT STATE')
+                inventory['virtualhere'] = {'devices': parse_virtualhere_state(response['stdout'])}
+            except (RPCError, ElementTree.ParseError) as e:
+                logger.warning(f"Could not get VirtualHere state: {e}")
+        return inventory
+
+    def find_virtualhere(self) -> Optional[str]:
+        if self.virtualhere_command:
+            return self.virtualhere_command
+        return shutil.which('vhclientx86_64')
+
+    async def bind(self, bus_id: str) -> dict:
+        response = await self.run_checked(*self.sudo, 'usbip', 'bind', '-b', bus_id)
+        await self.report()
+        return response
+
+    async def unbind(self, bus_id: str) -> dict:
+        response = await self.run_checked(*self.sudo, 'usbip', 'unbind', '-b', bus_id)
+        await self.report()
+        return response
+
+    async def stop_using(self, address: str) -> dict:
+        vh = self.find_virtualhere()
+        if vh is None:
+            raise RPCError(COMMAND_FAILED, "VirtualHere client not found")
+        response = await self.run_checked(vh, '-t', f"STOP USING,{address}")
+        await self.report()
+        return response
+
+    async def execute(self, command: str) -> dict:
+        """
+        Escape hatch for drivers that don't have a structured request for what they need yet. Only the commands of
+        command_allowed() are run, and without a shell, anyone able to send requests must not be able to run
+        anything else as this user.
+        """
+        try:
+            args = shlex.split(command)
+        except ValueError as e:
+            raise RPCError(INVALID_PARAMS, f"Could not parse command: {e}")
+        if args[:1] == ['sudo']:
+            # Agents running as root are started with --no-sudo, use whatever they were told
+            args = [*self.sudo, *args[1:]] if args[1:2] == ['usbip'] else []
+        if not self.command_allowed(args):
+            raise RPCError(UNAUTHORIZED, f"Command not allowed: {command}")
+        return await self.run_process(*args)
+
+    def command_allowed(self, args: List[str]) -> bool:
+        """usbip, the VirtualHere client and listing sysfs"""
+        elevated = bool(self.sudo) and args[:len(self.sudo)] == self.sudo
+        program_args = args[len(self.sudo):] if elevated else args
+        if not program_args:
+            return False
+        program, arguments = program_args[0], program_args[1:]
+        if program == 'usbip':
+            return True
+        if elevated:
+            # Only usbip is run with sudo
+            return False
+        if program == 'ls':
+            return all(argument.startswith('-') or
+                       os.path.normpath(argument).startswith(tuple(path.rstrip('/') for path in SYSFS_USB_PATHS))
+                       for argument in arguments)
+        virtualhere = self.find_virtualhere()
+        return virtualhere is not None and program in (virtualhere, os.path.basename(virtualhere))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Quartermaster remote host agent")
+    parser.add_argument('--hub', required=True, help="Agent hub address, host:port")
+    parser.add_argument('--host-id', required=True, type=int, help="Id of this host on the quartermaster server")
+    parser.add_argument('--token', default=os.environ.get('QUARTERMASTER_AGENT_TOKEN'),
+                        help="Shared secret from the host config, defaults to $QUARTERMASTER_AGENT_TOKEN")
+    parser.add_argument('--report-interval', type=float, default=30.0, help="Seconds between inventory reports")
+    parser.add_argument('--virtualhere-command', help="VirtualHere client to query, found in PATH if not given")
+    parser.add_argument('--no-sudo', action='store_true', help="Run usbip directly, for agents running as root")
+    parser.add_argument('--ca-file', help="Certificate authority to check the hub's certificate against, the system's "
+                                          "are used if not given")
+    parser.add_argument('--insecure', action='store_true',
+                        help="Connect to the hub without TLS, the token is sent in the clear")
+    parser.add_argument('--debug', action='store_true')
+    args = parser.parse_args()
+    if not args.token:
+        parser.error("--token or $QUARTERMASTER_AGENT_TOKEN is required")
+
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO)
+    ssl_context = None if args.insecure else ssl.create_default_context(cafile=args.ca_file)
+    daemon = AgentDaemon(hub_address=args.hub, host_id=args.host_id, token=args.token,
+                         report_interval=args.report_interval, virtualhere_command=args.virtualhere_command,
+                         sudo=not args.no_sudo, ssl_context=ssl_context)
+    asyncio.run(daemon.run())
+
+
+if __name__ == '__main__':
+    main()
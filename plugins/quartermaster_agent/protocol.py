@@ -0,0 +1,176 @@
+"""
+JSON-RPC 2.0 as spoken between the agent daemon, the hub and the Agent communicator. Every message is one line of
+JSON. Only the standard library is used here so the daemon can run on remote hosts without the server's dependencies.
+"""
+import asyncio
+import itertools
+import json
+import logging
+import socket
+from typing import Any, Optional, Dict, Callable, Awaitable, Tuple
+
+logger = logging.getLogger(__name__)
+
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+INTERNAL_ERROR = -32603
+AGENT_NOT_CONNECTED = -32000
+UNAUTHORIZED = -32001
+COMMAND_FAILED = -32002
+
+# Inventory reports from hosts with many devices can be long lines
+STREAM_LIMIT = 4 * 1024 * 1024
+
+_request_ids = itertools.count(1)
+
+
+class RPCError(Exception):
+    def __init__(self, code: int, message: str):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+
+
+def make_request(method: str, params: Optional[dict] = None, notification: bool = False) -> dict:
+    request = {'jsonrpc': '2.0', 'method': method, 'params': params or {}}
+    if not notification:
+        request['id'] = next(_request_ids)
+    return request
+
+
+def make_result(request_id: Any, result: Any) -> dict:
+    return {'jsonrpc': '2.0', 'id': request_id, 'result': result}
+
+
+def make_error(request_id: Any, code: int, message: str) -> dict:
+    return {'jsonrpc': '2.0', 'id': request_id, 'error': {'code': code, 'message': message}}
+
+
+def encode(message: dict) -> bytes:
+    return json.dumps(message, separators=(',', ':')).encode('utf-8') + b'\n'
+
+
+def decode(line: bytes) -> dict:
+    try:
+        message = json.loads(line)
+    except ValueError as e:
+        raise RPCError(PARSE_ERROR, f"Invalid JSON: {e}")
+    if not isinstance(message, dict):
+        raise RPCError(INVALID_REQUEST, "Message is not an object")
+    return message
+
+
+def unwrap(response: dict) -> Any:
+    if 'error' in response:
+        raise RPCError(response['error'].get('code', INTERNAL_ERROR), response['error'].get('message', ''))
+    return response.get('result')
+
+
+def parse_address(address: str) -> Tuple[str, int]:
+    host, _, port = address.rpartition(':')
+    return host, int(port)
+
+
+def call(address: Tuple[str, int], method: str, params: Optional[dict] = None, timeout: float = 10.0) -> Any:
+    """Blocking single request over a new connection, used by the server side to talk to the hub"""
+    request = make_request(method, params)
+    with socket.create_connection(address, timeout=timeout) as connection:
+        connection.sendall(encode(request))
+        with connection.makefile('rb') as stream:
+            line = stream.readline(STREAM_LIMIT)
+    if not line:
+        raise RPCError(AGENT_NOT_CONNECTED, f"No response from {address[0]}:{address[1]}")
+    return unwrap(decode(line))
+
+
+class Connection(object):
+    """
+    A connection where both ends can make requests of the other, responses are matched to requests by id.
+    Incoming requests are passed to handler(method, params) and its return value, or RPCError, is sent back.
+    """
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                 handler: Callable[[str, dict], Awaitable[Any]]):
+        self.reader = reader
+        self.writer = writer
+        self.handler = handler
+        self.pending: Dict[Any, asyncio.Future] = {}
+        self.write_lock = asyncio.Lock()
+        self.closed = False
+
+    @property
+    def peer(self) -> str:
+        peer = self.writer.get_extra_info('peername')
+        return f"{peer[0]}:{peer[1]}" if peer else "unknown"
+
+    async def serve(self) -> None:
+        try:
+            while True:
+                line = await self.reader.readline()
+                if not line:
+                    break
+                try:
+                    message = decode(line)
+                except RPCError as e:
+                    await self.send(make_error(None, e.code, e.message))
+                    continue
+                if 'method' in message:
+                    asyncio.ensure_future(self.handle(message))
+                else:
+                    future = self.pending.pop(message.get('id'), None)
+                    if future is not None and not future.done():
+                        future.set_result(message)
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError) as e:
+            logger.warning(f"Connection to {self.peer} lost: {e}")
+        finally:
+            self.close()
+
+    async def handle(self, message: dict) -> None:
+        request_id = message.get('id')
+        try:
+            result = await self.handler(message['method'], message.get('params') or {})
+            response = make_result(request_id, result)
+        except RPCError as e:
+            response = make_error(request_id, e.code, e.message)
+        except TypeError as e:
+            response = make_error(request_id, INVALID_PARAMS, str(e))
+        except Exception as e:
+            logger.exception(f"Error handling {message['method']} from {self.peer}")
+            response = make_error(request_id, INTERNAL_ERROR, repr(e))
+        if request_id is not None:
+            await self.send(response)
+
+    async def call(self, method: str, params: Optional[dict] = None, timeout: Optional[float] = None) -> Any:
+        if self.closed:
+            raise RPCError(AGENT_NOT_CONNECTED, f"Connection to {self.peer} is closed")
+        request = make_request(method, params)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request['id']] = future
+        try:
+            await self.send(request)
+            response = await asyncio.wait_for(future, timeout=timeout)
+        except asyncio.TimeoutError:
+            raise RPCError(INTERNAL_ERROR, f"Timed out waiting for {method} from {self.peer}")
+        finally:
+            self.pending.pop(request['id'], None)
+        return unwrap(response)
+
+    async def notify(self, method: str, params: Optional[dict] = None) -> None:
+        await self.send(make_request(method, params, notification=True))
+
+    async def send(self, message: dict) -> None:
+        async with self.write_lock:
+            self.writer.write(encode(message))
+            await self.writer.drain()
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(RPCError(AGENT_NOT_CONNECTED, f"Connection to {self.peer} closed"))
+        self.pending.clear()
+        self.writer.close()
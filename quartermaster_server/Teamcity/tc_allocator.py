@@ -7,7 +7,7 @@ from requests import Response
 from Teamcity.config import TEAMCITY_HOST, TEAMCITY, TEAMCITY_BLOCKED_JOB_PREFIX, TEAMCITY_USER
 from Teamcity.models import TeamCityPool
 from data.models import Resource
-from quartermaster.allocator import make_reservation, release_reservation
+from quartermaster.allocator import claim_any, release_reservation
 
 logger = logging.getLogger(__name__)
 
@@ -52,23 +52,22 @@ def teamcity_make_reservation(tc_pool: TeamCityPool, job_id: int):
     if suitable_resources_qs.filter(used_for=used_for, user=TEAMCITY_USER).exists():
         return
 
-    selected_resource = suitable_resources_qs.filter(user=None).first()
+    # Other pollers may be reserving from the same pool, claim_any() hands each of them a different resource
+    selected_resource = claim_any(suitable_resources_qs, user=TEAMCITY_USER, used_for=used_for)
 
     if selected_resource is None:  # No resources available
         logger.warning(f"Could not find unused tc_name={tc_pool.name} resource_pool={tc_pool.pool.name} resource for "
                        f"build {job_id}")
         return
 
-    # We have everything we need, let make a reservation
-
-    # Note: Race condition as this data could be updated before reinserting it
-    teamcity_data = teamcity_request(f'{tc_pool.shared_resource_url}/properties/quota').json()
-    current_quota = int(teamcity_data['value'])
-    teamcity_data['value'] = current_quota + 1
-
-    logger.info(f"Reserving {tc_pool.name} for build {job_id}, new quota is {teamcity_data['value']}")
-    make_reservation(resource=selected_resource, user=TEAMCITY_USER, used_for=used_for)
     try:
+        # Note: Race condition as this data could be updated before reinserting it
+        teamcity_data = teamcity_request(f'{tc_pool.shared_resource_url}/properties/quota').json()
+        current_quota = int(teamcity_data['value'])
+        teamcity_data['value'] = current_quota + 1
+
+        logger.info(f"Reserved {selected_resource} for build {job_id}, new {tc_pool.name} quota is "
+                    f"{teamcity_data['value']}")
         teamcity_request(f'{tc_pool.shared_resource_url}/properties/quota', data=json.dumps(teamcity_data))
     except IOError as e:
         logger.error(f"Error incrementing quota for {tc_pool.name}, "
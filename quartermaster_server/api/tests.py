@@ -1,11 +1,17 @@
 import json
+from unittest.mock import patch
 
 from django.contrib.auth.models import User
+from django.db import connection
 from django.test import TestCase, RequestFactory
+from django.test.utils import CaptureQueriesContext
 # Create your tests here.
 from django.urls import reverse
+from django.utils.timezone import now
 
-from data.models import Pool, Resource, Device
+from USB_Quartermaster_common import host_gates
+from data.models import Pool, Resource, Device, RemoteHost, ReservationRequest
+from quartermaster.allocator import finish_reservation, release_reservation, grant_waiting_requests
 
 
 class TestViews(TestCase):
@@ -24,3 +30,188 @@ class TestViews(TestCase):
         cls.rf = RequestFactory()
 
         super().setUpClass()
+
+
+class APITestCase(TestCase):
+    """Logs the client in as a fresh user with an empty pool to reserve from"""
+    # Staff can do things like jumping the reservation queue, tests of what everyone else sees turn this off
+    superuser = True
+
+    def setUp(self):
+        if self.superuser:
+            self.user = User.objects.create_superuser(username="TEST_USER_API", email="not_real@example.com",
+                                                      password="lolSecret")
+        else:
+            self.user = User.objects.create_user(username="TEST_USER_API", password="lolSecret")
+        self.pool = Pool.objects.create(name='TEST_POOL_API')
+        self.client.force_login(self.user)
+
+
+class TestReservationQueries(APITestCase):
+    """Serializing a reservation must not go back to the database for every device in it"""
+
+    def setUp(self):
+        super().setUp()
+        self.resource = Resource.objects.create(pool=self.pool, name="RESOURCE_1_API", user=self.user,
+                                                last_reserved=now(), last_check_in=now())
+        self.num_devices = 0
+
+    def add_devices(self, count: int):
+        for _ in range(0, count):
+            host = RemoteHost.objects.create(address=f"host{self.num_devices}.example.com", communicator='SSH',
+                                             type='Linux_AMD64', config_json='{}')
+            Device.objects.create(resource=self.resource, host=host, driver='USB_Quartermaster_VirtualHere',
+                                  config_json='{"device_address": "device_address"}',
+                                  name=f"DeviceAPI{self.num_devices}")
+            self.num_devices += 1
+
+    def count_reservation_queries(self) -> int:
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('api:show_reservation', kwargs={'resource_pk': self.resource.pk}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['devices']), self.num_devices)
+        return len(queries)
+
+    def test_reservation_queries_do_not_grow_with_devices(self):
+        self.add_devices(1)
+        few = self.count_reservation_queries()
+        self.add_devices(5)
+        self.assertEqual(self.count_reservation_queries(), few)
+
+
+class TestAsyncReservation(APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.resource = Resource.objects.create(pool=self.pool, name="RESOURCE_1_API")
+        self.url = reverse('api:show_reservation', kwargs={'resource_pk': self.resource.pk})
+
+    def test_async_reservation(self):
+        with patch('quartermaster.allocator.for_all_devices') as for_all_devices:
+            response = self.client.post(self.url + '?async=true', {'used_for': 'TEST'})
+            self.assertEqual(response.status_code, 202)
+            self.assertEqual(response.data['provisioning_state'], Resource.PROVISIONING_PENDING)
+            self.assertEqual(for_all_devices.call_count, 0)
+
+            response = self.client.get(self.url)
+            self.assertEqual(response.data['provisioning_state'], Resource.PROVISIONING_PENDING)
+
+            # What the task does once it runs
+            finish_reservation(self.resource.pk, response.data['use_password'])
+            self.assertEqual(for_all_devices.call_count, 1)
+
+        response = self.client.get(self.url + '?wait=5')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['provisioning_state'], Resource.PROVISIONING_READY)
+
+    def test_wait_must_be_a_number(self):
+        with patch('quartermaster.allocator.for_all_devices'):
+            self.client.post(self.url, {'used_for': 'TEST'})
+        response = self.client.get(self.url + '?wait=soon')
+        self.assertEqual(response.status_code, 400)
+
+
+class TestPoolReservation(APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        for x in range(0, 2):
+            Resource.objects.create(pool=self.pool, name=f"RESOURCE_{x}_API")
+        self.url = reverse('api:reserve_from_pool', kwargs={'pool_pk': self.pool.pk})
+
+    def test_reserve_from_pool(self):
+        with patch('quartermaster.allocator.for_all_devices'):
+            reserved = set()
+            for _ in range(0, 2):
+                response = self.client.post(self.url, {'used_for': 'TEST'})
+                self.assertEqual(response.status_code, 201)
+                reserved.add(response.data['reservation_url'])
+            self.assertEqual(len(reserved), 2)
+
+            response = self.client.post(self.url, {'used_for': 'TEST'})
+            self.assertEqual(response.status_code, 409)
+        self.assertEqual(Resource.objects.filter(user=self.user).count(), 2)
+
+    def test_unknown_strategy(self):
+        response = self.client.post(self.url, {'used_for': 'TEST', 'strategy': 'random'})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(Resource.objects.filter(user=self.user).count(), 0)
+
+    def test_unknown_pool(self):
+        response = self.client.post(reverse('api:reserve_from_pool', kwargs={'pool_pk': 'MISSING'}))
+        self.assertEqual(response.status_code, 404)
+
+
+class TestReservationQueue(APITestCase):
+    superuser = False
+
+    def setUp(self):
+        super().setUp()
+        self.other_user = User.objects.create_user(username="TEST_USER_API2", password="lolSecret")
+        self.resource = Resource.objects.create(pool=self.pool, name="RESOURCE_1_API", user=self.other_user,
+                                                last_reserved=now(), last_check_in=now())
+        self.url = reverse('api:reserve_from_pool', kwargs={'pool_pk': self.pool.pk})
+
+    def test_wait_in_line(self):
+        response = self.client.post(self.url + '?queue=true', {'used_for': 'TEST', 'priority': 100})
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.data['state'], ReservationRequest.WAITING)
+        self.assertEqual(response.data['position'], 0)
+        # Only staff can set a priority
+        self.assertEqual(response.data['priority'], 0)
+        request_url = reverse('api:show_reservation_request', kwargs={'request_pk': response.data['id']})
+
+        response = self.client.get(request_url + '?wait=0.1')
+        self.assertEqual(response.data['state'], ReservationRequest.WAITING)
+        self.assertIsNone(response.data['reservation'])
+
+        with patch('quartermaster.allocator.for_all_devices'):
+            release_reservation(self.resource)
+            # What the task started on release does
+            grant_waiting_requests(self.pool.pk)
+
+        response = self.client.get(request_url + '?wait=5')
+        self.assertEqual(response.data['state'], ReservationRequest.GRANTED)
+        self.assertEqual(response.data['position'], None)
+        self.assertEqual(response.data['reservation']['user'], self.user.pk)
+
+    def test_without_queue_busy_pool_conflicts(self):
+        response = self.client.post(self.url, {'used_for': 'TEST'})
+        self.assertEqual(response.status_code, 409)
+        self.assertFalse(ReservationRequest.objects.exists())
+
+    def test_cancel(self):
+        response = self.client.post(self.url + '?queue=true', {'used_for': 'TEST'})
+        request_url = reverse('api:show_reservation_request', kwargs={'request_pk': response.data['id']})
+        self.assertEqual(self.client.delete(request_url).status_code, 204)
+        self.assertEqual(ReservationRequest.objects.get().state, ReservationRequest.CANCELLED)
+
+    def test_requests_are_private(self):
+        response = self.client.post(self.url + '?queue=true', {'used_for': 'TEST'})
+        request_url = reverse('api:show_reservation_request', kwargs={'request_pk': response.data['id']})
+        self.client.force_login(self.other_user)
+        self.assertEqual(self.client.get(request_url).status_code, 404)
+
+
+class TestHostQueues(TestCase):
+    def setUp(self):
+        host_gates.clear()
+        self.url = reverse('api:show_host_queues')
+
+    def tearDown(self):
+        host_gates.clear()
+
+    def test_admin_only(self):
+        user = User.objects.create_user(username="TEST_USER_API", password="lolSecret")
+        self.client.force_login(user)
+        self.assertEqual(self.client.get(self.url).status_code, 403)
+
+    def test_shows_process_queues(self):
+        user = User.objects.create_superuser(username="TEST_USER_API", email="not_real@example.com",
+                                             password="lolSecret")
+        self.client.force_login(user)
+        with host_gates.get(7, 'host7', limit=2).slot():
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['hosts'][7]['limit'], 2)
+        self.assertEqual(response.data['hosts'][7]['active'], 1)
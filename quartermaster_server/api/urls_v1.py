@@ -15,7 +15,8 @@ Including another URLconf
 """
 from django.urls import path
 
-from api.views import ResourceView, ReservationDjangoAuthView, ReservationResourcePasswordView
+from api.views import ResourceView, ReservationDjangoAuthView, ReservationResourcePasswordView, PoolReservationView, \
+    ReservationRequestView, HostQueuesView
 
 urlpatterns = [
 
@@ -23,5 +24,8 @@ urlpatterns = [
     path("resource/<str:resource_pk>/reservation",
          ReservationDjangoAuthView.as_view(), name='show_reservation'),
     path("resource/<str:resource_pk>/reservation/<str:resource_password>",
-         ReservationResourcePasswordView.as_view(), name='show_reservation_with_password')
+         ReservationResourcePasswordView.as_view(), name='show_reservation_with_password'),
+    path("pool/<str:pool_pk>/reservation", PoolReservationView.as_view(), name='reserve_from_pool'),
+    path("reservation_request/<int:request_pk>", ReservationRequestView.as_view(), name='show_reservation_request'),
+    path("status/host_queues", HostQueuesView.as_view(), name='show_host_queues'),
 ]
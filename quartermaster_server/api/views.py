@@ -1,13 +1,22 @@
 # Create your views here.
+import os
+import time
+from typing import Callable
 
 from django.conf import settings
+from django.db import transaction
 from django.http import JsonResponse
 from django.urls import reverse
-from rest_framework import serializers, generics, status, permissions, authentication
+from django.utils.timezone import now
+from rest_framework import serializers, generics, status, permissions, authentication, views
 from rest_framework.response import Response
 
-from data.models import Resource, Device
-from quartermaster.allocator import make_reservation, release_reservation, refresh_reservation
+from USB_Quartermaster_common import host_gates
+from data.models import Resource, Device, Pool, ReservationRequest
+from data.tasks import provision_reservation, serve_reservation_queue
+from quartermaster import placement
+from quartermaster.allocator import make_reservation, release_reservation, refresh_reservation, ResourceUnavailable, \
+    start_reservation, claim_any, request_reservation
 
 
 class ReservationSerializer(serializers.ModelSerializer):
@@ -17,22 +26,56 @@ class ReservationSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Resource
-        fields = ['user', 'used_for', 'use_password', 'devices', 'reservation_url', 'reservation_expiration']
+        fields = ['user', 'used_for', 'use_password', 'devices', 'reservation_url', 'reservation_expiration',
+                  'provisioning_state', 'provisioning_error']
 
     def get_reservation_url(self, resource_pk):
         return settings.SERVER_BASE_URL + reverse('api:show_reservation', kwargs={"resource_pk": self.instance.pk})
 
     def get_devices(self, resource_pk):
         devices = []
+        device_qs = self.instance.device_set.all()
+        if 'device_set' not in getattr(self.instance, '_prefetched_objects_cache', {}):
+            # refresh_from_db() drops what with_devices() loaded
+            device_qs = device_qs.select_related('host')
         device: Device  # Type hint for the loop
-        for device in self.instance.device_set.all():
+        for device in device_qs:
             devices.append(
                 {**device.config, 'host_address': device.host.address, 'driver': device.driver, 'name': str(device)})
         return devices
 
 
+def wants_async(request) -> bool:
+    """Clients opt in to having devices shared by a task with ?async=true"""
+    return request.query_params.get('async', '').lower() in ('1', 'true')
+
+
+def provision_in_background(resource: Resource) -> None:
+    # The client follows provisioning_state with GET ?wait=<seconds>
+    resource_pk, use_password = resource.pk, resource.use_password
+    transaction.on_commit(lambda: provision_reservation(resource_pk, use_password))
+
+
+def long_poll(request, waiting: Callable[[], bool], refresh: Callable[[], None]) -> None:
+    """
+    With ?wait=<seconds> keep refreshing while `waiting` is true, for at most that long or RESERVATION_WAIT_MAX.
+    This lets clients be told about a change as it happens instead of retrying blindly.
+
+    The request holds its worker for the whole wait and makes a query each RESERVATION_WAIT_INTERVAL, so every
+    waiting client costs a worker of the web server, that is why the wait is capped.
+    """
+    try:
+        wait = float(request.query_params.get('wait', 0))
+    except ValueError:
+        raise serializers.ValidationError({'wait': "Must be a number of seconds"})
+    deadline = time.monotonic() + min(wait, settings.RESERVATION_WAIT_MAX.total_seconds())
+    while waiting() and time.monotonic() < deadline:
+        time.sleep(settings.RESERVATION_WAIT_INTERVAL.total_seconds())
+        refresh()
+
+
 class ReservationView(generics.GenericAPIView):
-    queryset = Resource.objects.all()
+    queryset = Resource.objects.with_devices()
     serializer_class = ReservationSerializer
     lookup_url_kwarg = 'resource_pk'
     resource: Resource
@@ -45,7 +88,18 @@ class ReservationView(generics.GenericAPIView):
     def post(self, request, *args, **kwargs):
         serializer = self.get_serializer(self.resource)
         if self.resource.user is None:
-            make_reservation(self.resource, user=request.user, used_for=request.data.get('used_for', 'API User'))
+            if not self.resource.hosts_available:
+                return JsonResponse({"message": "A host of the resource is currently unreachable"},
+                                    status=status.HTTP_503_SERVICE_UNAVAILABLE)
+            asynchronous = wants_async(request)
+            reserve = start_reservation if asynchronous else make_reservation
+            try:
+                reserve(self.resource, request.user, request.data.get('used_for', 'API User'))
+            except ResourceUnavailable as e:
+                return JsonResponse({"message": str(e)}, status=status.HTTP_409_CONFLICT)
+            if asynchronous:
+                provision_in_background(self.resource)
+                return Response(serializer.data, status=status.HTTP_202_ACCEPTED)
             return Response(serializer.data, status=status.HTTP_201_CREATED)
         elif self.resource.user == request.user:
             return Response(serializer.data)
@@ -57,12 +111,19 @@ class ReservationView(generics.GenericAPIView):
         if self.resource.user is None:
             return Response(status=status.HTTP_404_NOT_FOUND)
         elif self.resource.user == request.user:
+            self.wait_for_provisioning()
             serializer = self.get_serializer(self.resource)
             return Response(serializer.data)
         else:
             return JsonResponse({"message": f"The resource in use by another user, {self.resource.user.username}"},
                                 status=403)
 
+    def wait_for_provisioning(self) -> None:
+        """With ?wait=<seconds> hold the response until a pending reservation is ready or failed, or time is up"""
+        long_poll(self.request,
+                  waiting=lambda: self.resource.provisioning_state == Resource.PROVISIONING_PENDING,
+                  refresh=lambda: self.resource.refresh_from_db(fields=['provisioning_state', 'provisioning_error']))
+
     def delete(self, request, *args, **kwargs):
         release_reservation(self.resource)
         self.resource.refresh_from_db()
@@ -89,6 +150,98 @@ class ReservationDjangoAuthView(ReservationView):
     pass
 
 
+class PoolReservationView(generics.GenericAPIView):
+    """
+    Reserve whichever free resource of a pool the placement strategy picks, rather than clients racing each other
+    for the same one. The response is the reservation, including its url, as for a single resource.
+    """
+    queryset = Pool.objects.all()
+    serializer_class = ReservationSerializer
+    lookup_url_kwarg = 'pool_pk'
+    permission_classes = [permissions.IsAuthenticated]
+
+    def post(self, request, *args, **kwargs):
+        pool: Pool = self.get_object()
+        strategy = request.data.get('strategy')
+        try:
+            placement.get_strategy(strategy)
+        except ValueError as e:
+            return JsonResponse({"message": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        asynchronous = wants_async(request)
+        resource = claim_any(Resource.objects.filter(pool=pool), request.user,
+                             used_for=request.data.get('used_for', 'API User'), strategy=strategy,
+                             reserve=start_reservation if asynchronous else make_reservation)
+        if resource is None:
+            if request.query_params.get('queue', '').lower() in ('1', 'true'):
+                return self.join_queue(pool)
+            return JsonResponse({"message": f"No resource in pool {pool.pk} is free"}, status=status.HTTP_409_CONFLICT)
+        serializer = self.get_serializer(resource)
+        if asynchronous:
+            provision_in_background(resource)
+            return Response(serializer.data, status=status.HTTP_202_ACCEPTED)
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+
+    def join_queue(self, pool: Pool) -> Response:
+        """Wait in line for the next free resource, the client follows the request with GET ?wait=<seconds>"""
+        # Only staff may jump the line
+        try:
+            priority = int(self.request.data.get('priority', 0)) if self.request.user.is_staff else 0
+        except ValueError:
+            raise serializers.ValidationError({'priority': "Must be a whole number"})
+        reservation_request = request_reservation(pool, self.request.user,
+                                                  used_for=self.request.data.get('used_for', 'API User'),
+                                                  priority=priority)
+        # A resource may have been released between looking for one and joining the line
+        transaction.on_commit(lambda: serve_reservation_queue(pool.pk))
+        serializer = ReservationRequestSerializer(reservation_request)
+        return Response(serializer.data, status=status.HTTP_202_ACCEPTED)
+
+
+class ReservationRequestSerializer(serializers.ModelSerializer):
+    position = serializers.IntegerField(read_only=True)
+    request_url = serializers.SerializerMethodField()
+    reservation = serializers.SerializerMethodField()
+
+    class Meta:
+        model = ReservationRequest
+        fields = ['id', 'pool', 'used_for', 'priority', 'state', 'position', 'created_at', 'granted_at',
+                  'request_url', 'reservation']
+
+    def get_request_url(self, reservation_request: ReservationRequest):
+        return settings.SERVER_BASE_URL + reverse('api:show_reservation_request',
+                                                  kwargs={"request_pk": reservation_request.pk})
+
+    def get_reservation(self, reservation_request: ReservationRequest):
+        if reservation_request.state != ReservationRequest.GRANTED or reservation_request.resource is None:
+            return None
+        return ReservationSerializer(reservation_request.resource).data
+
+
+class ReservationRequestView(generics.GenericAPIView):
+    """A place in line for a pool's resources, once granted it includes the reservation that was made"""
+    serializer_class = ReservationRequestSerializer
+    lookup_url_kwarg = 'request_pk'
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get_queryset(self):
+        return ReservationRequest.objects.filter(user=self.request.user)
+
+    def get(self, request, *args, **kwargs):
+        reservation_request: ReservationRequest = self.get_object()
+        long_poll(request,
+                  waiting=lambda: reservation_request.state == ReservationRequest.WAITING,
+                  refresh=lambda: reservation_request.refresh_from_db())
+        # Asking about the request is what keeps it in line
+        ReservationRequest.objects.filter(pk=reservation_request.pk).update(last_seen_at=now())
+        return Response(self.get_serializer(reservation_request).data)
+
+    def delete(self, request, *args, **kwargs):
+        reservation_request: ReservationRequest = self.get_object()
+        ReservationRequest.objects.filter(pk=reservation_request.pk, state=ReservationRequest.WAITING) \
+            .update(state=ReservationRequest.CANCELLED)
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
 class ResourceAuthentication(authentication.BaseAuthentication):
     """
     This allows the use of resources passwords to authenticate.
@@ -99,7 +252,7 @@ class ResourceAuthentication(authentication.BaseAuthentication):
     def authenticate(self, request):
         resource_pk = request.parser_context['kwargs']['resource_pk']
         resource_password = request.parser_context['kwargs']['resource_password']
-        resource = Resource.objects.get(pk=resource_pk)
+        resource = Resource.objects.select_related('user').get(pk=resource_pk)
 
         if resource.user is None:
             return None
@@ -132,3 +285,14 @@ class ResourceView(generics.RetrieveAPIView):
     queryset = Resource.objects.all()
     serializer_class = ResourceSerializer
     lookup_url_kwarg = 'resource_pk'
+
+
+class HostQueuesView(views.APIView):
+    """
+    Command queue statistics of each host this process has run commands on. The queues are kept per process, this
+    is the web server process that answered, the task workers log theirs with data.tasks.report_host_queues.
+    """
+    permission_classes = [permissions.IsAdminUser]
+
+    def get(self, request, *args, **kwargs):
+        return Response({'pid': os.getpid(), 'hosts': host_gates.stats()})
@@ -3,3 +3,8 @@ from django.apps import AppConfig
 
 class DataConfig(AppConfig):
     name = 'data'
+
+    def ready(self):
+        # Connects the receivers that hand released resources to waiting reservation requests and drop the poll
+        # digests of deleted hosts
+        from data import tasks  # noqa: F401
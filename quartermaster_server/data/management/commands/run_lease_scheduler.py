@@ -0,0 +1,47 @@
+import logging
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DatabaseError, close_old_connections
+from django.utils.timezone import now
+from redis.exceptions import RedisError
+
+from quartermaster.allocator import release_due_leases
+from quartermaster.leases import get_lease_scheduler, schedule_all
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Release reservations within seconds of their leases expiring instead of at the next once a minute sweep"
+
+    def handle(self, *args, **options):
+        scheduler = get_lease_scheduler()
+        if scheduler is None:
+            raise CommandError("Huey is not using Redis, there is nowhere to keep the lease schedule")
+        logger.info(f"Scheduled {schedule_all(scheduler)} current reservation leases")
+
+        poll_interval = settings.RESERVATION_LEASE_POLL_INTERVAL.total_seconds()
+        while True:
+            # This runs for as long as the process, drop connections the database closed or that are past
+            # CONN_MAX_AGE the way a request would
+            close_old_connections()
+            try:
+                released = release_due_leases(scheduler)
+                if released:
+                    logger.info(f"Released expired reservations of {', '.join(released)}")
+                next_due = scheduler.next_due()
+            except RedisError as e:
+                logger.warning(f"Lease schedule unavailable, retrying: {e}")
+                next_due = None
+            except DatabaseError as e:
+                logger.warning(f"Database unavailable, retrying: {e}")
+                next_due = None
+            except Exception:
+                # The once a minute sweep is the fallback for whatever lease this failed on, keep serving the rest
+                logger.exception("Releasing due leases failed, retrying")
+                next_due = None
+            # Sleep until the next lease is due, but wake regularly to pick up leases that were added meanwhile
+            delay = poll_interval if next_due is None else (next_due - now()).total_seconds()
+            time.sleep(min(max(delay, 0.0), poll_interval))
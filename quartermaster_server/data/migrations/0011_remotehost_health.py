@@ -0,0 +1,28 @@
+# Generated by Django 3.0.4 on 2026-10-17 10:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data', '0010_remotehost_type'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='remotehost',
+            name='health_failures',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='remotehost',
+            name='health_retry_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='remotehost',
+            name='health_state',
+            field=models.CharField(choices=[('closed', 'Reachable'), ('open', 'Unreachable'), ('half_open', 'Retrying')], default='closed', editable=False, max_length=10),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 3.0.4 on 2026-10-17 14:02
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+
+def count_offline_devices(apps, schema_editor):
+    Resource = apps.get_model('data', 'Resource')
+    Device = apps.get_model('data', 'Device')
+    offline = Device.objects.filter(resource=OuterRef('pk'), online=False).order_by() \
+        .values('resource').annotate(count=Count('pk')).values('count')
+    Resource.objects.update(offline_device_count=Coalesce(Subquery(offline), Value(0)))
+    Resource.objects.exclude(enabled=True, offline_device_count=0).update(is_available=False)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data', '0011_remotehost_health'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='resource',
+            name='is_available',
+            field=models.BooleanField(default=True, editable=False),
+        ),
+        migrations.AddField(
+            model_name='resource',
+            name='offline_device_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(count_offline_devices, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='resource',
+            index=models.Index(condition=models.Q(is_available=True), fields=['pool'], name='resource_available_idx'),
+        ),
+    ]
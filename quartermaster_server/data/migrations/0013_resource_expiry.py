@@ -0,0 +1,34 @@
+# Generated by Django 3.0.4 on 2026-10-17 15:21
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def set_expiry(apps, schema_editor):
+    Resource = apps.get_model('data', 'Resource')
+    for resource in Resource.objects.filter(last_check_in__isnull=False).iterator():
+        resource.checkin_expires_at = resource.last_check_in + settings.RESERVATION_CHECKIN_TIMEOUT_MINUTES
+        if resource.last_reserved is not None:
+            resource.reservation_expires_at = resource.last_reserved + settings.RESERVATION_MAX_MINUTES
+        resource.save(update_fields=['checkin_expires_at', 'reservation_expires_at'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data', '0012_resource_availability'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='resource',
+            name='checkin_expires_at',
+            field=models.DateTimeField(blank=True, db_index=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='resource',
+            name='reservation_expires_at',
+            field=models.DateTimeField(blank=True, db_index=True, editable=False, null=True),
+        ),
+        migrations.RunPython(set_expiry, migrations.RunPython.noop),
+    ]
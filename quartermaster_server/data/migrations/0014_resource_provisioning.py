@@ -0,0 +1,24 @@
+# Generated by Django 3.0.4 on 2026-10-17 16:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data', '0013_resource_expiry'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='resource',
+            name='provisioning_error',
+            field=models.TextField(blank=True, default='', editable=False),
+        ),
+        migrations.AddField(
+            model_name='resource',
+            name='provisioning_state',
+            field=models.CharField(choices=[('pending', 'Pending'), ('ready', 'Ready'), ('failed', 'Failed')],
+                                   default='ready', editable=False, max_length=10),
+        ),
+    ]
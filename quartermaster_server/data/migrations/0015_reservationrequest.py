@@ -0,0 +1,36 @@
+# Generated by Django 3.0.4 on 2026-10-17 16:40
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('data', '0014_resource_provisioning'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReservationRequest',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('used_for', models.CharField(max_length=30)),
+                ('priority', models.IntegerField(default=0, help_text='Requests with a higher priority are served first')),
+                ('state', models.CharField(choices=[('waiting', 'Waiting'), ('granted', 'Granted'), ('cancelled', 'Cancelled'), ('expired', 'Expired')], default='waiting', max_length=10)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('last_seen_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('granted_at', models.DateTimeField(blank=True, null=True)),
+                ('pool', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='data.Pool')),
+                ('resource', models.ForeignKey(blank=True, help_text='The resource reserved for this request once granted', null=True, on_delete=django.db.models.deletion.SET_NULL, to='data.Resource')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='reservationrequest',
+            index=models.Index(condition=models.Q(state='waiting'), fields=['pool', '-priority', 'created_at'], name='request_waiting_idx'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 3.0.4 on 2026-10-17 17:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data', '0015_reservationrequest'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='remotehost',
+            name='last_polled_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='remotehost',
+            name='poll_started_at',
+            field=models.DateTimeField(blank=True, editable=False, help_text='When the poll in progress started, empty when none is', null=True),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 3.0.4 on 2026-10-17 18:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data', '0016_remotehost_poll'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='remotehost',
+            name='next_poll_at',
+            field=models.DateTimeField(blank=True, editable=False, help_text='When the host is due to be polled, empty when it is due now', null=True),
+        ),
+        migrations.AddField(
+            model_name='remotehost',
+            name='poll_interval',
+            field=models.DurationField(blank=True, editable=False, help_text='Time between the last poll and the next', null=True),
+        ),
+        migrations.AddField(
+            model_name='remotehost',
+            name='poll_interval_max',
+            field=models.DurationField(blank=True, help_text='Longest time between polls, used once the host is stable or has been down for a while', null=True),
+        ),
+        migrations.AddField(
+            model_name='remotehost',
+            name='poll_interval_min',
+            field=models.DurationField(blank=True, help_text='Shortest time between polls, used while devices are reserved or changing', null=True),
+        ),
+    ]
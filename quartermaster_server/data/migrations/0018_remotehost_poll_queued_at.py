@@ -0,0 +1,18 @@
+# Generated by Django 3.0.4 on 2026-10-17 21:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data', '0017_remotehost_poll_interval'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='remotehost',
+            name='poll_queued_at',
+            field=models.DateTimeField(blank=True, editable=False, help_text='When a poll of the host was queued, empty once it has started', null=True),
+        ),
+    ]
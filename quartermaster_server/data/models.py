@@ -1,35 +1,56 @@
 import json
-from datetime import datetime
-from typing import List, Type, Tuple
+import logging
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import List, Type, Tuple, Optional
 
 from django.conf import settings
 from django.contrib import admin
 from django.core.exceptions import ValidationError
-from django.db import models
+from django.db import models, transaction
 # Create your models here.
-from django.db.models import Q, Count
+from django.db.models import Q, Count, F, OuterRef, Subquery, QuerySet, Value, Prefetch
+from django.db.models.functions import Coalesce
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
 from django.forms import Textarea
 from django.utils.functional import lazy
+from django.utils.timezone import now
 
-from USB_Quartermaster_common import AbstractShareableDeviceDriver, AbstractCommunicator, plugins
+from USB_Quartermaster_common import AbstractShareableDeviceDriver, AbstractCommunicator, HostHealth, plugins, \
+    DeviceTransition
+from data.signals import device_states_changed
 from quartermaster.helpers import get_driver_obj, get_communicator_obj, get_communicator_class
 
+logger = logging.getLogger(__name__)
+
 
 class ConfigJSON(object):
+    """
+    The parsed config is kept on the instance along with the config_json it came from and reused until config_json
+    changes, whether through set_config(), a form or refresh_from_db(). Treat it as read only, use set_config().
+    """
+
+    _parsed_config: Tuple[str, dict] = None
 
     @property
-    def config(self):
-        return json.loads(self.config_json, strict=False)  # strict=False is there to allow use of \n in json values
+    def config(self) -> dict:
+        parsed = self._parsed_config
+        if parsed is not None and parsed[0] == self.config_json:
+            return parsed[1]
+        config = json.loads(self.config_json, strict=False)  # strict=False is there to allow use of \n in json values
+        self._parsed_config = (self.config_json, config)
+        return config
 
     def set_config(self, config: dict):
         self.config_json = json.dumps(config)
+        self._parsed_config = None
 
     def validate_configuration_json(self, keys: List[str]) -> List[str]:
         # TODO: Handle nested keys
         errors_found = []
         try:
-            data = json.loads(self.config_json, strict=False)
-            data_keys = set(data.keys())
+            data_keys = set(self.config.keys())
             required_keys = set(keys)
             missing_keys = required_keys - data_keys
             for key in missing_keys:
@@ -50,10 +71,19 @@ class Pool(models.Model):
         return self.name
 
 
-class ResourceHideDisabledOfflineManager(models.Manager):
+class ResourceQuerySet(models.QuerySet):
+    def with_devices(self) -> 'ResourceQuerySet':
+        """
+        Load the pool, user and devices, with their hosts, for every resource up front. Listing resources and
+        serializing reservations then take the same number of queries however many rows there are.
+        """
+        return self.select_related('pool', 'user').prefetch_related(
+            Prefetch('device_set', queryset=Device.everything.select_related('host')))
+
+
+class ResourceHideDisabledOfflineManager(models.Manager.from_queryset(ResourceQuerySet)):
     def get_queryset(self):
-        offline_devices = Count('device', filter=Q(device__online=False))
-        return super().get_queryset().annotate(offline_devices=offline_devices).filter(enabled=True, offline_devices=0)
+        return super().get_queryset().filter(is_available=True)
 
 
 class Resource(models.Model):
@@ -61,13 +91,30 @@ class Resource(models.Model):
     A resource is logical collection of usb devices which are treated as a single unit.
     This is the thing a user looks for to attach to their host
     """
+
+    class Meta:
+        indexes = [
+            # Covers the default manager's filter, only a small part of the table is usually available
+            models.Index(fields=['pool'], name='resource_available_idx', condition=Q(is_available=True)),
+        ]
+
     UNUSED = [None, ""]
 
+    PROVISIONING_PENDING = 'pending'
+    PROVISIONING_READY = 'ready'
+    PROVISIONING_FAILED = 'failed'
+    PROVISIONING_STATES = ((PROVISIONING_PENDING, 'Pending'),
+                           (PROVISIONING_READY, 'Ready'),
+                           (PROVISIONING_FAILED, 'Failed'))
+
     pool = models.ForeignKey(Pool, blank=False, null=False, on_delete=models.CASCADE)
     name = models.SlugField(blank=False, null=False, primary_key=True)
     description = models.TextField()
     last_check_in = models.DateTimeField(null=True, blank=True)
     last_reserved = models.DateTimeField(null=True, blank=True)
+    # Derived from last_reserved and last_check_in on save so the expiry sweep can find expired leases by index
+    reservation_expires_at = models.DateTimeField(null=True, blank=True, db_index=True, editable=False)
+    checkin_expires_at = models.DateTimeField(null=True, blank=True, db_index=True, editable=False)
     # Make this required for reservations
     used_for = models.CharField(null=True, blank=True, max_length=30)
     user = models.ForeignKey(settings.AUTH_USER_MODEL, blank=True, null=True, on_delete=models.DO_NOTHING)
@@ -75,23 +122,94 @@ class Resource(models.Model):
     use_password = models.CharField(null=True, blank=True, max_length=30,
                                     help_text="Random password needed to request access to devices in this resource")
     enabled = models.BooleanField(default=True)
+    # Whether the devices of the current reservation have been shared yet, see allocator.start_reservation()
+    provisioning_state = models.CharField(max_length=10, choices=PROVISIONING_STATES, default=PROVISIONING_READY,
+                                          editable=False)
+    provisioning_error = models.TextField(blank=True, default="", editable=False)
+
+    # Kept up to date by Device.save() and deletes so finding available resources doesn't need an aggregate.
+    # is_available is enabled and no devices offline.
+    offline_device_count = models.PositiveIntegerField(default=0, editable=False)
+    is_available = models.BooleanField(default=True, editable=False)
+
+    # These are only ever written with UPDATEs, a save() from an instance loaded earlier must not put back old values
+    COUNTER_FIELDS = ('offline_device_count', 'is_available')
+    UPDATE_ONLY_FIELDS = COUNTER_FIELDS + ('provisioning_state', 'provisioning_error')
 
     # Everything in DB
-    everything = models.Manager()
+    everything = ResourceQuerySet.as_manager()
 
     # By default ignore disabled
     objects = ResourceHideDisabledOfflineManager()
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._loaded_enabled = self.__dict__.get('enabled')
+        self._loaded_pk = self.__dict__.get(self._meta.pk.attname)
+
     def __str__(self):
         return f"{str(self.pool)} / {self.name}"
 
+    def save(self, *args, **kwargs):
+        self.update_expiry()
+        if self._state.adding or self.pk != self._loaded_pk:
+            # New, or renamed in the admin which saves a new row under the new name
+            self.is_available = self.enabled and self.offline_device_count == 0
+        elif kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [field.name for field in self._meta.concrete_fields
+                                       if not field.primary_key and field.name not in self.UPDATE_ONLY_FIELDS]
+        elif {'last_reserved', 'last_check_in'} & set(kwargs['update_fields']):
+            kwargs['update_fields'] = {*kwargs['update_fields'], 'reservation_expires_at', 'checkin_expires_at'}
+        super().save(*args, **kwargs)
+        self._loaded_pk = self.pk
+        if self.enabled != self._loaded_enabled:
+            Resource.refresh_availability(Resource.everything.filter(pk=self.pk))
+            self.is_available = self.enabled and self.offline_device_count == 0
+            self._loaded_enabled = self.enabled
+
+    def update_expiry(self) -> None:
+        if self.last_check_in is None:
+            # Not reserved
+            self.reservation_expires_at = None
+            self.checkin_expires_at = None
+        else:
+            self.reservation_expires_at = self.reservation_expiration if self.last_reserved else None
+            self.checkin_expires_at = self.checkin_expiration
+
+    @classmethod
+    def adjust_offline_device_count(cls, resource_pk, delta: int) -> None:
+        resources = cls.everything.filter(pk=resource_pk)
+        resources.update(offline_device_count=F('offline_device_count') + delta)
+        cls.refresh_availability(resources)
+
+    @staticmethod
+    def refresh_availability(resources: QuerySet) -> None:
+        """Bring is_available in line with enabled and offline_device_count"""
+        resources.filter(is_available=True).exclude(enabled=True, offline_device_count=0).update(is_available=False)
+        resources.filter(is_available=False, enabled=True, offline_device_count=0).update(is_available=True)
+
+    @classmethod
+    def recount_offline_devices(cls, resources: QuerySet) -> None:
+        """Recount from scratch, for changes made with queryset update()s that bypass Device.save()"""
+        offline = Device.everything.filter(resource=OuterRef('pk'), online=False).order_by() \
+            .values('resource').annotate(count=Count('pk')).values('count')
+        resources.update(offline_device_count=Coalesce(Subquery(offline), Value(0)))
+        cls.refresh_availability(resources)
+
     @property
     def in_use(self) -> bool:
         return self.user is not None
 
     @property
     def is_online(self) -> bool:
-        return self.device_set.filter(online=False).count() == 0
+        return self.offline_device_count == 0
+
+    @property
+    def hosts_available(self) -> bool:
+        if 'device_set' in getattr(self, '_prefetched_objects_cache', {}):
+            # Loaded by with_devices(), no need to ask the database again
+            return not any(device.host.health_state == HostHealth.OPEN for device in self.device_set.all())
+        return not self.device_set.filter(host__health_state=HostHealth.OPEN).exists()
 
     # This is the time when the reservation expires when in_use() is True
     @property
@@ -130,6 +248,104 @@ class RemoteHost(models.Model, ConfigJSON):
     type = models.CharField(max_length=20, null=False, blank=False,
                             choices=((sht, sht) for sht in SUPPORTED_HOST_TYPES))
 
+    # Maintained by the communicator's circuit breaker
+    health_state = models.CharField(max_length=10, choices=HostHealth.CHOICES, default=HostHealth.CLOSED,
+                                    editable=False)
+    health_failures = models.PositiveIntegerField(default=0, editable=False)
+    health_retry_at = models.DateTimeField(null=True, blank=True, editable=False)
+
+    # Limits for how often the host is polled, the settings HOST_POLL_MIN_INTERVAL and HOST_POLL_MAX_INTERVAL when empty
+    poll_interval_min = models.DurationField(null=True, blank=True,
+                                             help_text="Shortest time between polls, used while devices are reserved "
+                                                       "or changing")
+    poll_interval_max = models.DurationField(null=True, blank=True,
+                                             help_text="Longest time between polls, used once the host is stable or "
+                                                       "has been down for a while")
+
+    # Maintained by the per host poll task, see data.tasks.update_host_devices()
+    poll_queued_at = models.DateTimeField(null=True, blank=True, editable=False,
+                                          help_text="When a poll of the host was queued, empty once it has started")
+    poll_started_at = models.DateTimeField(null=True, blank=True, editable=False,
+                                           help_text="When the poll in progress started, empty when none is")
+    last_polled_at = models.DateTimeField(null=True, blank=True, editable=False)
+    poll_interval = models.DurationField(null=True, blank=True, editable=False,
+                                         help_text="Time between the last poll and the next")
+    next_poll_at = models.DateTimeField(null=True, blank=True, editable=False,
+                                        help_text="When the host is due to be polled, empty when it is due now")
+
+    # These are only ever written with UPDATEs, a save() from an instance loaded earlier must not put back old values
+    UPDATE_ONLY_FIELDS = ('health_state', 'health_failures', 'health_retry_at',
+                          'poll_queued_at', 'poll_started_at', 'last_polled_at', 'poll_interval', 'next_poll_at')
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [field.name for field in self._meta.concrete_fields
+                                       if not field.primary_key and field.name not in self.UPDATE_ONLY_FIELDS]
+        super().save(*args, **kwargs)
+
+    @classmethod
+    def queue_polls(cls, host_pks: List[int]) -> None:
+        """Mark polls of these hosts as queued so the next poll cycles don't queue them again, see poll_pending()"""
+        cls.objects.filter(pk__in=host_pks).update(poll_queued_at=now())
+
+    def poll_pending(self, current_time: datetime) -> bool:
+        """
+        Whether a poll of the host is queued or running. One that hasn't finished after HOST_POLL_TIMEOUT is taken
+        to have been lost, or to have died with its worker, and no longer holds the host.
+        """
+        stale = current_time - settings.HOST_POLL_TIMEOUT
+        return any(marker is not None and marker >= stale for marker in (self.poll_queued_at, self.poll_started_at))
+
+    @classmethod
+    def start_poll(cls, host_pk: int) -> Optional[datetime]:
+        """
+        Mark the host as being polled, returning when the poll started or None if another poll of it is already in
+        progress. A poll running longer than HOST_POLL_TIMEOUT is taken to have died with its worker and no longer
+        holds the host.
+        """
+        started_at = now()
+        stale = started_at - settings.HOST_POLL_TIMEOUT
+        started = cls.objects.filter(pk=host_pk) \
+            .filter(Q(poll_started_at__isnull=True) | Q(poll_started_at__lt=stale)) \
+            .update(poll_started_at=started_at, poll_queued_at=None)
+        return started_at if started else None
+
+    @classmethod
+    def finish_poll(cls, host_pk: int, started_at: datetime, interval: Optional[timedelta] = None) -> None:
+        """
+        Record the poll that started at `started_at` is over, and schedule the next one `interval` after it started
+        if given. Nothing is changed if the host was taken over by another poll since, that one holds it now.
+        """
+        fields = {'poll_started_at': None, 'last_polled_at': now()}
+        if interval is not None:
+            fields.update(poll_interval=interval, next_poll_at=started_at + interval)
+        cls.objects.filter(pk=host_pk, poll_started_at=started_at).update(**fields)
+
+    @classmethod
+    def poll_soon(cls, resource_pks: List[str]) -> None:
+        """The reservations of these resources just changed, poll their hosts at the shortest interval again"""
+        current_time = now()
+        for host in cls.objects.filter(device__resource__in=resource_pks).distinct() \
+                .only('pk', 'poll_interval_min', 'next_poll_at'):
+            fields = {'poll_interval': None}
+            soon = current_time + host.min_poll_interval
+            if host.next_poll_at is not None and host.next_poll_at > soon:
+                fields['next_poll_at'] = soon
+            cls.objects.filter(pk=host.pk).update(**fields)
+
+    @property
+    def min_poll_interval(self) -> timedelta:
+        return self.poll_interval_min or settings.HOST_POLL_MIN_INTERVAL
+
+    @property
+    def max_poll_interval(self) -> timedelta:
+        return max(self.poll_interval_max or settings.HOST_POLL_MAX_INTERVAL, self.min_poll_interval)
+
+    @property
+    def is_available(self) -> bool:
+        """False while the host is known to be down and not yet due to be retried"""
+        return self.health_state != HostHealth.OPEN
+
     def get_communicator_obj(self) -> AbstractCommunicator:
         return get_communicator_obj(self)
 
@@ -137,6 +353,9 @@ class RemoteHost(models.Model, ConfigJSON):
         return get_communicator_class(self.communicator)
 
     def clean(self):
+        if self.poll_interval_min and self.poll_interval_max and self.poll_interval_min > self.poll_interval_max:
+            raise ValidationError({'poll_interval_max': "Can not be shorter than the shortest poll interval"})
+
         # Check valid driver is used
         communicator_class = self.get_communicator_class()
         errors = self.validate_configuration_json(communicator_class.CONFIGURATION_KEYS)
@@ -175,14 +394,66 @@ class Device(models.Model, ConfigJSON):
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        # What this row currently contributes to its resource's offline_device_count, None if it was loaded with
+        # those fields deferred
+        if 'resource_id' in self.__dict__ and 'online' in self.__dict__:
+            self._counted = (self.resource_id, self.online)
+        else:
+            self._counted = None
 
     def __str__(self):
         return f"{str(self.resource)} / {self.name}@{self.host}"
 
+    def save(self, *args, **kwargs):
+        counted = (None, True) if self._state.adding else self._counted
+        super().save(*args, **kwargs)
+        self.update_offline_count(counted, (self.resource_id, self.online))
+
+    def update_offline_count(self, counted: Optional[Tuple[Optional[str], bool]],
+                             current: Tuple[Optional[str], bool]) -> None:
+        self._counted = current
+        if counted == current:
+            return
+        if counted is None:
+            # We don't know what was counted before, recount the resource we belong to now
+            if current[0] is not None:
+                Resource.recount_offline_devices(Resource.everything.filter(pk=current[0]))
+            return
+        if counted[0] is not None and not counted[1]:
+            Resource.adjust_offline_device_count(counted[0], -1)
+        if current[0] is not None and not current[1]:
+            Resource.adjust_offline_device_count(current[0], 1)
+
     everything = models.Manager()
 
     objects = DeviceHideOfflineManager()
 
+    @classmethod
+    def apply_transitions(cls, host: RemoteHost, transitions: List[DeviceTransition]) -> None:
+        """
+        Save state changes found while polling a host. Devices getting the same new value are written together in a
+        single UPDATE of just that field, then the counters of the resources involved are recounted.
+        """
+        if not transitions:
+            return
+
+        device_ids = defaultdict(list)
+        for transition in transitions:
+            setattr(transition.device, transition.field, transition.new)
+            device_ids[(transition.field, transition.new)].append(transition.device.pk)
+            logger.info(f"Device {transition.device.name} (id={transition.device.pk}) on {host} {transition.field} "
+                        f"changed from {transition.old} to {transition.new}")
+
+        resource_ids = {transition.device.resource_id for transition in transitions} - {None}
+        with transaction.atomic():
+            for (field, value), ids in device_ids.items():
+                cls.everything.filter(pk__in=ids).update(**{field: value})
+            Resource.recount_offline_devices(Resource.everything.filter(pk__in=resource_ids))
+
+        for transition in transitions:
+            transition.device._counted = (transition.device.resource_id, transition.device.online)
+        device_states_changed.send(sender=cls, host=host, transitions=transitions)
+
     @property
     def in_use(self) -> bool:
         return self.resource.in_use
@@ -215,6 +486,67 @@ class Device(models.Model, ConfigJSON):
             raise ValidationError({'config_json': errors_message})
 
 
+@receiver(post_delete, sender=Device)
+def uncount_deleted_device(sender, instance: Device, **kwargs):
+    # A signal rather than Device.delete() so queryset and cascading deletes are counted too
+    instance.update_offline_count(instance._counted, (None, True))
+
+
+class ReservationRequestQuerySet(models.QuerySet):
+    def waiting(self) -> 'ReservationRequestQuerySet':
+        """Requests still in line, first in line first"""
+        return self.filter(state=ReservationRequest.WAITING).order_by('-priority', 'created_at', 'pk')
+
+
+class ReservationRequest(models.Model):
+    """
+    A user waiting for any resource of a pool. When one is released it is handed to the request at the head of the
+    line, highest priority first and in the order they were made within a priority.
+    """
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['pool', '-priority', 'created_at'], name='request_waiting_idx',
+                         condition=Q(state='waiting')),
+        ]
+
+    WAITING = 'waiting'
+    GRANTED = 'granted'
+    CANCELLED = 'cancelled'
+    EXPIRED = 'expired'
+    STATES = ((WAITING, 'Waiting'),
+              (GRANTED, 'Granted'),
+              (CANCELLED, 'Cancelled'),
+              (EXPIRED, 'Expired'))
+
+    pool = models.ForeignKey(Pool, on_delete=models.CASCADE)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
+    used_for = models.CharField(max_length=30)
+    priority = models.IntegerField(default=0, help_text="Requests with a higher priority are served first")
+    state = models.CharField(max_length=10, choices=STATES, default=WAITING)
+    resource = models.ForeignKey(Resource, null=True, blank=True, on_delete=models.SET_NULL,
+                                 help_text="The resource reserved for this request once granted")
+    created_at = models.DateTimeField(auto_now_add=True)
+    # Waiting requests whose client stopped asking about them are dropped, see RESERVATION_QUEUE_TIMEOUT
+    last_seen_at = models.DateTimeField(default=now)
+    granted_at = models.DateTimeField(null=True, blank=True)
+
+    objects = ReservationRequestQuerySet.as_manager()
+
+    def __str__(self):
+        return f"{self.pool_id} for {self.used_for} ({self.state})"
+
+    @property
+    def position(self) -> Optional[int]:
+        """How many requests are ahead of this one, None once it has left the line"""
+        if self.state != self.WAITING:
+            return None
+        return ReservationRequest.objects.waiting().filter(pool_id=self.pool_id).filter(
+            Q(priority__gt=self.priority) |
+            Q(priority=self.priority, created_at__lt=self.created_at) |
+            Q(priority=self.priority, created_at=self.created_at, pk__lt=self.pk)).count()
+
+
 class DeviceInline(admin.TabularInline):
     model = Device
     formfield_overrides = {
@@ -226,6 +558,12 @@ class ResourceAdmin(admin.ModelAdmin):
     inlines = [DeviceInline]
 
 
+class RemoteHostAdmin(admin.ModelAdmin):
+    list_display = ['__str__', 'type', 'health_state', 'last_polled_at', 'poll_interval', 'next_poll_at']
+    readonly_fields = ['health_state', 'health_retry_at', 'last_polled_at', 'poll_interval', 'next_poll_at']
+
+
 admin.site.register(Pool)
 admin.site.register(Resource, ResourceAdmin)
-admin.site.register(RemoteHost)
+admin.site.register(RemoteHost, RemoteHostAdmin)
+admin.site.register(ReservationRequest)
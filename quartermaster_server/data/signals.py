@@ -0,0 +1,9 @@
+from django.dispatch import Signal
+
+# Sent after device state changes found by polling a host have been saved. Receivers get `host`, the RemoteHost, and
+# `transitions`, a list of USB_Quartermaster_common.DeviceTransition whose devices already hold the new values.
+device_states_changed = Signal()
+
+# Sent after reservations have been released. Receivers get `pools`, the primary keys of the pools the released
+# resources belong to.
+resources_released = Signal()
@@ -1,12 +1,23 @@
 import logging
+import time
+from datetime import timedelta
+from typing import List, NamedTuple
 
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
 from django.utils.timezone import now
 from huey import crontab
 from huey.contrib.djhuey import lock_task, db_periodic_task, db_task
 
-from data.models import Resource, RemoteHost
-from quartermaster import plugins
-from quartermaster.allocator import release_reservation
+from USB_Quartermaster_common import USB_Quartermaster_Exception, AbstractShareableDeviceDriver, plugins, HostBusy, \
+    host_gates, DeviceTransition, AbstractRemoteHostDriver, CommunicatorError
+from data.models import Resource, RemoteHost, Device, ReservationRequest
+from data.signals import resources_released
+from quartermaster.allocator import release_expired_reservations, finish_reservation, grant_waiting_requests, \
+    expire_reservation_requests
+from quartermaster.digests import poll_digests
 
 logger = logging.getLogger(__name__)
 
@@ -14,22 +25,118 @@ logger = logging.getLogger(__name__)
 @db_periodic_task(crontab(minute='*'))
 @lock_task('update_reservations')
 def update_reservations():
-    for resource in Resource.objects.filter(last_check_in__isnull=False):
-        if now() > resource.reservation_expiration or now() > resource.checkin_expiration:
-            release_reservation(resource)
+    release_expired_reservations()
+    expired = expire_reservation_requests()
+    if expired:
+        logger.info(f"Dropped {expired} reservation requests that were no longer being waited on")
+
+
+@db_task()
+def provision_reservation(resource_pk: str, use_password: str):
+    finish_reservation(resource_pk, use_password)
+
+
+@db_task()
+def serve_reservation_queue(pool_pk: str):
+    for resource in grant_waiting_requests(pool_pk):
+        finish_reservation(resource.pk, resource.use_password)
+
+
+@receiver(resources_released)
+def hand_off_released_resources(sender, pools, **kwargs):
+    # Only bother the task queue when someone is actually waiting
+    for pool_pk in ReservationRequest.objects.waiting().filter(pool__in=pools).values_list('pool', flat=True) \
+            .distinct():
+        transaction.on_commit(lambda pool_pk=pool_pk: serve_reservation_queue(pool_pk))
+
+
+# How often confirm_device_state runs, a host is polled in the cycle closest to when it is due
+POLL_CYCLE = timedelta(minutes=1)
+
+
+class PollOutcome(NamedTuple):
+    reachable: bool
+    # Device states were found to have changed
+    changed: bool
 
 
 @db_periodic_task(crontab(minute='*'))
 @lock_task('update_host_state')
 def confirm_device_state():
-    for host in RemoteHost.objects.all():
-        update_host_devices(host)
+    hosts = list(RemoteHost.objects.only('pk', 'address', 'poll_queued_at', 'poll_started_at', 'next_poll_at'))
+    report_poll_cycle(hosts)
+    current_time = now()
+    due_by = current_time + POLL_CYCLE / 2
+    # Hosts whose last poll is still waiting in the queue, or running, aren't queued again. A backed up queue would
+    # otherwise fill with polls of the same hosts.
+    due = [host.pk for host in hosts
+           if (host.next_poll_at is None or host.next_poll_at < due_by) and not host.poll_pending(current_time)]
+    RemoteHost.queue_polls(due)
+    # One task per host so a slow host only holds up itself, the consumer's workers poll them in parallel
+    for host_pk in due:
+        update_host_devices(host_pk)
+
+
+@receiver(post_delete, sender=RemoteHost)
+def forget_deleted_host(sender, instance: RemoteHost, **kwargs):
+    # Digests are otherwise only replaced by polls, a deleted host's would stay for the life of the worker
+    poll_digests.forget_host(instance.pk)
+
+
+def report_poll_cycle(hosts: List[RemoteHost]):
+    """Log how many hosts the poll cycles are keeping up with, and the stragglers they aren't"""
+    cutoff = now() - settings.HOST_POLL_STRAGGLER_AGE
+    stragglers = [host.address for host in hosts
+                  if (host.next_poll_at and host.next_poll_at < cutoff)
+                  or (host.poll_started_at and host.poll_started_at < cutoff)]
+    digests = poll_digests.stats()
+    unchanged = f"unchanged hosts skipped {digests['hit_rate']:.0%} ({digests['hits']} of " \
+                f"{digests['hits'] + digests['misses']})"
+    if stragglers:
+        logger.warning(f"Poll cycle: {len(hosts) - len(stragglers)} of {len(hosts)} hosts polled on schedule, "
+                       f"stragglers overdue by more than {settings.HOST_POLL_STRAGGLER_AGE}: {', '.join(stragglers)}, "
+                       f"{unchanged}")
+    else:
+        logger.info(f"Poll cycle: all {len(hosts)} hosts polled on schedule, {unchanged}")
 
 
 @db_task()
-def update_host_devices(host: RemoteHost):
+def update_host_devices(host_pk: int):
+    # A host still being polled from an earlier cycle is left to finish rather than polled twice at once
+    started_at = RemoteHost.start_poll(host_pk)
+    if started_at is None:
+        logger.info(f"Skipped polling host_id={host_pk}, the previous poll of it is still running")
+        return
+    started = time.monotonic()
+    interval = None
+    try:
+        host = RemoteHost.objects.filter(pk=host_pk).first()
+        if host is None:
+            # Deleted since the poll was queued
+            return
+        outcome = poll_host(host)
+        interval = next_poll_interval(host, outcome)
+    finally:
+        RemoteHost.finish_poll(host_pk, started_at, interval)
+    logger.debug(f"Polled host_id={host_pk} in {time.monotonic() - started:.2f}s, next poll in {interval}")
+
+
+def next_poll_interval(host: RemoteHost, outcome: PollOutcome) -> timedelta:
+    """
+    Hosts whose devices are reserved or changing are polled as often as they may be. Hosts that are stable or down
+    are polled less and less often, up to their longest interval.
+    """
+    if outcome.reachable and (outcome.changed or Device.everything.filter(host=host, resource__user__isnull=False)
+                              .exists()):
+        return host.min_poll_interval
+    interval = (host.poll_interval or host.min_poll_interval) * settings.HOST_POLL_BACKOFF
+    return min(max(interval, host.min_poll_interval), host.max_poll_interval)
+
+
+def poll_host(host: RemoteHost) -> PollOutcome:
+    reachable, changed = True, False
     # For each driver
-    for host_driver_class in plugins.remote_host_classes().values():
+    for host_driver_class in plugins.remote_host_classes():
         # If compatible with communicator
         if host.communicator not in host_driver_class.SUPPORTED_COMMUNICATORS \
                 or host.type not in host_driver_class.SUPPORTED_HOST_TYPES:
@@ -37,15 +144,61 @@ def update_host_devices(host: RemoteHost):
 
         host_driver = host_driver_class(host=host)
 
-        devices_to_update = host.device_set.filter(driver=host_driver_class.DEVICE_CLASS.__name__)
+        devices_to_update = host.device_set.filter(driver=host_driver_class.IDENTIFIER)
 
         if not host_driver.is_reachable:
-            logger.exception(f"Could not reach host {host}")
-            for device in devices_to_update:
-                device.online = False
-                device.save()
+            logger.error(f"Could not reach host {host}")
+            mark_devices_offline(host, devices_to_update)
+            reachable = False
             continue
 
+        # Everything about the devices reconciling them depends on, part of the poll's digest
+        device_rows = list(devices_to_update.order_by('pk')
+                           .values_list('pk', 'config_json', 'online', 'resource__user'))
+
         # If no devices are being check do try to communicate with host as that could end up raising exceptions
-        if devices_to_update.count() > 0:
-            host_driver.update_device_states(devices_to_update)
+        if device_rows:
+            digest_key = (host.pk, host_driver_class.IDENTIFIER)
+            try:
+                snapshot = host_driver.snapshot = host_driver.take_snapshot()
+                digest = poll_digests.digest(snapshot, device_rows)
+                if poll_digests.unchanged(digest_key, digest):
+                    # Neither the host nor the reservations of its devices changed since the last poll put them right
+                    continue
+                transitions = host_driver.update_device_states(devices_to_update)
+            except HostBusy as e:
+                # The host is answering, just slowly because of other work. Leave devices as they are until next time.
+                logger.warning(f"Skipped updating device states on host {host}: {e}")
+            except (AbstractRemoteHostDriver.HostConnectionError, CommunicatorError, OSError):
+                # Reachability is taken on trust from recent commands so the state query is what finds a host
+                # that has gone away
+                logger.exception(f"Could not reach host {host} to update device states")
+                poll_digests.forget(digest_key)
+                mark_devices_offline(host, devices_to_update)
+                reachable = False
+            except (USB_Quartermaster_Exception, AbstractShareableDeviceDriver.DeviceError):
+                # The host answered, a command on it or a correction to one of its devices failed. That says nothing
+                # about whether the devices are there, leave them be and go through them all again next poll.
+                logger.exception(f"Could not update device states on host {host}")
+                poll_digests.forget(digest_key)
+            else:
+                Device.apply_transitions(host, transitions)
+                changed = changed or bool(transitions)
+                # Any corrections made change the digest, so the next poll checks they stuck before skipping
+                poll_digests.record(digest_key, digest)
+    return PollOutcome(reachable=reachable, changed=changed)
+
+
+@db_periodic_task(crontab(minute='*/5'))
+def report_host_queues():
+    """Log hosts where commands have had to wait their turn, a sign their concurrency limit is too low"""
+    for host_id, stats in host_gates.stats().items():
+        if stats['timeouts'] or stats['max_wait'] > 1.0:
+            logger.info(f"Command queue host_id={host_id} limit={stats['limit']} active={stats['active']} "
+                        f"waiting={stats['waiting']} acquired={stats['acquired']} timeouts={stats['timeouts']} "
+                        f"average_wait={stats['average_wait']:.2f}s max_wait={stats['max_wait']:.2f}s")
+
+
+def mark_devices_offline(host: RemoteHost, devices):
+    transitions = [DeviceTransition(device, 'online', True, False) for device in devices.filter(online=True)]
+    Device.apply_transitions(host, transitions)
@@ -1,4 +1,7 @@
-from data import models
+import pytest
+
+from USB_Quartermaster_common import CircuitBreaker, HostHealth
+from data import models, signals
 
 
 def test_drivers_found_and_sorted():
@@ -7,4 +10,147 @@ def test_drivers_found_and_sorted():
     discovered_drivers = models.loaded_device_drivers()
     assert expected_drivers == discovered_drivers
 
+
+
+@pytest.mark.django_db
+def test_config_is_parsed_once(sample_remote_host, monkeypatch):
+    first = sample_remote_host.config
+    monkeypatch.setattr(models.json, 'loads', lambda *args, **kwargs: pytest.fail("config parsed again"))
+    assert sample_remote_host.config is first
+
+
+@pytest.mark.django_db
+def test_config_follows_edits(sample_remote_host):
+    config = dict(sample_remote_host.config)
+    config['username'] = 'someone_else'
+    sample_remote_host.set_config(config)
+    assert sample_remote_host.config['username'] == 'someone_else'
+
+    models.RemoteHost.objects.filter(pk=sample_remote_host.pk).update(config_json='{"username": "from_db"}')
+    sample_remote_host.refresh_from_db()
+    assert sample_remote_host.config == {'username': 'from_db'}
+
 # TODO: Test validation works
+
+
+@pytest.mark.django_db
+def test_offline_device_hides_resource(sample_shared_device):
+    resource = models.Resource.everything.get(pk=sample_shared_device.resource_id)
+    assert resource.offline_device_count == 0
+    assert models.Resource.objects.filter(pk=resource.pk).exists()
+
+    sample_shared_device.online = False
+    sample_shared_device.save()
+    resource.refresh_from_db()
+    assert resource.offline_device_count == 1
+    assert not resource.is_available
+    assert not models.Resource.objects.filter(pk=resource.pk).exists()
+
+    # A save that doesn't change anything must not count the device twice
+    sample_shared_device.save()
+    resource.refresh_from_db()
+    assert resource.offline_device_count == 1
+
+    sample_shared_device.online = True
+    sample_shared_device.save()
+    resource.refresh_from_db()
+    assert resource.offline_device_count == 0
+    assert resource.is_available
+
+
+@pytest.mark.django_db
+def test_offline_count_follows_device_moves_and_deletes(sample_shared_device, sample_unshared_resource):
+    old_resource_pk = sample_shared_device.resource_id
+    sample_shared_device.online = False
+    sample_shared_device.save()
+
+    sample_shared_device.resource = sample_unshared_resource
+    sample_shared_device.save()
+    assert models.Resource.everything.get(pk=old_resource_pk).offline_device_count == 0
+    assert models.Resource.everything.get(pk=sample_unshared_resource.pk).offline_device_count == 1
+
+    sample_shared_device.delete()
+    assert models.Resource.everything.get(pk=sample_unshared_resource.pk).is_available
+
+
+@pytest.mark.django_db
+def test_stale_resource_save_keeps_counters(sample_shared_device):
+    stale = models.Resource.everything.get(pk=sample_shared_device.resource_id)
+    sample_shared_device.online = False
+    sample_shared_device.save()
+
+    stale.description = 'edited'
+    stale.save()
+    assert not models.Resource.everything.get(pk=stale.pk).is_available
+
+    stale.enabled = False
+    stale.save()
+    sample_shared_device.online = True
+    sample_shared_device.save()
+    assert not models.Resource.everything.get(pk=stale.pk).is_available
+
+
+@pytest.mark.django_db
+def test_stale_host_save_keeps_breaker_state(sample_remote_host):
+    # Say an admin opened the host's page before it started failing and saves it afterwards
+    stale = models.RemoteHost.objects.get(pk=sample_remote_host.pk)
+    CircuitBreaker(sample_remote_host, failure_threshold=1).record_failure()
+
+    stale.address = 'edited.example.com'
+    stale.save()
+    host = models.RemoteHost.objects.get(pk=stale.pk)
+    assert 'edited.example.com' == host.address
+    assert HostHealth.OPEN == host.health_state
+    assert 1 == host.health_failures
+    assert host.health_retry_at is not None
+
+
+@pytest.mark.django_db
+def test_offline_count_follows_queryset_deletes(sample_shared_device):
+    sample_shared_device.online = False
+    sample_shared_device.save()
+    assert not models.Resource.everything.get(pk=sample_shared_device.resource_id).is_available
+
+    models.Device.everything.filter(pk=sample_shared_device.pk).delete()
+    resource = models.Resource.everything.get(pk=sample_shared_device.resource_id)
+    assert resource.offline_device_count == 0
+    assert resource.is_available
+
+
+@pytest.mark.django_db
+def test_renamed_resource_is_saved(sample_unshared_resource):
+    # The admin lets the name, the primary key, be edited, that saves the resource under its new name
+    sample_unshared_resource.name = 'RENAMED'
+    sample_unshared_resource.save()
+    assert models.Resource.everything.get(pk='RENAMED').is_available
+
+    sample_unshared_resource.description = 'edited'
+    sample_unshared_resource.save()
+    assert models.Resource.everything.get(pk='RENAMED').description == 'edited'
+
+
+@pytest.mark.django_db
+def test_apply_transitions(sample_shared_device, sample_unshared_device, sample_remote_host,
+                           django_assert_num_queries):
+    received = []
+
+    def receiver(sender, host, transitions, **kwargs):
+        received.append((host, transitions))
+
+    signals.device_states_changed.connect(receiver)
+    try:
+        transitions = [models.DeviceTransition(sample_shared_device, 'online', True, False),
+                       models.DeviceTransition(sample_unshared_device, 'online', True, False)]
+        # One UPDATE for the devices, one to recount and two to refresh availability, inside a savepoint
+        with django_assert_num_queries(6):
+            models.Device.apply_transitions(sample_remote_host, transitions)
+    finally:
+        signals.device_states_changed.disconnect(receiver)
+
+    assert received == [(sample_remote_host, transitions)]
+    assert not models.Device.everything.filter(online=True).exists()
+    assert models.Resource.objects.count() == 0
+
+    # Already counted, saving again changes nothing
+    sample_shared_device.save()
+    assert models.Resource.everything.get(pk=sample_shared_device.resource_id).offline_device_count == 1
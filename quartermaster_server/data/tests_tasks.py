@@ -0,0 +1,297 @@
+import json
+import logging
+from datetime import timedelta
+
+import pytest
+from django.utils.timezone import now
+from huey.contrib.djhuey import HUEY
+
+from USB_Quartermaster_Simulated import SimulatedFleet
+from USB_Quartermaster_Usbip.driver import UsbipOverSSHHost
+from USB_Quartermaster_common import AbstractShareableDeviceDriver, HostBusy, CommunicatorError
+from USB_Quartermaster_common.Communicator import contact_tracker
+from data import tasks
+from data.models import RemoteHost, Resource, Device
+from quartermaster.digests import poll_digests
+
+
+@pytest.fixture()
+def polled_hosts(monkeypatch):
+    polled = []
+    monkeypatch.setattr(HUEY, 'immediate', True)
+    monkeypatch.setattr(tasks, 'poll_host', lambda host: polled.append(host.pk))
+    return polled
+
+
+@pytest.fixture()
+def simulated_host(monkeypatch, sample_pool):
+    """A host of a simulated fleet with two usbip devices of a free resource, returns the fleet's host and the record"""
+    fleet = SimulatedFleet(hosts=1, devices_per_host=2)
+    monkeypatch.setattr(RemoteHost, 'get_communicator_obj', lambda host: fleet.communicator(host))
+    contact_tracker.clear()
+    poll_digests.clear()
+    simulated = next(iter(fleet.hosts.values()))
+    host = RemoteHost.objects.create(address=simulated.address, communicator='SSH', type='Linux_AMD64',
+                                     config_json='{}')
+    resource = Resource.objects.create(pool=sample_pool, name='SIMULATED')
+    for bus_id in simulated.devices:
+        Device.objects.create(resource=resource, driver='USBIP', host=host, name=bus_id,
+                              config_json=json.dumps({'bus_id': bus_id}))
+    return simulated, host
+
+
+@pytest.mark.django_db
+def test_poll_cycle_polls_each_host(sample_remote_host, polled_hosts):
+    other_host = RemoteHost.objects.create(address='other', communicator='SSH', type='Linux_AMD64', config_json='{}')
+
+    tasks.confirm_device_state.call_local()
+
+    assert sorted(polled_hosts) == sorted([sample_remote_host.pk, other_host.pk])
+    for host in RemoteHost.objects.all():
+        assert host.poll_started_at is None
+        assert host.last_polled_at is not None
+
+
+@pytest.mark.django_db
+def test_host_being_polled_is_skipped(sample_remote_host, polled_hosts):
+    assert RemoteHost.start_poll(sample_remote_host.pk)
+    tasks.update_host_devices(sample_remote_host.pk)
+    assert polled_hosts == []
+
+    # Long enough that the poll holding the host must have died
+    RemoteHost.objects.filter(pk=sample_remote_host.pk).update(poll_started_at=now() - timedelta(hours=1))
+    tasks.update_host_devices(sample_remote_host.pk)
+    assert polled_hosts == [sample_remote_host.pk]
+
+
+@pytest.mark.django_db
+def test_poll_taken_over_keeps_new_marker(sample_remote_host):
+    started_at = RemoteHost.start_poll(sample_remote_host.pk)
+    # The first poll hung long enough for another to take the host over
+    RemoteHost.objects.filter(pk=sample_remote_host.pk).update(poll_started_at=started_at - timedelta(hours=1))
+    taken_over_at = RemoteHost.start_poll(sample_remote_host.pk)
+    assert taken_over_at is not None
+
+    RemoteHost.finish_poll(sample_remote_host.pk, started_at, timedelta(minutes=1))
+    sample_remote_host.refresh_from_db()
+    assert sample_remote_host.poll_started_at == taken_over_at
+    assert sample_remote_host.next_poll_at is None
+
+    RemoteHost.finish_poll(sample_remote_host.pk, taken_over_at, timedelta(minutes=1))
+    sample_remote_host.refresh_from_db()
+    assert sample_remote_host.poll_started_at is None
+    assert sample_remote_host.next_poll_at == taken_over_at + timedelta(minutes=1)
+
+
+@pytest.mark.django_db
+def test_queued_polls_are_not_queued_again(sample_remote_host, monkeypatch):
+    queued = []
+    monkeypatch.setattr(tasks, 'update_host_devices', queued.append)
+
+    # The consumer is backed up, the first cycle's poll hasn't started by the next cycle
+    tasks.confirm_device_state.call_local()
+    tasks.confirm_device_state.call_local()
+    assert queued == [sample_remote_host.pk]
+
+    # A queued poll that never ran is given up on eventually
+    RemoteHost.objects.filter(pk=sample_remote_host.pk).update(poll_queued_at=now() - timedelta(hours=1))
+    tasks.confirm_device_state.call_local()
+    assert queued == [sample_remote_host.pk] * 2
+
+
+@pytest.mark.django_db
+def test_failed_poll_frees_host(sample_remote_host, monkeypatch):
+    monkeypatch.setattr(HUEY, 'immediate', True)
+
+    def fail(host):
+        raise RuntimeError("poll failed")
+
+    monkeypatch.setattr(tasks, 'poll_host', fail)
+    with pytest.raises(RuntimeError):
+        tasks.update_host_devices.call_local(sample_remote_host.pk)
+    sample_remote_host.refresh_from_db()
+    assert sample_remote_host.poll_started_at is None
+
+
+@pytest.mark.django_db
+def test_stragglers_are_reported(sample_remote_host, caplog):
+    RemoteHost.objects.filter(pk=sample_remote_host.pk).update(next_poll_at=now() - timedelta(hours=1))
+    RemoteHost.objects.create(address='fresh', communicator='SSH', type='Linux_AMD64', config_json='{}',
+                              next_poll_at=now() + timedelta(minutes=1))
+
+    with caplog.at_level(logging.INFO, logger='data.tasks'):
+        tasks.report_poll_cycle(list(RemoteHost.objects.all()))
+    assert "1 of 2 hosts polled on schedule" in caplog.text
+    assert sample_remote_host.address in caplog.text
+
+
+@pytest.mark.django_db
+def test_only_due_hosts_are_polled(sample_remote_host, polled_hosts):
+    due = RemoteHost.objects.create(address='due', communicator='SSH', type='Linux_AMD64', config_json='{}',
+                                    next_poll_at=now() - timedelta(minutes=1))
+    RemoteHost.objects.filter(pk=sample_remote_host.pk).update(next_poll_at=now() + timedelta(minutes=10))
+
+    tasks.confirm_device_state.call_local()
+    assert polled_hosts == [due.pk]
+
+
+@pytest.mark.django_db
+def test_stable_host_backs_off(sample_remote_host, monkeypatch, settings):
+    settings.HOST_POLL_MIN_INTERVAL = timedelta(minutes=1)
+    settings.HOST_POLL_MAX_INTERVAL = timedelta(minutes=5)
+    monkeypatch.setattr(HUEY, 'immediate', True)
+    monkeypatch.setattr(tasks, 'poll_host', lambda host: tasks.PollOutcome(reachable=True, changed=False))
+
+    intervals = []
+    for _ in range(4):
+        tasks.update_host_devices(sample_remote_host.pk)
+        sample_remote_host.refresh_from_db()
+        intervals.append(sample_remote_host.poll_interval)
+    assert intervals == [timedelta(minutes=2), timedelta(minutes=4), timedelta(minutes=5), timedelta(minutes=5)]
+    assert sample_remote_host.next_poll_at - sample_remote_host.last_polled_at <= timedelta(minutes=5)
+
+    # A host that has to be polled less often keeps to its own limits
+    RemoteHost.objects.filter(pk=sample_remote_host.pk).update(poll_interval_min=timedelta(minutes=10),
+                                                               poll_interval_max=timedelta(minutes=30))
+    tasks.update_host_devices(sample_remote_host.pk)
+    sample_remote_host.refresh_from_db()
+    assert sample_remote_host.poll_interval == timedelta(minutes=10)
+    tasks.update_host_devices(sample_remote_host.pk)
+    sample_remote_host.refresh_from_db()
+    assert sample_remote_host.poll_interval == timedelta(minutes=20)
+
+
+@pytest.mark.django_db
+def test_busy_host_polled_often(sample_shared_device, settings):
+    settings.HOST_POLL_MIN_INTERVAL = timedelta(minutes=1)
+    host = sample_shared_device.host
+    host.poll_interval = timedelta(minutes=8)
+    unchanged = tasks.PollOutcome(reachable=True, changed=False)
+
+    # The device's resource is reserved
+    assert tasks.next_poll_interval(host, unchanged) == timedelta(minutes=1)
+    # but a host that is down is left alone until it comes back
+    assert tasks.next_poll_interval(host, tasks.PollOutcome(reachable=False, changed=True)) > timedelta(minutes=8)
+
+
+@pytest.mark.django_db
+def test_reservation_changes_hurry_polls(sample_shared_device, settings):
+    settings.HOST_POLL_MIN_INTERVAL = timedelta(minutes=1)
+    later = now() + timedelta(minutes=10)
+    RemoteHost.objects.update(poll_interval=timedelta(minutes=10), next_poll_at=later)
+
+    RemoteHost.poll_soon([sample_shared_device.resource_id])
+    host = RemoteHost.objects.get(pk=sample_shared_device.host_id)
+    assert host.poll_interval is None
+    assert host.next_poll_at < later - timedelta(minutes=8)
+
+
+@pytest.mark.django_db
+def test_device_error_leaves_devices_online(simulated_host, monkeypatch):
+    simulated, host = simulated_host
+
+    def fail(self, devices):
+        raise AbstractShareableDeviceDriver.DeviceNotFound("1-1 vanished mid poll")
+
+    monkeypatch.setattr(UsbipOverSSHHost, 'update_device_states', fail)
+    outcome = tasks.poll_host(host)
+    # The host answered, a problem with one device doesn't make all of them unusable
+    assert outcome.reachable
+    assert Device.everything.filter(host=host, online=True).count() == 2
+
+
+@pytest.mark.django_db
+def test_busy_host_leaves_devices_online(simulated_host, monkeypatch):
+    simulated, host = simulated_host
+
+    def busy(self, devices):
+        raise HostBusy("Timed out waiting behind 8 callers")
+
+    monkeypatch.setattr(UsbipOverSSHHost, 'update_device_states', busy)
+    # Callers that only know about communicator failures still catch a busy host
+    assert issubclass(HostBusy, CommunicatorError)
+    outcome = tasks.poll_host(host)
+    assert outcome.reachable
+    assert Device.everything.filter(host=host, online=True).count() == 2
+
+
+@pytest.mark.django_db
+def test_lost_host_marks_devices_offline(simulated_host):
+    simulated, host = simulated_host
+    assert tasks.poll_host(host).reachable
+
+    # Recent contact vouches for the host so it is the state query that fails
+    simulated.reachable = False
+    outcome = tasks.poll_host(host)
+    assert not outcome.reachable
+    assert Device.everything.filter(host=host, online=True).count() == 0
+
+
+@pytest.fixture()
+def reconciliations(monkeypatch):
+    """Counts the polls that went through a host's devices rather than skipping them"""
+    counted = []
+    update_device_states = UsbipOverSSHHost.update_device_states
+
+    def counting(self, devices):
+        counted.append(self.host.pk)
+        return update_device_states(self, devices)
+
+    monkeypatch.setattr(UsbipOverSSHHost, 'update_device_states', counting)
+    return counted
+
+
+@pytest.mark.django_db
+def test_unchanged_poll_skips_devices(simulated_host, reconciliations):
+    simulated, host = simulated_host
+    tasks.poll_host(host)
+    tasks.poll_host(host)
+    assert len(reconciliations) == 1
+    assert poll_digests.stats() == {'hits': 1, 'misses': 1, 'hit_rate': 0.5}
+
+
+@pytest.mark.django_db
+def test_reservation_change_reconciles_again(simulated_host, reconciliations, admin_user):
+    simulated, host = simulated_host
+    tasks.poll_host(host)
+    Resource.everything.filter(name='SIMULATED').update(user=admin_user)
+    tasks.poll_host(host)
+    assert len(reconciliations) == 2
+
+
+@pytest.mark.django_db
+def test_failed_poll_forgets_digest(simulated_host, reconciliations):
+    simulated, host = simulated_host
+    tasks.poll_host(host)
+    assert len(poll_digests) == 1
+    simulated.reachable = False
+    tasks.poll_host(host)
+    assert len(poll_digests) == 0
+    simulated.reachable = True
+    # Same answer as before the failure, but the devices were marked offline meanwhile and must be brought back
+    tasks.poll_host(host)
+    assert len(reconciliations) == 2
+    assert Device.everything.filter(host=host, online=True).count() == 2
+
+
+@pytest.mark.django_db
+def test_corrections_are_checked_once(simulated_host, reconciliations, admin_user):
+    simulated, host = simulated_host
+    Resource.everything.filter(name='SIMULATED').update(user=admin_user)
+    # Shares the reserved devices
+    tasks.poll_host(host)
+    assert all(device.shared for device in simulated.devices.values())
+    # The host looks different now, the next poll makes sure the shares stuck, after that there is nothing to do
+    tasks.poll_host(host)
+    tasks.poll_host(host)
+    assert len(reconciliations) == 2
+
+
+@pytest.mark.django_db
+def test_deleted_host_digest_is_dropped(simulated_host):
+    simulated, host = simulated_host
+    tasks.poll_host(host)
+    assert len(poll_digests) == 1
+    Device.everything.filter(host=host).delete()
+    host.delete()
+    assert len(poll_digests) == 0
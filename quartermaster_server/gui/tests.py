@@ -1,11 +1,13 @@
 from datetime import datetime
 
 from django.contrib.auth.models import User
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 # Create your tests here.
 from django.urls import reverse
 
-from data.models import Pool, Resource
+from data.models import Pool, Resource, RemoteHost, Device
 
 
 class GUITestCase(TestCase):
@@ -67,3 +69,46 @@ class GUITestCase(TestCase):
                                     data={'DELETE': 'true'})
         self.assertEqual(response.status_code, 302)
         self.assertRedirects(expected_url=reverse('gui:list_resources'), response=response)
+
+
+class ResourceListQueriesTestCase(TestCase):
+    """Listing resources must not go back to the database for every resource or device it shows"""
+
+    def setUp(self):
+        self.user = User.objects.create_superuser(username="TEST_USER",
+                                                  email="not_real@example.com",
+                                                  password="lolSecret")
+        self.pool = Pool.objects.create(name='TEST_POOL')
+        self.hosts = [RemoteHost.objects.create(address=f"host{x}.example.com", communicator='SSH', type='Linux_AMD64',
+                                                config_json='{}') for x in range(0, 2)]
+        self.num_resources = 0
+        self.client.force_login(self.user)
+
+    def add_resources(self, count: int):
+        for _ in range(0, count):
+            resource = Resource.objects.create(pool=self.pool, name=f"RESOURCE_{self.num_resources}",
+                                               user=self.user, last_reserved=datetime.now(),
+                                               last_check_in=datetime.now())
+            for x, host in enumerate(self.hosts):
+                Device.objects.create(resource=resource, host=host, driver='USB_Quartermaster_Usbip',
+                                      config_json='{"bus_id": "1-1"}', name=f"DEVICE_{x}")
+            self.num_resources += 1
+
+    def count_list_queries(self) -> int:
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('gui:list_resources'))
+        self.assertEqual(len(response.context['resources']), self.num_resources)
+        return len(queries)
+
+    def test_list_resources_queries_do_not_grow_with_rows(self):
+        self.add_resources(2)
+        few = self.count_list_queries()
+        self.add_resources(8)
+        self.assertEqual(self.count_list_queries(), few)
+
+    def test_view_reservation_queries(self):
+        self.add_resources(1)
+        # Session, user, resource with its pool and user, then the check in
+        with self.assertNumQueries(4):
+            response = self.client.get(reverse('gui:view_reservation', kwargs={'resource_pk': 'RESOURCE_0'}))
+        self.assertEqual(response.status_code, 200)
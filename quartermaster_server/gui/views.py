@@ -12,7 +12,7 @@ from django.views.decorators.cache import never_cache
 from django.views.decorators.http import require_http_methods
 
 from data.models import Resource
-from quartermaster.allocator import release_reservation, make_reservation, update_reservation
+from quartermaster.allocator import release_reservation, make_reservation, update_reservation, ResourceUnavailable
 
 logger = logging.getLogger(__name__)
 
@@ -21,7 +21,7 @@ logger = logging.getLogger(__name__)
 @require_http_methods(("GET",))
 @never_cache
 def list_resources(request):
-    resource_qs = Resource.everything.all()
+    resource_qs = Resource.everything.with_devices()
     return TemplateResponse(request=request,
                             template='resource_list.html',
                             context={"resources": resource_qs})
@@ -35,7 +35,7 @@ def get_resource(func):
     def wrapper(request, *args, **kwargs):
         resource_pk = kwargs['resource_pk']
         try:
-            resource = Resource.objects.get(pk=resource_pk)
+            resource = Resource.objects.select_related('pool', 'user').get(pk=resource_pk)
         except Resource.DoesNotExist:
             messages.error(request, f"No resource found matching '{resource_pk}'")
             response = HttpResponseNotFound()
@@ -64,7 +64,14 @@ class ReservationView(View):
         if resource.in_use:
             return HttpResponseForbidden("The resource is already in use")
 
-        make_reservation(resource, request.user, used_for="GUI")
+        if not resource.hosts_available:
+            messages.error(request, f"The resource, {resource.pk}, is on a host that is currently unreachable")
+            return HttpResponseRedirect(reverse('gui:list_resources'))
+
+        try:
+            make_reservation(resource, request.user, used_for="GUI")
+        except ResourceUnavailable:
+            return HttpResponseForbidden("The resource is already in use")
         return HttpResponseRedirect(reverse('gui:view_reservation', kwargs={'resource_pk': resource.pk}))
 
     def get(self, request, resource, *args, **kwargs):
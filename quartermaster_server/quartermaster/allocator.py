@@ -1,48 +1,249 @@
 import logging
 from secrets import token_urlsafe
+from typing import List, Optional, Callable
 
 from django.conf import settings
 from django.db import transaction
+from django.db.models import Q, QuerySet, Prefetch
 from django.utils.timezone import now
 
-from data.models import Resource
-from quartermaster.helpers import for_all_devices
+from USB_Quartermaster_common import USB_Quartermaster_Exception, AbstractShareableDeviceDriver
+from data.models import Resource, Pool, ReservationRequest, RemoteHost, Device
+from data.signals import resources_released
+from quartermaster import placement
+from quartermaster.helpers import for_all_devices, DEVICE_RELATED
+from quartermaster.leases import LeaseScheduler, schedule_lease, cancel_leases, lease_expiry
 
 logger = logging.getLogger(__name__)
 
+# What a resource looks like once its reservation is released
+RELEASED_FIELDS = {'user': None, 'used_for': "", 'use_password': "", 'last_check_in': None,
+                   'reservation_expires_at': None, 'checkin_expires_at': None}
+
+
+def resource_devices(resource: Resource) -> QuerySet:
+    return resource.device_set.select_related(*DEVICE_RELATED)
+
+
+def prefetch_devices() -> Prefetch:
+    return Prefetch('device_set', queryset=Device.everything.select_related(*DEVICE_RELATED))
+
+
+class ResourceUnavailable(USB_Quartermaster_Exception):
+    """
+    Raised when a resource was reserved by someone else between being looked up and being claimed
+    """
+    pass
+
+
+def claim_resource(resource: Resource, user: settings.AUTH_USER_MODEL, used_for: str,
+                   provisioning_state: str = Resource.PROVISIONING_READY) -> bool:
+    """
+    Reserve the resource in the database if, and only if, it is still unreserved. This is a single conditional
+    UPDATE so of any number of concurrent callers exactly one wins, no matter how stale their copy of the resource
+    is. On success the reservation is copied onto `resource`, otherwise it is reloaded to show who has it.
+    """
+    current_time = now()
+    fields = {'user': user, 'used_for': used_for, 'use_password': token_urlsafe(nbytes=10),
+              'last_check_in': current_time, 'last_reserved': current_time,
+              'provisioning_state': provisioning_state, 'provisioning_error': ""}
+    # The expiry columns are normally filled in by save(), which this bypasses
+    claimed = Resource(**fields)
+    claimed.update_expiry()
+    fields.update(reservation_expires_at=claimed.reservation_expires_at, checkin_expires_at=claimed.checkin_expires_at)
+    if not Resource.everything.filter(pk=resource.pk, user=None).update(**fields):
+        resource.refresh_from_db()
+        return False
+    for field, value in fields.items():
+        setattr(resource, field, value)
+    schedule_lease(resource)
+    RemoteHost.poll_soon([resource.pk])
+    return True
+
 
 def make_reservation(resource: Resource, user: settings.AUTH_USER_MODEL, used_for: str):
-    # If we are multi threaded there could be a race condition here between when grab and when used
     logger.info(f"Reservation being made user={user.username} used_for={used_for} resource={resource}")
     with transaction.atomic():
-        resource.user = user
-        resource.used_for = used_for
-        resource.use_password = token_urlsafe(nbytes=10)
-        resource.last_check_in = now()
-        resource.last_reserved = now()
-        resource.save()
+        if not claim_resource(resource, user, used_for):
+            raise ResourceUnavailable(f"{resource} was reserved by another user")
+        for_all_devices(resource_devices(resource), 'share')
+
+
+def start_reservation(resource: Resource, user: settings.AUTH_USER_MODEL, used_for: str):
+    """
+    Reserve the resource without sharing its devices, that is left to finish_reservation() which is expected to run
+    in a task. Until it does the reservation's provisioning_state is pending, afterwards it is ready or failed.
+    """
+    logger.info(f"Reservation being started user={user.username} used_for={used_for} resource={resource}")
+    if not claim_resource(resource, user, used_for, provisioning_state=Resource.PROVISIONING_PENDING):
+        raise ResourceUnavailable(f"{resource} was reserved by another user")
+
+
+def finish_reservation(resource_pk: str, use_password: str) -> None:
+    """
+    Share the devices of a reservation made with start_reservation(). The password identifies the reservation, if
+    it was released, or released and made again, in the meantime there is nothing to do.
+    """
+    reservation = Resource.everything.filter(pk=resource_pk, use_password=use_password,
+                                             provisioning_state=Resource.PROVISIONING_PENDING)
+    resource = reservation.select_related('pool').prefetch_related(prefetch_devices()).first()
+    if resource is None:
+        logger.info(f"Reservation of {resource_pk} was released before its devices were shared")
+        return
+    try:
         for_all_devices(resource.device_set.all(), 'share')
+    except Exception as e:
+        # Anything escaping here would leave the client waiting on a pending reservation until it expires
+        logger.exception(f"Could not share devices of {resource_pk}")
+        reservation.update(provisioning_state=Resource.PROVISIONING_FAILED, provisioning_error=str(e))
+        return
+    with transaction.atomic():
+        if not reservation.update(provisioning_state=Resource.PROVISIONING_READY):
+            # Released while the devices were being shared, release_reservation() may have unshared them before
+            # they were shared here. Undo that unless the resource was reserved again, the lock holds off anyone
+            # claiming it until this is done.
+            if Resource.everything.select_for_update().filter(pk=resource_pk, user=None).exists():
+                logger.info(f"Reservation of {resource_pk} was released while its devices were shared, unsharing")
+                try:
+                    for_all_devices(resource_devices(resource), 'unshare')
+                except Exception:
+                    logger.exception(f"Could not unshare devices of released reservation {resource_pk}")
+            return
+    logger.info(f"Reservation of {resource_pk} is ready user_id={resource.user_id} used_for={resource.used_for}")
+
+
+def claim_any(resources: QuerySet, user: settings.AUTH_USER_MODEL, used_for: str, strategy: Optional[str] = None,
+              reserve: Callable[[Resource, settings.AUTH_USER_MODEL, str], None] = make_reservation) \
+        -> Optional[Resource]:
+    """
+    Reserve the free resource of `resources` the placement strategy likes best, or return None if there are none.
+    Rows another caller is in the middle of claiming are skipped instead of waited on, so many workers drawing from
+    the same pool at once each get a different resource without queueing behind each other.
+
+    `reserve` is make_reservation(), or start_reservation() to leave sharing the devices to a task.
+    """
+    ordered = placement.get_strategy(strategy)(placement.candidates(resources))
+    with transaction.atomic():
+        resource = ordered.select_for_update(skip_locked=True, of=('self',)).first()
+        if resource is not None:
+            reserve(resource, user, used_for)
+    return resource
 
 
 def update_reservation(resource: Resource):
     logger.info(f"Reservation being being updated user={resource.user.username} resource={resource}")
     resource.last_check_in = now()
     resource.save()
+    schedule_lease(resource)
 
 
 def refresh_reservation(resource: Resource):
     logger.info(f"Reservation device shares being refresh resource={resource}")
     resource.last_check_in = now()
-    for_all_devices(resource.device_set.all(), 'refresh')
+    for_all_devices(resource_devices(resource), 'refresh')
     resource.save()
+    schedule_lease(resource)
 
 
 def release_reservation(resource):
     with transaction.atomic():
         logger.info(f"Reservation being released user={getattr(resource.user,'username', None)} used_for={resource.used_for} resource={resource}")
-        for_all_devices(resource.device_set.all(), 'unshare')
-        resource.user = None
-        resource.used_for = ""
-        resource.use_password = ""
-        resource.last_check_in = None
+        for_all_devices(resource_devices(resource), 'unshare')
+        for field, value in RELEASED_FIELDS.items():
+            setattr(resource, field, value)
         resource.save()
+    cancel_leases([resource.pk])
+    RemoteHost.poll_soon([resource.pk])
+    resources_released.send(sender=Resource, pools=[resource.pool_id])
+
+
+def release_expired_reservations(resources: Optional[QuerySet] = None) -> List[str]:
+    """
+    Release every reservation, of `resources` if given, past its expiry, returning the names of the released
+    resources.
+
+    Expired leases are found through the indexed expiry columns and locked in one query so the cost follows the
+    number of expired leases rather than active ones. Rows another transaction is busy with are skipped until the
+    next sweep. Resources whose devices unshared cleanly are cleared together in a single UPDATE, any that failed
+    keep their reservation and are tried again next time.
+    """
+    current_time = now()
+    with transaction.atomic():
+        if resources is None:
+            resources = Resource.everything.all()
+        expired = resources.select_for_update(skip_locked=True, of=('self',)) \
+            .filter(Q(reservation_expires_at__lte=current_time) | Q(checkin_expires_at__lte=current_time)) \
+            .select_related('pool').prefetch_related(prefetch_devices())
+        released = []
+        for resource in expired:
+            logger.info(f"Reservation expired user_id={resource.user_id} used_for={resource.used_for} "
+                        f"resource={resource.pk}")
+            try:
+                for_all_devices(resource.device_set.all(), 'unshare')
+            except (USB_Quartermaster_Exception, AbstractShareableDeviceDriver.DeviceError, OSError):
+                logger.exception(f"Could not release expired reservation of {resource.pk}, will retry")
+                continue
+            released.append(resource.pk)
+        if released:
+            Resource.everything.filter(pk__in=released).update(**RELEASED_FIELDS)
+    if released:
+        cancel_leases(released)
+        RemoteHost.poll_soon(released)
+        pools = Resource.everything.filter(pk__in=released).values_list('pool', flat=True).distinct()
+        resources_released.send(sender=Resource, pools=list(pools))
+    return released
+
+
+def release_due_leases(scheduler: LeaseScheduler) -> List[str]:
+    """Release the reservations whose leases the scheduler says are due, returning the names of those released"""
+    due = scheduler.claim_due(now())
+    if not due:
+        return []
+    released = release_expired_reservations(Resource.everything.filter(pk__in=due))
+    # A check in may have moved the expiry after we read the schedule, those reservations go back in. Ones that
+    # have expired but could not be released are left to the sweep rather than retried straight away.
+    current_time = now()
+    for resource in Resource.everything.filter(pk__in=due, user__isnull=False).exclude(pk__in=released):
+        expires_at = lease_expiry(resource)
+        if expires_at is not None and expires_at > current_time:
+            scheduler.schedule(resource.pk, expires_at)
+    return released
+
+
+def request_reservation(pool: Pool, user: settings.AUTH_USER_MODEL, used_for: str,
+                        priority: int = 0) -> ReservationRequest:
+    """Join the line for the next free resource of the pool, see grant_waiting_requests()"""
+    logger.info(f"Reservation requested user={user.username} used_for={used_for} pool={pool.pk} priority={priority}")
+    return ReservationRequest.objects.create(pool=pool, user=user, used_for=used_for, priority=priority)
+
+
+def grant_waiting_requests(pool_pk: str) -> List[Resource]:
+    """
+    Hand free resources of the pool to the requests waiting for them, in line order, until either runs out. The
+    reservations are made with start_reservation(), returned so the caller can share their devices.
+    """
+    granted = []
+    while True:
+        with transaction.atomic():
+            request = ReservationRequest.objects.waiting().filter(pool_id=pool_pk) \
+                .select_for_update(skip_locked=True, of=('self',)).select_related('user').first()
+            if request is None:
+                break
+            resource = claim_any(Resource.objects.filter(pool_id=pool_pk), request.user, request.used_for,
+                                 reserve=start_reservation)
+            if resource is None:
+                break
+            request.state = ReservationRequest.GRANTED
+            request.resource = resource
+            request.granted_at = now()
+            request.save(update_fields=['state', 'resource', 'granted_at'])
+        logger.info(f"Reservation request {request.pk} granted {resource}")
+        granted.append(resource)
+    return granted
+
+
+def expire_reservation_requests() -> int:
+    """Drop waiting requests nobody has asked about for RESERVATION_QUEUE_TIMEOUT, returning how many there were"""
+    abandoned = ReservationRequest.objects.filter(state=ReservationRequest.WAITING,
+                                                  last_seen_at__lt=now() - settings.RESERVATION_QUEUE_TIMEOUT)
+    return abandoned.update(state=ReservationRequest.EXPIRED)
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/2.2/ref/settings/
 """
 import os
+from datetime import timedelta
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 from pathlib import Path
 
@@ -110,7 +111,8 @@ HUEY = {
         'immediate': False
     },
     'consumer': {
-        'workers': 2,
+        # Hosts are polled by a task each, this bounds how many are polled at once
+        'workers': 8,
         'worker_type': 'thread',
     },
 }
@@ -136,3 +138,74 @@ LOGGING = {
 
 SSH_CONNECT_TIMEOUT = 1.0
 SSH_EXEC_TIMEOUT = 2.0
+
+# Authenticated SSH connections are kept open and reused, they are closed after being idle this many seconds
+SSH_POOL_IDLE_TIMEOUT = 300.0
+SSH_KEEPALIVE_INTERVAL = 30
+
+# After this many failed connections a remote host is considered down and calls to it fail fast. It is retried after
+# a backoff that doubles with each further failure.
+HOST_FAILURE_THRESHOLD = 3
+HOST_RETRY_BACKOFF = timedelta(seconds=30)
+HOST_RETRY_BACKOFF_MAX = timedelta(minutes=15)
+
+# Commands run at once on a single host by each server process, more wait in line for up to the queue timeout.
+# Hosts can set their own limit with "max_concurrent_commands" in their config. The limit is per process, not per
+# server: a host can see this many commands from every web server and task worker process at once, so size it with
+# the number of processes in mind. Queue statistics are at api/v1/status/host_queues for the web process answering.
+HOST_MAX_CONCURRENT_COMMANDS = 4
+HOST_QUEUE_TIMEOUT = timedelta(seconds=30)
+
+# Hosts that completed a command within this window are treated as reachable without a separate probe. Keep it below
+# HOST_POLL_MIN_INTERVAL so each poll finds out for itself rather than trusting the poll before.
+HOST_REACHABLE_FRESHNESS = timedelta(seconds=30)
+
+# Command output beyond this is dropped. When output is streamed to a parser only the preview is kept for errors.
+SSH_MAX_OUTPUT_BYTES = 4 * 1024 * 1024
+SSH_STREAM_PREVIEW_BYTES = 4096
+
+# Agent hub, run with `manage.py run_agent_hub`. Agents on remote hosts connect to the listen address, the rest of the
+# server sends requests for them to the control address.
+AGENT_HUB_LISTEN_ADDRESS = ('0.0.0.0', 7590)
+AGENT_HUB_CONTROL_LISTEN_ADDRESS = ('127.0.0.1', 7591)
+AGENT_HUB_CONTROL_ADDRESS = ('127.0.0.1', 7591)
+# Shared secret every control request has to carry, the hub won't start without one
+AGENT_HUB_CONTROL_TOKEN = None
+# Certificate and key agents connections are wrapped in, agents send their token so run the hub with --insecure only
+# for testing
+AGENT_HUB_TLS_CERTFILE = None
+AGENT_HUB_TLS_KEYFILE = None
+AGENT_REQUEST_TIMEOUT = 10.0
+# Inventory reported by an agent is used for polling until it is this old, after that the agent is asked directly
+AGENT_INVENTORY_MAX_AGE = timedelta(seconds=60)
+
+# Hosts are polled every HOST_POLL_MIN_INTERVAL while their devices are reserved or changing. Hosts that are stable or
+# down are polled less often, the interval growing by HOST_POLL_BACKOFF times each poll up to HOST_POLL_MAX_INTERVAL.
+# Hosts can set their own limits. Poll cycles run once a minute so shorter intervals are rounded up to that.
+HOST_POLL_MIN_INTERVAL = timedelta(minutes=1)
+HOST_POLL_MAX_INTERVAL = timedelta(minutes=15)
+HOST_POLL_BACKOFF = 2
+
+# A host's poll that hasn't finished after HOST_POLL_TIMEOUT is assumed to have died and the host is polled again.
+# Hosts overdue by more than HOST_POLL_STRAGGLER_AGE are reported as stragglers at the start of each poll cycle.
+HOST_POLL_TIMEOUT = timedelta(minutes=5)
+HOST_POLL_STRAGGLER_AGE = timedelta(minutes=3)
+
+# Sharing or releasing a resource works on this many of its hosts at once, devices on the same host go one at a time
+DEVICE_OPERATION_WORKERS = 8
+
+# Longest a client may wait on a pending reservation with ?wait=<seconds>, and how often it is checked meanwhile.
+# A waiting client holds a web worker for the whole wait and costs a query every interval, keep the maximum short
+# enough that a burst of waiting clients can't tie up every worker.
+RESERVATION_WAIT_MAX = timedelta(seconds=10)
+RESERVATION_WAIT_INTERVAL = timedelta(milliseconds=500)
+
+# How a resource is picked when reserving any resource of a pool, one of the names in quartermaster.placement
+RESERVATION_PLACEMENT_STRATEGY = 'least_recently_used'
+# Waiting reservation requests are dropped when their client hasn't asked about them for this long
+RESERVATION_QUEUE_TIMEOUT = timedelta(minutes=2)
+
+# Redis sorted set of reservation leases used by `manage.py run_lease_scheduler`, which looks for due leases at least
+# this often
+RESERVATION_LEASE_KEY = 'quartermaster.leases'
+RESERVATION_LEASE_POLL_INTERVAL = timedelta(seconds=2)
@@ -0,0 +1,73 @@
+"""
+Digests of what the last poll of each host found, so a poll that finds nothing has changed can skip reconciling the
+host's devices.
+
+A digest covers both sides, the host's snapshot and the rows of its devices including who has them reserved, so a
+change on either side means a full reconciliation. Digests are kept in the memory of the worker process, one that
+hasn't seen a host yet just reconciles it once.
+"""
+import hashlib
+import threading
+from typing import Dict, Hashable, Iterable
+
+from USB_Quartermaster_common import HostSnapshot
+
+
+class PollDigests(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._digests: Dict[Hashable, str] = {}
+        # Metrics
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def digest(snapshot: HostSnapshot, device_rows: Iterable[tuple]) -> str:
+        hasher = hashlib.sha1(snapshot.digest.encode())
+        hasher.update(repr(list(device_rows)).encode())
+        return hasher.hexdigest()
+
+    def unchanged(self, key: Hashable, digest: str) -> bool:
+        """Whether `digest` is the one recorded for `key` by the last poll, counts towards the hit rate"""
+        with self._lock:
+            hit = self._digests.get(key) == digest
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return hit
+
+    def record(self, key: Hashable, digest: str) -> None:
+        """Remember `digest` once the devices it was taken from have been reconciled"""
+        with self._lock:
+            self._digests[key] = digest
+
+    def forget(self, key: Hashable) -> None:
+        with self._lock:
+            self._digests.pop(key, None)
+
+    def forget_host(self, host_pk: int) -> None:
+        """Drop the digests of every driver of a host, keys being (host pk, driver identifier)"""
+        with self._lock:
+            for key in [key for key in self._digests if key[0] == host_pk]:
+                del self._digests[key]
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._digests)
+
+    def stats(self) -> dict:
+        with self._lock:
+            checks = self.hits + self.misses
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'hit_rate': self.hits / checks if checks else 0.0}
+
+    def clear(self) -> None:
+        with self._lock:
+            self._digests.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+poll_digests = PollDigests()
@@ -1,19 +1,79 @@
 import logging
-from typing import Iterable, TYPE_CHECKING, Optional, Type
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, TYPE_CHECKING, Optional, Type, List, Tuple
 
-import plugins
-from USB_Quartermaster_common import AbstractShareableDeviceDriver, AbstractCommunicator
+from django.conf import settings
+
+from USB_Quartermaster_common import AbstractShareableDeviceDriver, AbstractCommunicator, plugins, \
+    USB_Quartermaster_Exception
+from USB_Quartermaster_common.util import CallingThread
 
 if TYPE_CHECKING:
     from data.models import Device, RemoteHost
 
 logger = logging.getLogger(__name__)
 
+# What for_all_devices() needs of each device, load devices with select_related(*DEVICE_RELATED) to save queries
+DEVICE_RELATED = ('resource__pool', 'host')
+
+
+class DeviceOperationError(USB_Quartermaster_Exception):
+    """
+    Raised by for_all_devices() when more than one device failed, `errors` holds each device's exception
+    """
+
+    def __init__(self, method: str, errors: List[Tuple['Device', Exception]]):
+        self.errors = errors
+        failures = ', '.join(f"{device.pk}: {error}" for device, error in errors)
+        super().__init__(f"{method} failed for {len(errors)} devices, {failures}")
+
+
+def run_on_host(drivers: List[AbstractShareableDeviceDriver], method: str) -> List[Tuple['Device', Exception]]:
+    errors = []
+    for driver in drivers:
+        try:
+            getattr(driver, method)()
+        except Exception as e:
+            logger.warning(f"{method} failed for device {driver.device.pk} on host {driver.device.host_id}: {e}")
+            errors.append((driver.device, e))
+    return errors
+
 
 def for_all_devices(devices: Iterable['Device'], method: str):
+    """
+    Call `method` on the driver of each device. Hosts are worked on in parallel, devices on the same host one after
+    the other, so a resource spread over several hosts takes about as long as its slowest host. Every device is
+    tried even if some fail, afterwards a single failure is re-raised as is and several as a DeviceOperationError.
+
+    The worker threads don't touch the database, the devices are loaded here and anything the drivers write on the
+    way, like circuit breaker state, is handed back to this thread. That keeps it all in the caller's transaction.
+    """
+    by_host = defaultdict(list)
+    host_drivers = {}
     for device in devices:
+        # Whatever the drivers, and their log lines, read of the device is loaded now on this thread
+        str(device)
         driver = device.get_driver()
-        getattr(driver, method)()
+        # Devices on a host share its driver, and with it the one snapshot of the host they all decide from
+        driver.host_driver = host_drivers.setdefault((device.host_id, type(driver.host_driver)), driver.host_driver)
+        by_host[device.host_id].append(driver)
+
+    if len(by_host) <= 1:
+        errors = [error for drivers in by_host.values() for error in run_on_host(drivers, method)]
+    else:
+        calling_thread = CallingThread()
+        with ThreadPoolExecutor(max_workers=min(len(by_host), settings.DEVICE_OPERATION_WORKERS),
+                                thread_name_prefix=f"for_all_devices_{method}") as executor:
+            futures = [executor.submit(calling_thread.run, run_on_host, drivers, method)
+                       for drivers in by_host.values()]
+            calling_thread.serve(futures)
+        errors = [error for future in futures for error in future.result()]
+
+    if len(errors) == 1:
+        raise errors[0][1]
+    if errors:
+        raise DeviceOperationError(method, errors)
 
 
 def get_driver_obj(device: 'Device') -> AbstractShareableDeviceDriver:
@@ -29,7 +89,7 @@ def get_communicator_class(name: str) -> Optional[Type[AbstractCommunicator]]:
     for communicator_impl in plugins.communicator_classes():
         if name == communicator_impl.IDENTIFIER:
             return communicator_impl
-        return None
+    return None
 
 
 def get_communicator_obj(remote_host: 'RemoteHost') -> AbstractCommunicator:
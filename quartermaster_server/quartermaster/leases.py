@@ -0,0 +1,113 @@
+"""
+Reservation leases kept in a Redis sorted set scored by expiry time, so expired reservations can be released within
+seconds by `manage.py run_lease_scheduler` rather than waiting for the once a minute sweep.
+
+The schedule is only a hint about when to look. The database stays the authority on whether a reservation has
+expired and the sweep in data.tasks still runs, so a lost or stale schedule delays releases but never causes wrong
+ones.
+"""
+import logging
+from datetime import datetime, timezone
+from typing import List, Optional, Callable
+
+from django.conf import settings
+from django.db import transaction
+from huey.contrib.djhuey import HUEY
+from redis.exceptions import RedisError
+
+from data.models import Resource
+
+logger = logging.getLogger(__name__)
+
+
+class LeaseScheduler(object):
+    def __init__(self, connection, key: str):
+        self.connection = connection
+        self.key = key
+
+    def schedule(self, resource_pk: str, expires_at: datetime) -> None:
+        """Add the lease, or move it if it is already scheduled"""
+        self.connection.zadd(self.key, {resource_pk: expires_at.timestamp()})
+
+    def cancel(self, resource_pk: str) -> None:
+        self.connection.zrem(self.key, resource_pk)
+
+    def claim_due(self, until: datetime) -> List[str]:
+        """
+        Take the leases due by `until` off the schedule. Only the caller whose ZREM removes a lease gets it, so
+        several schedulers can run without releasing the same reservation twice.
+        """
+        due = self.connection.zrangebyscore(self.key, '-inf', until.timestamp())
+        claimed = []
+        for resource_pk in due:
+            if self.connection.zrem(self.key, resource_pk):
+                claimed.append(resource_pk.decode() if isinstance(resource_pk, bytes) else resource_pk)
+        return claimed
+
+    def next_due(self) -> Optional[datetime]:
+        first = self.connection.zrange(self.key, 0, 0, withscores=True)
+        if not first:
+            return None
+        return datetime.fromtimestamp(first[0][1], tz=timezone.utc)
+
+    def __len__(self):
+        return self.connection.zcard(self.key)
+
+
+def get_lease_scheduler() -> Optional[LeaseScheduler]:
+    """The scheduler on huey's Redis connection, None when huey isn't using Redis, as in immediate mode"""
+    connection = getattr(HUEY.storage, 'conn', None)
+    if connection is None:
+        return None
+    return LeaseScheduler(connection, settings.RESERVATION_LEASE_KEY)
+
+
+def lease_expiry(resource: Resource) -> Optional[datetime]:
+    """When the reservation expires, whichever of its limits comes first, None if it isn't reserved"""
+    expiries = [expiry for expiry in (resource.reservation_expires_at, resource.checkin_expires_at)
+                if expiry is not None]
+    return min(expiries) if expiries else None
+
+
+def update_schedule(action: Callable[[LeaseScheduler], None]) -> None:
+    """Run `action` once the current transaction commits. Redis being unavailable only delays releases to the sweep"""
+
+    def run():
+        scheduler = get_lease_scheduler()
+        if scheduler is None:
+            return
+        try:
+            action(scheduler)
+        except RedisError as e:
+            logger.warning(f"Could not update reservation lease schedule, expiry falls back to the sweep: {e}")
+
+    transaction.on_commit(run)
+
+
+def schedule_lease(resource: Resource) -> None:
+    resource_pk, expires_at = resource.pk, lease_expiry(resource)
+    if expires_at is None:
+        update_schedule(lambda scheduler: scheduler.cancel(resource_pk))
+    else:
+        update_schedule(lambda scheduler: scheduler.schedule(resource_pk, expires_at))
+
+
+def cancel_leases(resource_pks: List[str]) -> None:
+    def cancel(scheduler: LeaseScheduler):
+        for resource_pk in resource_pks:
+            scheduler.cancel(resource_pk)
+
+    update_schedule(cancel)
+
+
+def schedule_all(scheduler: LeaseScheduler) -> int:
+    """Put every current reservation in the schedule, for leases made while no scheduler was running"""
+    count = 0
+    reserved = Resource.everything.filter(user__isnull=False) \
+        .only('pk', 'reservation_expires_at', 'checkin_expires_at')
+    for resource in reserved.iterator():
+        expires_at = lease_expiry(resource)
+        if expires_at is not None:
+            scheduler.schedule(resource.pk, expires_at)
+            count += 1
+    return count
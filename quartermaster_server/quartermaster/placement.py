@@ -0,0 +1,70 @@
+"""
+Placement strategies decide which free resource of a pool a "reserve any" request gets.
+
+A strategy takes a queryset of free resources and returns it ordered best first. The allocator locks and claims the
+first row nobody else is busy with, so strategies only ever order, they never pick.
+"""
+import logging
+from typing import Callable, Dict, Optional
+
+from django.conf import settings
+from django.db.models import QuerySet, Count, OuterRef, Subquery, Value, F
+from django.db.models.functions import Coalesce
+
+from USB_Quartermaster_common import HostHealth
+from data.models import Device
+
+logger = logging.getLogger(__name__)
+
+Strategy = Callable[[QuerySet], QuerySet]
+
+strategies: Dict[str, Strategy] = {}
+
+
+def register_strategy(name: str) -> Callable[[Strategy], Strategy]:
+    """Decorator to make a strategy available by name, to the API and in settings"""
+
+    def register(strategy: Strategy) -> Strategy:
+        strategies[name] = strategy
+        return strategy
+
+    return register
+
+
+def get_strategy(name: Optional[str] = None) -> Strategy:
+    if name is None:
+        name = settings.RESERVATION_PLACEMENT_STRATEGY
+    try:
+        return strategies[name]
+    except KeyError:
+        raise ValueError(f"Unknown placement strategy '{name}', choices are {', '.join(sorted(strategies))}")
+
+
+def candidates(resources: QuerySet) -> QuerySet:
+    """Resources that can be reserved, skipping those on hosts known to be down as sharing their devices would fail"""
+    return resources.filter(user=None).exclude(device__host__health_state=HostHealth.OPEN)
+
+
+def with_host_load(resources: QuerySet) -> QuerySet:
+    """Annotate host_load, how many reserved devices share a host with the resource's devices"""
+    in_use = Device.everything.filter(host__device__resource=OuterRef('pk'), resource__user__isnull=False) \
+        .order_by().values('host__device__resource').annotate(count=Count('pk', distinct=True)).values('count')
+    return resources.annotate(host_load=Coalesce(Subquery(in_use), Value(0)))
+
+
+@register_strategy('least_recently_used')
+def least_recently_used(resources: QuerySet) -> QuerySet:
+    """Rotate through the pool so wear and any lingering state are spread over all resources"""
+    return resources.order_by(F('last_reserved').asc(nulls_first=True), 'name')
+
+
+@register_strategy('spread')
+def spread(resources: QuerySet) -> QuerySet:
+    """Prefer resources on the least busy hosts, keeping load and the impact of one host failing low"""
+    return with_host_load(resources).order_by('host_load', F('last_reserved').asc(nulls_first=True), 'name')
+
+
+@register_strategy('pack')
+def pack(resources: QuerySet) -> QuerySet:
+    """Prefer hosts that are already busy, keeping whole hosts free for maintenance or resources that need them"""
+    return with_host_load(resources).order_by('-host_load', F('last_reserved').asc(nulls_first=True), 'name')
@@ -20,7 +20,8 @@ ALLOWED_HOSTS = ['backend', 'localhost', parsed_server_base_url.netloc]
 INSTALLED_APPS.extend([
     'Teamcity',
     'UsbipOverSSH',
-    'VirtualHereOverSSH'
+    'VirtualHereOverSSH',
+    'USB_Quartermaster_Agent',
 ])
 
 DATABASES = {
@@ -51,6 +52,15 @@ cUILVHN/ALWmer4r9A+HAAAAGXRpbS5sYXVyZW5jZUBzcGYzLXRvcGF6LTEBAgME
 -----END OPENSSH PRIVATE KEY-----
 """))
 
+########### Agent hub ###########
+# The hub runs in its own container so its control socket has to be reachable from the others, keep 7591 off the
+# published ports. Control requests must carry the token all the same.
+AGENT_HUB_CONTROL_LISTEN_ADDRESS = ('0.0.0.0', 7591)
+AGENT_HUB_CONTROL_ADDRESS = ('agent_hub', 7591)
+AGENT_HUB_CONTROL_TOKEN = 'REPLACE_THIS'
+AGENT_HUB_TLS_CERTFILE = 'REPLACE_THIS'
+AGENT_HUB_TLS_KEYFILE = 'REPLACE_THIS'
+
 ########### TeamCity Intergration ###########
 TEAMCITY_USER = 'REPLACE_THIS'
 TEAMCITY_PASSWORD = 'REPLACE_THIS'
@@ -1,11 +1,13 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 from unittest.mock import MagicMock
 
 import pytest
 # from quartermaster_server.data.models import Pool, Resource, Device
+from django.utils.timezone import now
+from huey.contrib.djhuey import HUEY
 from pytz import utc
 
-from data.models import Resource
+from data.models import Resource, ReservationRequest
 from quartermaster import allocator
 
 
@@ -43,3 +45,194 @@ def test_release_reservation(sample_shared_resource, monkeypatch):
     assert 'unshare' in mock_for_all_devices.call_args[0]
     sample_shared_resource.refresh_from_db(fields=['user'])
     assert sample_shared_resource.user is None
+
+
+@pytest.mark.django_db(transaction=True)
+def test_reservation_sets_expiry(admin_user, sample_unshared_resource: Resource, monkeypatch, settings):
+    monkeypatch.setattr(allocator, 'for_all_devices', MagicMock())
+    allocator.make_reservation(sample_unshared_resource, admin_user, used_for='TEST')
+    sample_unshared_resource.refresh_from_db()
+    assert sample_unshared_resource.reservation_expires_at == \
+           sample_unshared_resource.last_reserved + settings.RESERVATION_MAX_MINUTES
+    assert sample_unshared_resource.checkin_expires_at == \
+           sample_unshared_resource.last_check_in + settings.RESERVATION_CHECKIN_TIMEOUT_MINUTES
+
+    allocator.release_reservation(sample_unshared_resource)
+    sample_unshared_resource.refresh_from_db()
+    assert sample_unshared_resource.reservation_expires_at is None
+    assert sample_unshared_resource.checkin_expires_at is None
+
+
+@pytest.mark.django_db(transaction=True)
+def test_release_expired_reservations(sample_shared_resource, sample_unshared_resource, admin_user, monkeypatch,
+                                      settings):
+    mock_for_all_devices = MagicMock()
+    monkeypatch.setattr(allocator, 'for_all_devices', mock_for_all_devices)
+    sample_shared_resource.last_reserved = now()
+    sample_shared_resource.last_check_in = now() - settings.RESERVATION_CHECKIN_TIMEOUT_MINUTES - timedelta(seconds=1)
+    sample_shared_resource.save()
+    sample_unshared_resource.user = admin_user
+    sample_unshared_resource.last_reserved = now()
+    sample_unshared_resource.last_check_in = now()
+    sample_unshared_resource.save()
+
+    assert allocator.release_expired_reservations() == [sample_shared_resource.pk]
+
+    assert mock_for_all_devices.call_count == 1
+    sample_shared_resource.refresh_from_db()
+    assert sample_shared_resource.user is None
+    assert sample_shared_resource.checkin_expires_at is None
+    sample_unshared_resource.refresh_from_db()
+    assert sample_unshared_resource.user == admin_user
+
+
+@pytest.mark.django_db(transaction=True)
+def test_make_reservation_lost_race(admin_user, django_user_model, sample_unshared_resource: Resource, monkeypatch):
+    monkeypatch.setattr(allocator, 'for_all_devices', MagicMock())
+    other_user = django_user_model.objects.create(username='other')
+    stale_copy = Resource.objects.get(pk=sample_unshared_resource.pk)
+
+    allocator.make_reservation(sample_unshared_resource, admin_user, used_for='TEST')
+    assert stale_copy.user is None
+    with pytest.raises(allocator.ResourceUnavailable):
+        allocator.make_reservation(stale_copy, other_user, used_for='TEST')
+
+    # The loser sees who won, the winner keeps the reservation
+    assert stale_copy.user == admin_user
+    sample_unshared_resource.refresh_from_db()
+    assert sample_unshared_resource.user == admin_user
+    assert sample_unshared_resource.use_password == stale_copy.use_password
+
+
+@pytest.mark.django_db(transaction=True)
+def test_claim_any(admin_user, sample_pool, sample_shared_resource, sample_unshared_resource, monkeypatch):
+    monkeypatch.setattr(allocator, 'for_all_devices', MagicMock())
+    other_unshared_resource = Resource.objects.create(pool=sample_pool, name="RESOURCE_3")
+    pool_resources = Resource.objects.filter(pool=sample_pool)
+
+    claimed = {allocator.claim_any(pool_resources, admin_user, used_for='TEST').pk for _ in range(0, 2)}
+
+    assert claimed == {sample_unshared_resource.pk, other_unshared_resource.pk}
+    assert allocator.claim_any(pool_resources, admin_user, used_for='TEST') is None
+    assert Resource.objects.filter(pool=sample_pool, user=admin_user).count() == 3
+
+
+@pytest.mark.django_db(transaction=True)
+def test_start_and_finish_reservation(admin_user, sample_unshared_resource: Resource, monkeypatch):
+    mock_for_all_devices = MagicMock()
+    monkeypatch.setattr(allocator, 'for_all_devices', mock_for_all_devices)
+
+    allocator.start_reservation(sample_unshared_resource, admin_user, used_for='TEST')
+    assert mock_for_all_devices.call_count == 0
+    sample_unshared_resource.refresh_from_db()
+    assert sample_unshared_resource.user == admin_user
+    assert sample_unshared_resource.provisioning_state == Resource.PROVISIONING_PENDING
+
+    allocator.finish_reservation(sample_unshared_resource.pk, sample_unshared_resource.use_password)
+    assert 'share' in mock_for_all_devices.call_args[0]
+    sample_unshared_resource.refresh_from_db()
+    assert sample_unshared_resource.provisioning_state == Resource.PROVISIONING_READY
+
+
+@pytest.mark.django_db(transaction=True)
+def test_finish_reservation_failed(admin_user, sample_unshared_resource: Resource, monkeypatch):
+    monkeypatch.setattr(allocator, 'for_all_devices', MagicMock(side_effect=OSError("host went away")))
+    allocator.start_reservation(sample_unshared_resource, admin_user, used_for='TEST')
+
+    allocator.finish_reservation(sample_unshared_resource.pk, sample_unshared_resource.use_password)
+
+    sample_unshared_resource.refresh_from_db()
+    assert sample_unshared_resource.provisioning_state == Resource.PROVISIONING_FAILED
+    assert sample_unshared_resource.provisioning_error == "host went away"
+    # The reservation is kept so the client can see what happened, it releases it or lets it expire
+    assert sample_unshared_resource.user == admin_user
+
+
+@pytest.mark.django_db(transaction=True)
+def test_finish_reservation_after_release(admin_user, sample_unshared_resource: Resource, monkeypatch):
+    mock_for_all_devices = MagicMock()
+    monkeypatch.setattr(allocator, 'for_all_devices', mock_for_all_devices)
+    allocator.start_reservation(sample_unshared_resource, admin_user, used_for='TEST')
+    use_password = sample_unshared_resource.use_password
+    allocator.release_reservation(sample_unshared_resource)
+    mock_for_all_devices.reset_mock()
+
+    allocator.finish_reservation(sample_unshared_resource.pk, use_password)
+    assert mock_for_all_devices.call_count == 0
+
+
+@pytest.mark.django_db(transaction=True)
+def test_finish_reservation_released_while_sharing(admin_user, django_user_model, sample_unshared_resource: Resource,
+                                                   monkeypatch):
+    calls = []
+
+    def for_all_devices(devices, method):
+        calls.append(method)
+        if method == 'share' and calls.count('share') == 1:
+            # The client gave up and released it while the devices were being shared
+            allocator.release_reservation(Resource.everything.get(pk=sample_unshared_resource.pk))
+
+    monkeypatch.setattr(allocator, 'for_all_devices', for_all_devices)
+    allocator.start_reservation(sample_unshared_resource, admin_user, used_for='TEST')
+    use_password = sample_unshared_resource.use_password
+
+    allocator.finish_reservation(sample_unshared_resource.pk, use_password)
+    # Released before the share finished so it is undone
+    assert calls == ['share', 'unshare', 'unshare']
+
+    # Unless the resource was reserved again meanwhile, its new reservation shares the same devices
+    calls.clear()
+    allocator.start_reservation(sample_unshared_resource, admin_user, used_for='TEST')
+    use_password = sample_unshared_resource.use_password
+    other = django_user_model.objects.create(username='other')
+
+    def release_and_reserve(devices, method):
+        calls.append(method)
+        if method == 'share' and calls.count('share') == 1:
+            resource = Resource.everything.get(pk=sample_unshared_resource.pk)
+            allocator.release_reservation(resource)
+            allocator.start_reservation(resource, other, used_for='TEST')
+
+    monkeypatch.setattr(allocator, 'for_all_devices', release_and_reserve)
+    allocator.finish_reservation(sample_unshared_resource.pk, use_password)
+    assert calls == ['share', 'unshare']
+
+
+@pytest.mark.django_db(transaction=True)
+def test_grant_waiting_requests(admin_user, django_user_model, sample_pool, sample_shared_resource,
+                                sample_unshared_resource, monkeypatch):
+    monkeypatch.setattr(allocator, 'for_all_devices', MagicMock())
+    monkeypatch.setattr(HUEY, 'immediate', True)
+    first, second, urgent = [django_user_model.objects.create(username=name) for name in ('first', 'second', 'urgent')]
+    first_request = allocator.request_reservation(sample_pool, first, used_for='TEST')
+    second_request = allocator.request_reservation(sample_pool, second, used_for='TEST')
+    urgent_request = allocator.request_reservation(sample_pool, urgent, used_for='TEST', priority=10)
+    assert [urgent_request.position, first_request.position, second_request.position] == [0, 1, 2]
+
+    # One resource is free, it goes to the highest priority
+    granted = allocator.grant_waiting_requests(sample_pool.pk)
+    assert [resource.pk for resource in granted] == [sample_unshared_resource.pk]
+    urgent_request.refresh_from_db()
+    assert urgent_request.state == ReservationRequest.GRANTED
+    assert urgent_request.resource == sample_unshared_resource
+    assert Resource.objects.get(pk=sample_unshared_resource.pk).user == urgent
+
+    # Releasing hands the resource straight on, then requests are served in the order they were made
+    allocator.release_reservation(sample_shared_resource)
+    sample_shared_resource.refresh_from_db()
+    assert sample_shared_resource.user == first
+    assert sample_shared_resource.provisioning_state == Resource.PROVISIONING_READY
+    second_request.refresh_from_db()
+    assert second_request.state == ReservationRequest.WAITING
+    assert second_request.position == 0
+
+
+@pytest.mark.django_db(transaction=True)
+def test_expire_reservation_requests(admin_user, sample_pool, settings):
+    request = allocator.request_reservation(sample_pool, admin_user, used_for='TEST')
+    assert allocator.expire_reservation_requests() == 0
+    ReservationRequest.objects.filter(pk=request.pk) \
+        .update(last_seen_at=now() - settings.RESERVATION_QUEUE_TIMEOUT - timedelta(seconds=1))
+    assert allocator.expire_reservation_requests() == 1
+    request.refresh_from_db()
+    assert request.state == ReservationRequest.EXPIRED
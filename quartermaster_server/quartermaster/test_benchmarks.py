@@ -0,0 +1,177 @@
+"""
+Benchmarks of the poll cycle and reservations against a simulated fleet of remote hosts.
+
+Each benchmark reports wall time, round trips to remote hosts and DB queries. The budgets below are the costs the
+code currently achieves, lower them when an optimisation lands so regressions fail CI. Run with
+`pytest -m benchmark --log-cli-level=INFO` to see the reports.
+"""
+import json
+import logging
+import time
+from typing import NamedTuple, Callable
+
+import pytest
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from huey.contrib.djhuey import HUEY
+
+from USB_Quartermaster_Simulated import SimulatedFleet
+from USB_Quartermaster_common.Communicator import contact_tracker
+from data.models import Pool, Resource, Device, RemoteHost
+from data.tasks import confirm_device_state
+from quartermaster import allocator
+from quartermaster.digests import poll_digests
+
+logger = logging.getLogger(__name__)
+
+POLL_ROUND_TRIPS_PER_HOST = 1
+# Four of these mark the host as being polled, load it, look for reservations on it and schedule its next poll
+POLL_QUERIES_PER_HOST = 7
+POLL_QUERIES_PER_DEVICE = 1
+RESERVATION_ROUND_TRIPS_PER_DEVICE = 2
+
+SIMULATED_LATENCY = 0.001
+SIMULATED_JITTER = 0.001
+
+
+class BenchmarkResult(NamedTuple):
+    name: str
+    wall_time: float
+    round_trips: int
+    commands: int
+    queries: int
+
+    def __str__(self):
+        return f"{self.name}: wall_time={self.wall_time:.3f}s round_trips={self.round_trips} " \
+               f"commands={self.commands} queries={self.queries}"
+
+
+def measure(name: str, fleet: SimulatedFleet, func: Callable) -> BenchmarkResult:
+    fleet.reset_counters()
+    with CaptureQueriesContext(connection) as queries:
+        start = time.perf_counter()
+        func()
+        wall_time = time.perf_counter() - start
+    result = BenchmarkResult(name=name, wall_time=wall_time, round_trips=fleet.round_trips,
+                             commands=fleet.commands, queries=len(queries))
+    logger.info(str(result))
+    return result
+
+
+def make_hosts_due():
+    """Have the next poll cycle poll every host, rather than only those whose poll interval is up"""
+    RemoteHost.objects.update(next_poll_at=None)
+
+
+@pytest.fixture()
+def make_fleet(monkeypatch):
+    """
+    Builds a simulated fleet and the matching RemoteHost, Resource and Device records. Resource n holds device n of
+    every host so reservations span hosts the way multi device resources do.
+    """
+
+    def _make_fleet(driver: str, hosts: int, devices_per_host: int, **fleet_options) -> SimulatedFleet:
+        fleet = SimulatedFleet(hosts=hosts, devices_per_host=devices_per_host, latency=SIMULATED_LATENCY,
+                               jitter=SIMULATED_JITTER, **fleet_options)
+        monkeypatch.setattr(RemoteHost, 'get_communicator_obj', lambda host: fleet.communicator(host))
+        monkeypatch.setattr(HUEY, 'immediate', True)
+        contact_tracker.clear()
+        poll_digests.clear()
+
+        pool = Pool.objects.create(name='SIMULATED_POOL')
+        resources = [Resource.objects.create(pool=pool, name=f"SIMULATED_{index}")
+                     for index in range(devices_per_host)]
+        for simulated_host in fleet.hosts.values():
+            host = RemoteHost.objects.create(address=simulated_host.address, communicator='SSH',
+                                             type='Linux_AMD64', config_json='{}')
+            for resource, simulated_device in zip(resources, simulated_host.devices.values()):
+                if driver == 'VirtualHere':
+                    config = {'device_address': f"{simulated_host.VH_HUB_NAME}.{simulated_device.vh_address}"}
+                else:
+                    config = {'bus_id': simulated_device.bus_id}
+                Device.objects.create(resource=resource, driver=driver, host=host, config_json=json.dumps(config),
+                                      name=f"{simulated_host.address}-{simulated_device.bus_id}")
+        return fleet
+
+    return _make_fleet
+
+
+@pytest.mark.benchmark
+@pytest.mark.django_db
+@pytest.mark.parametrize('driver', ('USBIP', 'VirtualHere'))
+def test_poll_cycle(make_fleet, driver):
+    hosts, devices_per_host = 20, 8
+    fleet = make_fleet(driver, hosts=hosts, devices_per_host=devices_per_host)
+
+    measure(f"poll {driver} first cycle", fleet, confirm_device_state.call_local)
+    make_hosts_due()
+    result = measure(f"poll {driver}", fleet, confirm_device_state.call_local)
+
+    assert result.round_trips <= hosts * POLL_ROUND_TRIPS_PER_HOST
+    assert result.queries <= 1 + hosts * POLL_QUERIES_PER_HOST + hosts * devices_per_host * POLL_QUERIES_PER_DEVICE
+
+
+@pytest.mark.benchmark
+@pytest.mark.django_db
+@pytest.mark.parametrize('driver', ('USBIP', 'VirtualHere'))
+def test_poll_cycle_unchanged(make_fleet, driver):
+    hosts, devices_per_host = 20, 8
+    fleet = make_fleet(driver, hosts=hosts, devices_per_host=devices_per_host)
+    confirm_device_state.call_local()
+    make_hosts_due()
+
+    result = measure(f"poll {driver} unchanged", fleet, confirm_device_state.call_local)
+
+    # Each host is still asked for its state but with nothing changed none of the devices are gone through
+    assert result.round_trips <= hosts * POLL_ROUND_TRIPS_PER_HOST
+    assert result.queries <= 1 + hosts * POLL_QUERIES_PER_HOST
+    assert poll_digests.stats() == {'hits': hosts, 'misses': hosts, 'hit_rate': 0.5}
+
+
+@pytest.mark.benchmark
+@pytest.mark.django_db
+def test_poll_cycle_with_failures(make_fleet):
+    hosts, devices_per_host = 20, 8
+    fleet = make_fleet('USBIP', hosts=hosts, devices_per_host=devices_per_host, failure_rate=0.2)
+
+    measure("poll USBIP 20% failures first cycle", fleet, confirm_device_state.call_local)
+    make_hosts_due()
+    result = measure("poll USBIP 20% failures", fleet, confirm_device_state.call_local)
+
+    # Hosts that failed last cycle get a reachability probe from each host driver before the state query but must
+    # not be retried beyond that
+    assert result.round_trips <= hosts * (POLL_ROUND_TRIPS_PER_HOST + 2)
+
+
+@pytest.mark.benchmark
+@pytest.mark.django_db
+def test_poll_cycle_with_corrections(make_fleet, admin_user):
+    hosts, devices_per_host = 20, 8
+    fleet = make_fleet('USBIP', hosts=hosts, devices_per_host=devices_per_host)
+    confirm_device_state.call_local()
+    # Reserved without sharing, so the poll has to bind a device on every host
+    Resource.objects.filter(name='SIMULATED_0').update(user=admin_user)
+    make_hosts_due()
+
+    result = measure("poll USBIP correcting shares", fleet, confirm_device_state.call_local)
+
+    # The correction is decided from the poll's snapshot of the host, only the bind itself is another round trip
+    assert result.round_trips <= hosts * (POLL_ROUND_TRIPS_PER_HOST + 1)
+    assert all(host.devices['1-1'].shared for host in fleet.hosts.values())
+
+
+@pytest.mark.benchmark
+@pytest.mark.django_db
+@pytest.mark.parametrize('driver', ('USBIP', 'VirtualHere'))
+def test_reservation_cycle(make_fleet, admin_user, driver):
+    hosts, devices_per_host = 4, 2
+    fleet = make_fleet(driver, hosts=hosts, devices_per_host=devices_per_host)
+    resource = Resource.objects.get(name='SIMULATED_0')
+
+    reserve = measure(f"make_reservation {driver} {hosts} devices", fleet,
+                      lambda: allocator.make_reservation(resource, admin_user, used_for='benchmark'))
+    release = measure(f"release_reservation {driver} {hosts} devices", fleet,
+                      lambda: allocator.release_reservation(resource))
+
+    assert reserve.round_trips <= hosts * RESERVATION_ROUND_TRIPS_PER_DEVICE
+    assert release.round_trips <= hosts * RESERVATION_ROUND_TRIPS_PER_DEVICE
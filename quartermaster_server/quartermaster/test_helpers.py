@@ -0,0 +1,134 @@
+import json
+import threading
+import time
+
+import pytest
+from django.db.backends.base.base import BaseDatabaseWrapper
+
+from USB_Quartermaster_Simulated import SimulatedFleet
+from USB_Quartermaster_Simulated.fleet import SimulatedCommunicator, SimulatedConnectionError
+from USB_Quartermaster_common import CircuitBreaker, CommunicatorError
+from data.models import Device, RemoteHost, Resource
+from quartermaster.allocator import resource_devices
+from quartermaster.helpers import for_all_devices, DeviceOperationError
+
+
+class FakeHostDriver(object):
+    pass
+
+
+class FakeDriver(object):
+    def __init__(self, device: 'FakeDevice'):
+        self.device = device
+        self.host_driver = FakeHostDriver()
+
+    def share(self):
+        self.device.calls.append(threading.current_thread().name)
+        self.device.host_drivers.append(self.host_driver)
+        time.sleep(self.device.delay)
+        if self.device.error is not None:
+            raise self.device.error
+
+
+class FakeDevice(object):
+    def __init__(self, pk: int, host_id: int, delay: float = 0.0, error: Exception = None):
+        self.pk = pk
+        self.host_id = host_id
+        self.delay = delay
+        self.error = error
+        self.calls = []
+        self.host_drivers = []
+
+    def get_driver(self) -> FakeDriver:
+        return FakeDriver(self)
+
+
+def test_for_all_devices_runs_hosts_in_parallel():
+    devices = [FakeDevice(pk, host_id=pk, delay=0.2) for pk in range(0, 4)]
+    start = time.monotonic()
+    for_all_devices(devices, 'share')
+    assert time.monotonic() - start < 0.6
+    assert all(len(device.calls) == 1 for device in devices)
+
+
+def test_for_all_devices_one_host_in_order():
+    devices = [FakeDevice(pk, host_id=1) for pk in range(0, 3)]
+    for_all_devices(devices, 'share')
+    # A single host doesn't need any threads
+    assert [device.calls for device in devices] == [[threading.current_thread().name]] * 3
+
+
+def test_for_all_devices_shares_host_drivers():
+    devices = [FakeDevice(0, host_id=0), FakeDevice(1, host_id=0), FakeDevice(2, host_id=1)]
+    for_all_devices(devices, 'share')
+    # Devices on a host decide from one snapshot of it, taken by the host driver they share
+    assert devices[0].host_drivers[0] is devices[1].host_drivers[0]
+    assert devices[0].host_drivers[0] is not devices[2].host_drivers[0]
+
+
+def test_for_all_devices_single_error_raised_as_is():
+    error = ValueError("nope")
+    devices = [FakeDevice(0, host_id=0, error=error), FakeDevice(1, host_id=1), FakeDevice(2, host_id=0)]
+    with pytest.raises(ValueError) as e:
+        for_all_devices(devices, 'share')
+    assert e.value is error
+    # The failure didn't stop the rest
+    assert all(len(device.calls) == 1 for device in devices)
+
+
+def test_for_all_devices_errors_aggregated():
+    devices = [FakeDevice(0, host_id=0, error=ValueError("a")), FakeDevice(1, host_id=1, error=OSError("b")),
+               FakeDevice(2, host_id=2)]
+    with pytest.raises(DeviceOperationError) as e:
+        for_all_devices(devices, 'share')
+    assert [(device.pk, str(error)) for device, error in e.value.errors] == [(0, "a"), (1, "b")]
+
+
+class BreakerCommunicator(SimulatedCommunicator):
+    """Keeps the host's circuit breaker up to date the way the SSH communicator does"""
+
+    def __init__(self, host: RemoteHost, fleet: SimulatedFleet):
+        super().__init__(host, fleet)
+        self.breaker = CircuitBreaker(host)
+
+    def execute_commands(self, commands):
+        self.breaker.before_call()
+        try:
+            responses = super().execute_commands(commands)
+        except CommunicatorError:
+            self.breaker.record_failure()
+            raise
+        self.breaker.record_success()
+        return responses
+
+
+@pytest.mark.django_db
+def test_for_all_devices_database_work_on_calling_thread(monkeypatch, sample_pool):
+    fleet = SimulatedFleet(hosts=2, devices_per_host=1)
+    monkeypatch.setattr(RemoteHost, 'get_communicator_obj', lambda host: BreakerCommunicator(host, fleet))
+    resource = Resource.objects.create(pool=sample_pool, name="SPANNING")
+    hosts = []
+    for simulated_host in fleet.hosts.values():
+        host = RemoteHost.objects.create(address=simulated_host.address, communicator='SSH', type='Linux_AMD64',
+                                         config_json='{}')
+        Device.objects.create(resource=resource, driver='USBIP', host=host, name=simulated_host.address,
+                              config_json=json.dumps({'bus_id': '1-1'}))
+        hosts.append(host)
+    fleet.hosts[hosts[1].address].reachable = False
+
+    query_threads = set()
+    cursor = BaseDatabaseWrapper.cursor
+
+    def recording_cursor(self):
+        query_threads.add(threading.current_thread())
+        return cursor(self)
+
+    monkeypatch.setattr(BaseDatabaseWrapper, 'cursor', recording_cursor)
+
+    with pytest.raises(SimulatedConnectionError):
+        for_all_devices(resource_devices(resource), 'share')
+
+    assert query_threads == {threading.current_thread()}
+    assert fleet.hosts[hosts[0].address].devices['1-1'].shared
+    # The breaker's writes still landed, they were made by this thread
+    assert RemoteHost.objects.get(pk=hosts[1].pk).health_failures == 1
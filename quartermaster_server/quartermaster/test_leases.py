@@ -0,0 +1,120 @@
+from datetime import timedelta
+from unittest.mock import MagicMock
+
+import pytest
+from django.db import DatabaseError
+from django.utils.timezone import now
+
+from data.management.commands import run_lease_scheduler
+from data.models import Resource
+from quartermaster import allocator, leases
+from quartermaster.leases import LeaseScheduler
+
+
+class FakeSortedSets(object):
+    """Just the sorted set commands the scheduler uses, with redis-py's return types"""
+
+    def __init__(self):
+        self.sets = {}
+
+    def zadd(self, key, mapping):
+        self.sets.setdefault(key, {}).update({member.encode(): score for member, score in mapping.items()})
+
+    def zrem(self, key, member):
+        member = member if isinstance(member, bytes) else member.encode()
+        return 1 if self.sets.get(key, {}).pop(member, None) is not None else 0
+
+    def zrangebyscore(self, key, minimum, maximum):
+        return [member for member, score in sorted(self.sets.get(key, {}).items(), key=lambda item: item[1])
+                if score <= maximum]
+
+    def zrange(self, key, start, end, withscores=False):
+        ordered = sorted(self.sets.get(key, {}).items(), key=lambda item: item[1])[start:end + 1]
+        return ordered if withscores else [member for member, _ in ordered]
+
+    def zcard(self, key):
+        return len(self.sets.get(key, {}))
+
+
+@pytest.fixture()
+def scheduler(monkeypatch) -> LeaseScheduler:
+    scheduler = LeaseScheduler(FakeSortedSets(), 'leases')
+    monkeypatch.setattr(leases, 'get_lease_scheduler', lambda: scheduler)
+    return scheduler
+
+
+def test_claim_due(scheduler):
+    current_time = now()
+    scheduler.schedule('soon', current_time + timedelta(seconds=1))
+    scheduler.schedule('later', current_time + timedelta(minutes=1))
+    scheduler.schedule('past', current_time - timedelta(seconds=1))
+    assert scheduler.next_due().timestamp() == pytest.approx((current_time - timedelta(seconds=1)).timestamp())
+
+    assert scheduler.claim_due(current_time + timedelta(seconds=2)) == ['past', 'soon']
+    assert len(scheduler) == 1
+    # Claimed leases are gone for everyone else
+    assert LeaseScheduler(scheduler.connection, 'leases').claim_due(current_time + timedelta(seconds=2)) == []
+
+    # Rescheduling moves rather than duplicates
+    scheduler.schedule('later', current_time)
+    assert len(scheduler) == 1
+    scheduler.cancel('later')
+    assert scheduler.next_due() is None
+
+
+@pytest.mark.django_db(transaction=True)
+def test_reservations_keep_schedule_current(scheduler, admin_user, sample_unshared_resource, monkeypatch):
+    monkeypatch.setattr(allocator, 'for_all_devices', MagicMock())
+
+    allocator.make_reservation(sample_unshared_resource, admin_user, used_for='TEST')
+    assert scheduler.next_due() == leases.lease_expiry(sample_unshared_resource)
+
+    allocator.update_reservation(sample_unshared_resource)
+    assert scheduler.next_due() == leases.lease_expiry(sample_unshared_resource)
+
+    allocator.release_reservation(sample_unshared_resource)
+    assert len(scheduler) == 0
+
+
+@pytest.mark.django_db(transaction=True)
+def test_release_due_leases(scheduler, admin_user, sample_shared_resource, sample_unshared_resource, monkeypatch,
+                            settings):
+    mock_for_all_devices = MagicMock()
+    monkeypatch.setattr(allocator, 'for_all_devices', mock_for_all_devices)
+    expired_check_in = now() - settings.RESERVATION_CHECKIN_TIMEOUT_MINUTES - timedelta(seconds=1)
+    sample_shared_resource.last_reserved = now()
+    sample_shared_resource.last_check_in = expired_check_in
+    sample_shared_resource.save()
+    scheduler.schedule(sample_shared_resource.pk, leases.lease_expiry(sample_shared_resource))
+    # Checked in after its lease was read, so the schedule is out of date
+    sample_unshared_resource.user = admin_user
+    sample_unshared_resource.last_reserved = now()
+    sample_unshared_resource.last_check_in = now()
+    sample_unshared_resource.save()
+    scheduler.schedule(sample_unshared_resource.pk, now() - timedelta(seconds=1))
+
+    assert allocator.release_due_leases(scheduler) == [sample_shared_resource.pk]
+
+    assert mock_for_all_devices.call_count == 1
+    assert Resource.objects.get(pk=sample_shared_resource.pk).user is None
+    assert Resource.objects.get(pk=sample_unshared_resource.pk).user == admin_user
+    assert scheduler.claim_due(now()) == []
+    assert scheduler.next_due() == leases.lease_expiry(Resource.objects.get(pk=sample_unshared_resource.pk))
+
+
+def test_lease_scheduler_command_survives_errors(scheduler, monkeypatch):
+    monkeypatch.setattr(run_lease_scheduler, 'get_lease_scheduler', lambda: scheduler)
+    monkeypatch.setattr(run_lease_scheduler, 'schedule_all', lambda scheduler: 0)
+    monkeypatch.setattr(run_lease_scheduler.time, 'sleep', lambda seconds: None)
+    close_old_connections = MagicMock()
+    monkeypatch.setattr(run_lease_scheduler, 'close_old_connections', close_old_connections)
+    # The database going away and a bug releasing one lease are both waited out, KeyboardInterrupt ends the test
+    release_due_leases = MagicMock(side_effect=[DatabaseError("gone away"), ValueError("bad lease"), [],
+                                                KeyboardInterrupt])
+    monkeypatch.setattr(run_lease_scheduler, 'release_due_leases', release_due_leases)
+
+    with pytest.raises(KeyboardInterrupt):
+        run_lease_scheduler.Command().handle()
+    assert release_due_leases.call_count == 4
+    # Connections are checked before each round
+    assert close_old_connections.call_count == 4
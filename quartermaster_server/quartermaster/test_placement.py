@@ -0,0 +1,67 @@
+from datetime import timedelta
+from unittest.mock import MagicMock
+
+import pytest
+from django.utils.timezone import now
+
+from USB_Quartermaster_common import HostHealth
+from data.models import Resource, RemoteHost, Device
+from quartermaster import allocator, placement
+
+
+@pytest.fixture()
+def placement_pool(sample_pool, admin_user):
+    """Host a has one reserved and one free resource, host b one free resource"""
+    hosts = {name: RemoteHost.objects.create(address=f"{name}.example.com", communicator="SSH", type='Linux_AMD64',
+                                             config_json='{}') for name in ('a', 'b')}
+    resources = {}
+    for name, host in (('a1', 'a'), ('a2', 'a'), ('b1', 'b')):
+        resources[name] = Resource.objects.create(pool=sample_pool, name=f"RESOURCE_{name}")
+        Device.objects.create(resource=resources[name], host=hosts[host], driver='USB_Quartermaster_Usbip',
+                              config_json='{"bus_id": "1-1"}', name="device")
+    resources['a1'].user = admin_user
+    resources['a1'].save()
+    return hosts, resources
+
+
+def first_choice(strategy: str) -> str:
+    return placement.get_strategy(strategy)(placement.candidates(Resource.objects.all())).first().name
+
+
+@pytest.mark.django_db
+def test_spread_and_pack(placement_pool):
+    assert first_choice('spread') == 'RESOURCE_b1'
+    assert first_choice('pack') == 'RESOURCE_a2'
+
+
+@pytest.mark.django_db
+def test_least_recently_used(placement_pool):
+    _, resources = placement_pool
+    resources['a2'].last_reserved = now() - timedelta(days=1)
+    resources['a2'].save()
+    # Never reserved goes first
+    assert first_choice('least_recently_used') == 'RESOURCE_b1'
+
+    resources['b1'].last_reserved = now()
+    resources['b1'].save()
+    assert first_choice('least_recently_used') == 'RESOURCE_a2'
+
+
+@pytest.mark.django_db
+def test_candidates_skip_unreachable_hosts(placement_pool):
+    hosts, _ = placement_pool
+    RemoteHost.objects.filter(pk=hosts['b'].pk).update(health_state=HostHealth.OPEN)
+    assert [resource.name for resource in placement.candidates(Resource.objects.all())] == ['RESOURCE_a2']
+
+
+def test_unknown_strategy():
+    with pytest.raises(ValueError):
+        placement.get_strategy('random')
+
+
+@pytest.mark.django_db(transaction=True)
+def test_claim_any_uses_strategy(placement_pool, admin_user, monkeypatch):
+    monkeypatch.setattr(allocator, 'for_all_devices', MagicMock())
+    resource = allocator.claim_any(Resource.objects.all(), admin_user, used_for='TEST', strategy='pack')
+    assert resource.name == 'RESOURCE_a2'
+    assert Resource.objects.get(pk='RESOURCE_a2').user == admin_user